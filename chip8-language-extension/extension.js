@@ -0,0 +1,29 @@
+// Starts the language server of the assembler ('chip8_compiler lsp') for the
+// .mini8 files. The command and the include directories are configurable.
+const vscode = require("vscode");
+const { LanguageClient, TransportKind } = require("vscode-languageclient/node");
+
+let client;
+
+function activate(context) {
+    const configuration = vscode.workspace.getConfiguration("mini8.server");
+    const command = configuration.get("command", "chip8_compiler");
+    const args = ["lsp"];
+    for (const includeDir of configuration.get("includeDirs", [])) {
+        args.push("-I", includeDir);
+    }
+
+    const serverOptions = { command, args, transport: TransportKind.stdio };
+    const clientOptions = {
+        documentSelector: [{ scheme: "file", language: "mini8" }]
+    };
+
+    client = new LanguageClient("mini8", "Mini8 Language Server", serverOptions, clientOptions);
+    client.start();
+}
+
+function deactivate() {
+    return client ? client.stop() : undefined;
+}
+
+module.exports = { activate, deactivate };
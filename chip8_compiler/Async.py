@@ -0,0 +1,251 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from timeit import default_timer as timer
+from typing import AsyncIterator, Iterable
+
+from .Batch import BuildResult, find_sources, worker_preprocessor
+from .Interfaces import AssemblyError
+from .Parser import assemble, iter_buffer_lines
+from .Preprocessor import Preprocessor
+from .Program import write_atomically
+
+# Asyncio API of the assembler, for event loops that must not block.
+#
+# The file reads and writes run on the I/O executor, the assembly (CPU-bound)
+# on the assembly executor: both default to the default executor of the loop
+# (threads). A ProcessPoolExecutor given for the assembly gets the sources as
+# bytes, and assembles them with a preprocessor of its own per worker process
+# (see Batch.py).
+#
+# Batches go through a pipeline of three stages, one task each (the assembly
+# stage can have several), linked by bounded queues:
+#     read -> assemble -> write -> results
+# so the next source is read while the current one is assembled and the
+# previous output written. A full queue stops the stage feeding it: a slow
+# consumer of the results holds back the writes, then the assembly, then the
+# reads. Closing the results (or cancelling the task reading them) cancels
+# every stage, the executor jobs not yet started with it.
+
+DEFAULT_QUEUE_SIZE: int = 4
+
+
+def _read_file(file_path: str) -> bytes:
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def _assemble_source(source: bytes, source_path: str | None, preprocessor: Preprocessor) -> bytes:
+    return assemble(iter_buffer_lines(source), preprocessor=preprocessor, source_path=source_path)
+
+
+def _assemble_in_worker(source: bytes, source_path: str | None, include_dirs: tuple[str, ...]) -> bytes:
+    # In a worker process: the preprocessor cannot be sent over, the worker has its own
+    return _assemble_source(source, source_path, worker_preprocessor(include_dirs))
+
+
+def _error(error: Exception) -> str:
+    return f"{type(error).__name__}: {error}"
+
+
+class AsyncAssembler:
+    """
+    Assembles sources without blocking the event loop, see above. The executors are not shut down by the assembler
+    """
+
+    def __init__(
+            self,
+            executor: Executor | None = None,
+            io_executor: Executor | None = None,
+            include_dirs: Iterable[str] = ()
+    ):
+        """
+        :param executor: Executor | None, where the sources are assembled, the default executor of the loop if None
+        :param io_executor: Executor | None, where the files are read and written, the default executor of the loop
+        if None
+        :param include_dirs: Iterable[str], where the included files are searched (see Preprocessor)
+        """
+        self.executor: Executor | None = executor
+        self.io_executor: Executor | None = io_executor
+        self.include_dirs: tuple[str, ...] = tuple(include_dirs)
+        # Shared by the assemblies run in threads, so the included files are only loaded once
+        self.preprocessor: Preprocessor = Preprocessor(self.include_dirs)
+
+    async def read(self, file_path: str) -> bytes:
+        """
+        Reads the file on the I/O executor
+        :param file_path: str
+        :return: bytes
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, _read_file, file_path)
+
+    async def write(self, file_path: str, bytecode: bytes) -> None:
+        """
+        Writes the file atomically on the I/O executor, creating its directory if needed
+        :param file_path: str
+        :param bytecode: bytes
+        :return:
+        """
+        await asyncio.get_running_loop().run_in_executor(self.io_executor, write_atomically, file_path, bytecode)
+
+    async def assemble(self, source: bytes | str, source_path: str | None = None) -> bytes:
+        """
+        Assembles the source code on the assembly executor. Raises an AssemblyError in case of invalid code
+        :param source: bytes | str, the whole source
+        :param source_path: str | None, where the source was read from, the includes are resolved from there
+        :return: bytes
+        """
+        if isinstance(source, str):
+            source = source.encode()
+
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        if isinstance(self.executor, ProcessPoolExecutor):
+            return await loop.run_in_executor(
+                self.executor, _assemble_in_worker, source, source_path, self.include_dirs
+            )
+        return await loop.run_in_executor(self.executor, _assemble_source, source, source_path, self.preprocessor)
+
+    async def assemble_file(self, file_path: str) -> bytes:
+        """
+        Reads and assembles the file. Raises an AssemblyError in case of invalid code
+        :param file_path: str
+        :return: bytes
+        """
+        return await self.assemble(await self.read(file_path), file_path)
+
+    async def build(
+            self,
+            pairs: Iterable[tuple[str, str]],
+            queue_size: int = DEFAULT_QUEUE_SIZE,
+            workers: int = 1
+    ) -> AsyncIterator[BuildResult]:
+        """
+        Assembles every (source, output) pair through the pipeline, yielding the result of every source once its output
+        is written (in order with a single worker). Never raises for a source, the errors are stored in the results.
+        Close it (e.g. with contextlib.aclosing) when leaving it early, to cancel the stages
+        :param pairs: Iterable[tuple[str, str]]
+        :param queue_size: int, how many sources may wait between two stages
+        :param workers: int, how many sources may be assembled at once (the assembly executor must have the workers)
+        :return: AsyncIterator[BuildResult]
+        """
+        if queue_size < 1 or workers < 1:
+            raise ValueError("The queue size and the number of workers must be positive")
+
+        # (result, source or output bytes, start time), None once a stage is done
+        read: asyncio.Queue = asyncio.Queue(queue_size)
+        assembled: asyncio.Queue = asyncio.Queue(queue_size)
+        results: asyncio.Queue = asyncio.Queue(queue_size)
+
+        async def read_stage() -> None:
+            for source, output in pairs:
+                result: BuildResult = BuildResult(source=source, output=output)
+                start: float = timer()
+                data: bytes | None = None
+                try:
+                    data = await self.read(source)
+                except OSError as e:
+                    result.error = _error(e)
+                await read.put((result, data, start))
+            for _ in range(workers):
+                await read.put(None)
+
+        async def assemble_stage() -> None:
+            while (item := await read.get()) is not None:
+                result, data, start = item
+                bytecode: bytes | None = None
+                if data is not None:
+                    try:
+                        bytecode = await self.assemble(data, result.source)
+                    except (AssemblyError, OSError, ValueError) as e:
+                        result.error = _error(e)
+                await assembled.put((result, bytecode, start))
+            await assembled.put(None)
+
+        async def write_stage() -> None:
+            done: int = 0
+            while done < workers:
+                item = await assembled.get()
+                if item is None:
+                    done += 1
+                    continue
+
+                result, bytecode, start = item
+                if bytecode is not None:
+                    try:
+                        await self.write(result.output, bytecode)
+                        result.size = len(bytecode)
+                    except OSError as e:
+                        result.error = _error(e)
+                result.elapsed = timer() - start
+                await results.put(result)
+            await results.put(None)
+
+        tasks: list[asyncio.Task] = [
+            asyncio.create_task(read_stage()),
+            *(asyncio.create_task(assemble_stage()) for _ in range(workers)),
+            asyncio.create_task(write_stage())
+        ]
+        next_result: asyncio.Task | None = None
+
+        try:
+            while True:
+                next_result = asyncio.create_task(results.get())
+                running: list[asyncio.Task] = [task for task in tasks if not task.done()]
+                # A stage failing unexpectedly would never feed the results, its error is raised instead
+                await asyncio.wait((next_result, *running), return_when=asyncio.FIRST_COMPLETED)
+                if not next_result.done():
+                    next_result.cancel()
+                    for task in tasks:
+                        if task.done() and task.exception() is not None:
+                            raise task.exception()
+                    continue
+
+                result: BuildResult | None = next_result.result()
+                if result is None:
+                    break
+                yield result
+        finally:
+            for task in (*tasks, *([] if next_result is None else [next_result])):
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def assemble_file_async(
+        file_path: str,
+        executor: Executor | None = None,
+        include_dirs: Iterable[str] = ()
+) -> bytes:
+    """
+    Reads and assembles the file without blocking the event loop, see AsyncAssembler
+    :param file_path: str
+    :param executor: Executor | None, where the source is assembled
+    :param include_dirs: Iterable[str]
+    :return: bytes
+    """
+    return await AsyncAssembler(executor, include_dirs=include_dirs).assemble_file(file_path)
+
+
+def build_stream(
+        paths: Iterable[str],
+        output_dir: str,
+        executor: Executor | None = None,
+        include_dirs: Iterable[str] = (),
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        workers: int = 1
+) -> AsyncIterator[BuildResult]:
+    """
+    Assembles every source found in the paths (see find_sources) into the output directory through the pipeline of
+    AsyncAssembler.build, whose results it returns
+    :param paths: Iterable[str]
+    :param output_dir: str
+    :param executor: Executor | None, where the sources are assembled
+    :param include_dirs: Iterable[str]
+    :param queue_size: int
+    :param workers: int
+    :return: AsyncIterator[BuildResult]
+    """
+    assembler: AsyncAssembler = AsyncAssembler(executor, include_dirs=include_dirs)
+    pairs: list[tuple[str, str]] = [
+        (source, os.path.join(output_dir, output)) for source, output in find_sources(paths, assembler.preprocessor)
+    ]
+    return assembler.build(pairs, queue_size, workers)
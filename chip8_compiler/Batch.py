@@ -0,0 +1,252 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, asdict
+from timeit import default_timer as timer
+from typing import Iterable
+
+from .Cache import BuildCache, assemble_cached
+from .Interfaces import AssemblyError
+from .Parser import assemble_file
+from .Preprocessor import Preprocessor
+
+# Batch assembly of many sources. Every source is assembled in-process by a
+# worker of a process pool, so the interpreter startup and the imports are only
+# paid once per worker instead of once per file.
+
+SOURCE_EXTENSION: str = ".mini8"
+OUTPUT_EXTENSION: str = ".ch8"
+
+
+@dataclass
+class BuildResult:
+    """
+    The outcome of assembling a single source
+    """
+    source: str
+    output: str
+    size: int = 0
+    error: str | None = None
+    elapsed: float = 0.0
+    cached: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class BatchSummary:
+    """
+    The outcome of a batch build, one BuildResult per source
+    """
+    results: list[BuildResult] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def succeeded(self) -> list[BuildResult]:
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self) -> list[BuildResult]:
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def cached(self) -> list[BuildResult]:
+        return [result for result in self.results if result.cached]
+
+    def to_dict(self) -> dict:
+        return {
+            "elapsed": self.elapsed,
+            "succeeded": len(self.succeeded),
+            "failed": len(self.failed),
+            "cached": len(self.cached),
+            "results": [asdict(result) for result in self.results]
+        }
+
+
+def __read_manifest(manifest_path: str) -> list[str]:
+    """
+    Reads a manifest: a text file listing one source per line, relative to the manifest. Blank lines and lines starting
+    with '#' are ignored
+    :param manifest_path: str
+    :return: list[str]
+    """
+    base_dir: str = os.path.dirname(manifest_path)
+
+    with open(manifest_path, "r") as f:
+        return [
+            os.path.join(base_dir, line)
+            for line in (line.strip() for line in f)
+            if line != "" and not line.startswith("#")
+        ]
+
+
+def included_files(sources: Iterable[str], preprocessor: Preprocessor) -> set[str]:
+    """
+    Returns the files (absolute paths) included by the sources, directly or not, found by following their include
+    directives (see Preprocessor.dependencies). A source whose includes cannot be followed is skipped, its assembly
+    reports the error
+    :param sources: Iterable[str]
+    :param preprocessor: Preprocessor
+    :return: set[str]
+    """
+    included: set[str] = set()
+    for source in sources:
+        try:
+            included.update(path for path, _ in preprocessor.dependencies(source))
+        except (AssemblyError, OSError, ValueError):
+            continue
+    return included
+
+
+def find_sources(paths: Iterable[str], preprocessor: Preprocessor | None = None) -> list[tuple[str, str]]:
+    """
+    Collects the sources to be assembled. Each path can be a source, a directory (searched recursively for sources) or
+    a manifest. The files of a directory included by its other sources are fragments, not programs, and are left out.
+
+    Returns (source, relative output path) pairs. The outputs of a directory mirror its layout, the other sources are
+    placed by their file name.
+    :param paths: Iterable[str]
+    :param preprocessor: Preprocessor | None, resolves the includes of the directories, a fresh one unless given
+    :return: list[tuple[str, str]]
+    """
+    sources: list[tuple[str, str]] = []
+
+    def output_name(relative_source: str) -> str:
+        return os.path.splitext(relative_source)[0] + OUTPUT_EXTENSION
+
+    for path in paths:
+        if os.path.isdir(path):
+            found: list[str] = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                found.extend(os.path.join(root, file) for file in sorted(files) if file.endswith(SOURCE_EXTENSION))
+
+            if preprocessor is None:
+                preprocessor = Preprocessor()
+            included: set[str] = included_files(found, preprocessor)
+            sources.extend(
+                (source, output_name(os.path.relpath(source, path)))
+                for source in found
+                if os.path.abspath(source) not in included
+            )
+        elif path.endswith(SOURCE_EXTENSION):
+            sources.append((path, output_name(os.path.basename(path))))
+        else:
+            sources.extend(
+                (source, output_name(os.path.basename(source)))
+                for source in __read_manifest(path)
+            )
+
+    return sources
+
+
+# Cache of the current worker process, opened on first use
+__WORKER_CACHE__: BuildCache | None = None
+# Preprocessor of the current worker process, so every included file is only loaded once per worker
+__WORKER_PREPROCESSOR__: Preprocessor | None = None
+
+
+def __worker_cache(cache_dir: str) -> BuildCache:
+    global __WORKER_CACHE__
+    if __WORKER_CACHE__ is None or __WORKER_CACHE__.cache_dir != cache_dir:
+        __WORKER_CACHE__ = BuildCache(cache_dir)
+    return __WORKER_CACHE__
+
+
+def worker_preprocessor(include_dirs: tuple[str, ...]) -> Preprocessor:
+    """
+    The preprocessor of the current worker process, for the include directories
+    :param include_dirs: tuple[str, ...]
+    :return: Preprocessor
+    """
+    global __WORKER_PREPROCESSOR__
+    if __WORKER_PREPROCESSOR__ is None or \
+            __WORKER_PREPROCESSOR__.include_dirs != [os.path.abspath(include_dir) for include_dir in include_dirs]:
+        __WORKER_PREPROCESSOR__ = Preprocessor(include_dirs)
+    return __WORKER_PREPROCESSOR__
+
+
+def build_one(
+        source: str,
+        output: str,
+        cache_dir: str | None = None,
+        include_dirs: tuple[str, ...] = ()
+) -> BuildResult:
+    """
+    Assembles a single source into the output file. Never raises, the errors are stored in the result
+    :param source: str
+    :param output: str
+    :param cache_dir: str | None, the build cache to go through (see BuildCache)
+    :param include_dirs: tuple[str, ...], where the included files are searched (see Preprocessor)
+    :return: BuildResult
+    """
+    start = timer()
+    result: BuildResult = BuildResult(source=source, output=output)
+
+    try:
+        preprocessor: Preprocessor = worker_preprocessor(include_dirs)
+
+        if cache_dir is not None:
+            cached_build = assemble_cached(source, __worker_cache(cache_dir), preprocessor=preprocessor)
+            bytecode: bytes = cached_build.bytecode
+            result.cached = cached_build.hit
+        else:
+            bytecode = assemble_file(source, preprocessor=preprocessor).to_bytes()
+
+        output_dir: str = os.path.dirname(output)
+        if output_dir != "":
+            os.makedirs(output_dir, exist_ok=True)
+
+        with open(output, "wb") as f:
+            f.write(bytecode)
+
+        result.size = len(bytecode)
+    except (AssemblyError, OSError, ValueError) as e:
+        result.error = f"{type(e).__name__}: {e}"
+
+    result.elapsed = timer() - start
+    return result
+
+
+def __build_pair(pair: tuple[str, str, str | None, tuple[str, ...]]) -> BuildResult:
+    return build_one(*pair)
+
+
+def build_many(
+        paths: Iterable[str],
+        output_dir: str,
+        jobs: int | None = None,
+        cache_dir: str | None = None,
+        include_dirs: Iterable[str] = ()
+) -> BatchSummary:
+    """
+    Assembles every source found in the paths (see find_sources) into the output directory, over a pool of jobs
+    processes. Runs in-process when jobs is 1.
+    :param paths: Iterable[str]
+    :param output_dir: str
+    :param jobs: int | None, defaults to the number of CPUs
+    :param cache_dir: str | None, the build cache to go through (see BuildCache)
+    :param include_dirs: Iterable[str], where the included files are searched (see Preprocessor)
+    :return: BatchSummary
+    """
+    start = timer()
+    include_dirs = tuple(include_dirs)
+
+    pairs: list[tuple[str, str, str | None, tuple[str, ...]]] = [
+        (source, os.path.join(output_dir, output), cache_dir, include_dirs)
+        for source, output in find_sources(paths, Preprocessor(include_dirs))
+    ]
+
+    jobs = jobs or os.cpu_count() or 1
+    jobs = min(jobs, len(pairs)) or 1
+
+    if jobs == 1:
+        results: list[BuildResult] = [__build_pair(pair) for pair in pairs]
+    else:
+        # Big chunks keep the inter-process traffic low, while still balancing the load between workers
+        chunk_size: int = max(1, len(pairs) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(__build_pair, pairs, chunksize=chunk_size))
+
+    return BatchSummary(results=results, elapsed=timer() - start)
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+
+from . import __version__
+from .Globals import AssemblyContext
+from .Parser import assemble
+from .Preprocessor import Preprocessor
+from .Program import write_atomically
+
+# Content-addressed cache of assembled programs. Entries are keyed by the hash
+# of the source bytes, the hashes of the files it includes and the assembler
+# version, so an unchanged source is never assembled twice. Callers caching
+# the assemblies with options of their own add the options to the key.
+#
+# Entry layout: 4-byte big-endian length of the symbol table, the symbol table
+# as JSON, then the bytecode.
+
+ENTRY_EXTENSION: str = ".c8c"
+DEFAULT_MAX_BYTES: int = 64 * 1024 * 1024
+
+
+@dataclass
+class CachedBuild:
+    """
+    A cached assembly: the bytecode and the resolved symbol table (see AssemblyContext.symbol_table)
+    """
+    bytecode: bytes
+    symbols: dict
+    hit: bool = False
+
+
+class BuildCache:
+    """
+    On-disk cache of assembled programs, bounded to max_bytes by evicting the least recently used entries (see evict).
+    The last use of an entry is the modification time of its file, which get refreshes.
+
+    Safe to share between processes: entries are written atomically and a missing entry is just a cache miss.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir: str = cache_dir
+        self.max_bytes: int = max_bytes
+        # Estimated size of the cache, computed on the first write
+        self.__size: int | None = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(source: bytes, options: dict | None = None, dependencies: list[tuple[str, str]] | None = None) -> str:
+        """
+        Computes the key of a source, for the given assembly options
+        :param source: bytes
+        :param options: dict | None
+        :param dependencies: list[tuple[str, str]] | None, the (path, digest) of the included files
+        :return: str
+        """
+        digest = hashlib.sha256()
+        digest.update(__version__.encode())
+        digest.update(b"\0")
+        digest.update(json.dumps(options or {}, sort_keys=True).encode())
+        digest.update(b"\0")
+        for path, dependency_digest in dependencies or ():
+            digest.update(f"{path}\0{dependency_digest}\0".encode())
+        digest.update(b"\0")
+        digest.update(source)
+        return digest.hexdigest()
+
+    def __entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ENTRY_EXTENSION)
+
+    def get(self, key: str) -> CachedBuild | None:
+        """
+        Returns the cached assembly for the key, None if there is none or if the entry is corrupt (it is removed then)
+        :param key: str
+        :return: CachedBuild | None
+        """
+        entry_path: str = self.__entry_path(key)
+
+        try:
+            with open(entry_path, "rb") as f:
+                entry: bytes = f.read()
+            # Mark the entry as recently used
+            os.utime(entry_path)
+        except OSError:
+            return None
+
+        symbols_length: int = int.from_bytes(entry[:4], "big")
+        try:
+            if 4 + symbols_length > len(entry):
+                raise ValueError("Truncated entry")
+            symbols: dict = json.loads(entry[4:4 + symbols_length])
+            if not isinstance(symbols, dict):
+                raise ValueError("Invalid symbol table")
+        except ValueError:
+            # A corrupt or foreign entry is a miss, and is removed so it gets written again
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            return None
+
+        return CachedBuild(bytecode=entry[4 + symbols_length:], symbols=symbols, hit=True)
+
+    def put(self, key: str, bytecode: bytes, symbols: dict) -> None:
+        """
+        Stores an assembly under the key, evicting old entries if the cache grows over its size limit
+        :param key: str
+        :param bytecode: bytes
+        :param symbols: dict
+        :return:
+        """
+        encoded_symbols: bytes = json.dumps(symbols, separators=(",", ":")).encode()
+        entry: bytes = len(encoded_symbols).to_bytes(4, "big") + encoded_symbols + bytecode
+
+        # Readers never see a partial entry
+        write_atomically(self.__entry_path(key), entry)
+
+        if self.__size is None:
+            self.__size = self.size()
+        else:
+            self.__size += len(entry)
+
+        if self.__size > self.max_bytes:
+            self.evict()
+
+    def size(self) -> int:
+        """
+        Returns the total size of the cache entries
+        :return: int
+        """
+        return sum(
+            entry.stat().st_size
+            for entry in os.scandir(self.cache_dir)
+            if entry.name.endswith(ENTRY_EXTENSION)
+        )
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries, until the cache fits in half of its size limit. Evicting down to a
+        lower watermark keeps the eviction scans rare. The entries are kept from the most recently used one, and every
+        entry older than the first one not fitting is removed, even a smaller one
+        :return:
+        """
+        entries = sorted(
+            (
+                (stat.st_mtime, stat.st_size, entry.path)
+                for entry in os.scandir(self.cache_dir)
+                if entry.name.endswith(ENTRY_EXTENSION)
+                for stat in (entry.stat(),)
+            ),
+            reverse=True
+        )
+
+        total_size: int = 0
+        target_size: int = self.max_bytes // 2
+        full: bool = False
+
+        for _, size, path in entries:
+            if not full and total_size + size <= target_size:
+                total_size += size
+                continue
+
+            full = True
+
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed by another process
+                pass
+
+        self.__size = total_size
+
+    def clear(self) -> None:
+        """
+        Removes every entry of the cache
+        :return:
+        """
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(ENTRY_EXTENSION):
+                os.remove(entry.path)
+        self.__size = 0
+
+
+def assemble_cached(
+        file_path: str,
+        cache: BuildCache,
+        preprocessor: Preprocessor | None = None
+) -> CachedBuild:
+    """
+    Assembles the file, going through the cache. Raises an AssemblyError in case of invalid code (see assemble)
+    :param file_path: str
+    :param cache: BuildCache
+    :param preprocessor: Preprocessor | None, see assemble
+    :return: CachedBuild
+    """
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+
+    with open(file_path, "rb") as f:
+        source: bytes = f.read()
+
+    key: str = cache.key(source, dependencies=preprocessor.dependencies(file_path))
+    cached_build: CachedBuild | None = cache.get(key)
+    if cached_build is not None:
+        return cached_build
+
+    context: AssemblyContext = AssemblyContext()
+    bytecode: bytes = assemble(source.decode().splitlines(), context, preprocessor=preprocessor, source_path=file_path)
+    symbols: dict = context.symbol_table()
+
+    cache.put(key, bytecode, symbols)
+    return CachedBuild(bytecode=bytecode, symbols=symbols)
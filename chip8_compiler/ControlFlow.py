@@ -0,0 +1,181 @@
+from dataclasses import dataclass, field
+
+from .Globals import PROGRAM_START
+from .Interfaces import Bytecode
+from .Types import Label, Instruction
+from ._ChipInstructions import LITERAL_KIND, NORMAL_REGISTER_KIND
+
+# Control-flow graph of the parsed items of a program.
+#
+# The items (the raw opcodes of an AssemblyContext, see Parser.py) are split
+# into basic blocks: straight runs of items entered only at their first one and
+# left only after their last one. The edges follow the CHIP-8 semantics:
+#     SE, SNE, SKP, SKNP: the next item, or the one after it (the next item is
+#                         skipped by its 2 bytes)
+#     JP addr:            addr
+#     CALL addr:          addr, and the next item once the call returns
+#     RET:                none, the block returns to its caller
+#     JP V0, addr:        any item from addr to addr + 0xFF
+#     anything else:      the next item
+# Data bytes are items like the others, the flow just runs through them.
+#
+# Jumps to addresses outside the program have no edge. A jump to the middle of
+# an item cannot be followed: the graph records why in unresolved, and must not
+# be used to remove code then.
+
+_SKIP_COMMANDS: frozenset[str] = frozenset(["SE", "SNE", "SKP", "SKNP"])
+_JP: tuple = ("JP", LITERAL_KIND, None, None)
+_JP_V0: tuple = ("JP", NORMAL_REGISTER_KIND, LITERAL_KIND, None)
+_CALL: tuple = ("CALL", LITERAL_KIND, None, None)
+_RET: tuple = ("RET", None, None, None)
+# The reach of JP V0, addr past addr
+_INDIRECT_JUMP_RANGE: int = 0x100
+
+
+@dataclass(slots=True)
+class BasicBlock:
+    """
+    A run of items: start and end are indexes in the items of the graph, address the address of the first one, and
+    successors the indexes of the blocks the flow can go to next
+    """
+    start: int
+    end: int
+    address: int
+    successors: list[int] = field(default_factory=list)
+
+
+class ControlFlowGraph:
+    """
+    The basic blocks of the items of a program, see above. The entry block is the first one
+    """
+
+    def __init__(self, items: list[Bytecode], start: int = PROGRAM_START):
+        """
+        :param items: list[Bytecode], the parsed instructions and data bytes, with their symbols resolved
+        :param start: int, the address of the first item
+        """
+        self.items: list[Bytecode] = items
+        self.start: int = start
+        self.blocks: list[BasicBlock] = []
+        # Why the graph may miss some edges, None if it is complete
+        self.unresolved: str | None = None
+
+        self.addresses: list[int] = []
+        address: int = start
+        for item in items:
+            self.addresses.append(address)
+            address += item.byte_length()
+        self.end: int = address
+        self.__indexes: dict[int, int] = {address: index for index, address in enumerate(self.addresses)}
+
+        self.__build()
+
+    def index_at(self, address: int) -> int | None:
+        """
+        The index of the item starting at the address, None if there is none
+        :param address: int
+        :return: int | None
+        """
+        return self.__indexes.get(address, None)
+
+    def __target(self, item: Instruction, operand) -> int | None:
+        # The item index of the address the operand holds, None outside of the program
+        address: int = operand.address if operand.__class__ is Label else operand.operand_value()
+        if not self.start <= address < self.end:
+            return None
+
+        index: int | None = self.__indexes.get(address, None)
+        if index is None and self.unresolved is None:
+            self.unresolved = f"the instruction at 0x{item.address:X} goes to the middle of an item (0x{address:X})"
+        return index
+
+    def item_successors(self, index: int) -> list[int]:
+        """
+        The indexes of the items the flow can go to after the item
+        :param index: int
+        :return: list[int]
+        """
+        item: Bytecode = self.items[index]
+        following: list[int] = [index + 1] if index + 1 < len(self.items) else []
+        if item.__class__ is not Instruction:
+            return following
+
+        key: tuple = (item.command, *item.encoding.shape)
+        if key == _RET:
+            return []
+        if key == _JP:
+            target: int | None = self.__target(item, item.operand1)
+            return [] if target is None else [target]
+        if key == _CALL:
+            target = self.__target(item, item.operand1)
+            return following if target is None else [target, *following]
+        if key == _JP_V0:
+            base: int = item.operand2.address if item.operand2.__class__ is Label else item.operand2.operand_value()
+            return [
+                self.__indexes[address]
+                for address in range(base, base + _INDIRECT_JUMP_RANGE)
+                if address in self.__indexes
+            ]
+        if item.command in _SKIP_COMMANDS:
+            skipped: int | None = self.__indexes.get(self.addresses[index] + 4, None)
+            if skipped is None and self.addresses[index] + 4 < self.end and self.unresolved is None:
+                self.unresolved = f"the skip at 0x{self.addresses[index]:X} lands in the middle of an item"
+            return following + ([] if skipped is None else [skipped])
+        return following
+
+    def __build(self) -> None:
+        if not self.items:
+            return
+
+        # The first item of every block
+        successors: list[list[int]] = [self.item_successors(index) for index in range(len(self.items))]
+        leaders: set[int] = {0}
+        for index, item_successors in enumerate(successors):
+            if item_successors != [index + 1]:
+                leaders.update(item_successors)
+                leaders.add(index + 1)
+        leaders.discard(len(self.items))
+
+        starts: list[int] = sorted(leaders)
+        block_indexes: dict[int, int] = {item_index: block for block, item_index in enumerate(starts)}
+        for block, block_start in enumerate(starts):
+            block_end: int = starts[block + 1] if block + 1 < len(starts) else len(self.items)
+            self.blocks.append(BasicBlock(
+                block_start,
+                block_end,
+                self.addresses[block_start],
+                sorted({block_indexes[successor] for successor in successors[block_end - 1]})
+            ))
+
+    def reachable(self) -> list[BasicBlock]:
+        """
+        The blocks reached from the entry block, in the order of the program
+        :return: list[BasicBlock]
+        """
+        if not self.blocks:
+            return []
+
+        seen: set[int] = {0}
+        pending: list[int] = [0]
+        while pending:
+            for successor in self.blocks[pending.pop()].successors:
+                if successor not in seen:
+                    seen.add(successor)
+                    pending.append(successor)
+
+        return [self.blocks[block] for block in sorted(seen)]
+
+    def unreachable_instructions(self) -> list[int]:
+        """
+        The indexes of the instructions no flow from the entry reaches. The data bytes are never counted in
+        :return: list[int]
+        """
+        reached: set[int] = set()
+        for block in self.reachable():
+            reached.update(range(block.start, block.end))
+
+        return [
+            index
+            for index, item in enumerate(self.items)
+            if index not in reached and item.__class__ is Instruction
+        ]
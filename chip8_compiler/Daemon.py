@@ -0,0 +1,323 @@
+import base64
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import IO
+
+# Long-running assembler server. It keeps the encoding tables warm and caches
+# the result of every assembled file, keyed by its mtime and content hash (and
+# the mtimes of the files it includes), so repeated requests are answered
+# without reassembling.
+#
+# Protocol: one JSON object per line, in both directions.
+#   request:  {"id": ..., "method": "assemble", "params": {"input": path, "output": path | null}}
+#   response: {"id": ..., "result": {...}} or {"id": ..., "error": {"type": ..., "message": ...}}
+#
+# Methods:
+#   assemble  assembles params.input. Writes to params.output if given,
+#             otherwise returns the bytecode (base64) in the result
+#   ping      checks that the server is up
+#   stats     returns the cache statistics
+#   shutdown  stops the server
+
+SOCKET_ENVIRONMENT_VARIABLE: str = "CHIP8_COMPILER_SOCKET"
+DEFAULT_MAX_ENTRIES: int = 4096
+
+
+def default_socket_path() -> str:
+    """
+    The socket used when none is given: $CHIP8_COMPILER_SOCKET, or a per-user socket in the temporary directory
+    :return: str
+    """
+    socket_path: str | None = os.environ.get(SOCKET_ENVIRONMENT_VARIABLE, None)
+    if socket_path:
+        return socket_path
+
+    user: str = str(os.getuid()) if hasattr(os, "getuid") else "user"
+    return os.path.join(tempfile.gettempdir(), f"chip8_compiler-{user}.sock")
+
+
+@dataclass
+class CachedResult:
+    mtime_ns: int
+    size: int
+    digest: str
+    bytecode: bytes
+    # The (path, mtime_ns, size) of every included file
+    dependencies: list[tuple[str, int, int]] = field(default_factory=list)
+
+    def dependencies_unchanged(self) -> bool:
+        for path, mtime_ns, size in self.dependencies:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+                return False
+        return True
+
+
+class AssemblerService:
+    """
+    Answers the protocol requests, caching the assembled files. Thread-safe
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        # Imported here, so the client side never pays for the assembler imports
+        from .Parser import assemble
+        from .Preprocessor import Preprocessor
+
+        self.__assemble = assemble
+        # Shared by every request, so the included files stay loaded
+        self.__preprocessor = Preprocessor()
+        self.max_entries: int = max_entries
+        self.__results: OrderedDict[str, CachedResult] = OrderedDict()
+        self.__lock: threading.Lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.running: bool = True
+
+    def __cached(self, path: str) -> tuple[bytes, bool]:
+        """
+        Returns the bytecode of the file and whether it came from the cache
+        """
+        stat = os.stat(path)
+
+        with self.__lock:
+            cached_result: CachedResult | None = self.__results.get(path, None)
+            if cached_result is not None and \
+                    cached_result.mtime_ns == stat.st_mtime_ns and cached_result.size == stat.st_size and \
+                    cached_result.dependencies_unchanged():
+                self.__results.move_to_end(path)
+                self.hits += 1
+                return cached_result.bytecode, True
+
+        with open(path, "rb") as f:
+            source: bytes = f.read()
+        digest: str = hashlib.sha256(source).hexdigest()
+
+        # Touched, but not changed
+        if cached_result is not None and cached_result.digest == digest and cached_result.dependencies_unchanged():
+            bytecode: bytes = cached_result.bytecode
+            dependencies: list[tuple[str, int, int]] = cached_result.dependencies
+            hit: bool = True
+        else:
+            bytecode = self.__assemble(
+                source.decode().splitlines(), preprocessor=self.__preprocessor, source_path=path
+            )
+            dependencies = [
+                (dependency, dependency_stat.st_mtime_ns, dependency_stat.st_size)
+                for dependency in sorted(self.__preprocessor.graph.dependencies(path))
+                for dependency_stat in (os.stat(dependency),)
+            ]
+            hit = False
+
+        with self.__lock:
+            self.__results[path] = CachedResult(stat.st_mtime_ns, stat.st_size, digest, bytecode, dependencies)
+            self.__results.move_to_end(path)
+            while len(self.__results) > self.max_entries:
+                self.__results.popitem(last=False)
+
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return bytecode, hit
+
+    def assemble(self, params: dict) -> dict:
+        from .Program import write_output
+
+        path: str = os.path.abspath(params["input"])
+        bytecode, cached = self.__cached(path)
+
+        result: dict = {"size": len(bytecode), "cached": cached}
+
+        output: str | None = params.get("output", None)
+        if output is not None:
+            write_output(output, bytecode)
+            result["output"] = output
+        else:
+            result["bytecode"] = base64.b64encode(bytecode).decode()
+
+        return result
+
+    def stats(self, params: dict) -> dict:
+        with self.__lock:
+            return {"entries": len(self.__results), "hits": self.hits, "misses": self.misses}
+
+    def ping(self, params: dict) -> dict:
+        return {"pid": os.getpid()}
+
+    def shutdown(self, params: dict) -> dict:
+        self.running = False
+        return {}
+
+    def handle(self, request: dict) -> dict:
+        """
+        Answers a single request
+        :param request: dict
+        :return: dict
+        """
+        methods: dict = {
+            "assemble": self.assemble,
+            "stats": self.stats,
+            "ping": self.ping,
+            "shutdown": self.shutdown
+        }
+
+        response: dict = {"id": request.get("id", None)}
+        method = methods.get(request.get("method", None), None)
+
+        if method is None:
+            response["error"] = {"type": "MethodNotFound", "message": f"Unknown method '{request.get('method')}'"}
+            return response
+
+        try:
+            response["result"] = method(request.get("params", None) or {})
+        except Exception as e:
+            response["error"] = {"type": type(e).__name__, "message": str(e)}
+
+        return response
+
+    def handle_line(self, line: str) -> str:
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return json.dumps({"id": None, "error": {"type": "ParseError", "message": str(e)}})
+
+        return json.dumps(self.handle(request))
+
+
+def serve_stdio(service: AssemblerService, input_stream: IO[str] = sys.stdin, output_stream: IO[str] = sys.stdout) -> None:
+    """
+    Serves the requests read from the input stream, until it ends or a shutdown request comes
+    """
+    for line in input_stream:
+        if line.strip() == "":
+            continue
+
+        output_stream.write(service.handle_line(line) + "\n")
+        output_stream.flush()
+
+        if not service.running:
+            return
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        service: AssemblerService = self.server.service
+
+        for line in self.rfile:
+            if line.strip() == b"":
+                continue
+
+            self.wfile.write((service.handle_line(line.decode()) + "\n").encode())
+            self.wfile.flush()
+
+            if not service.running:
+                # Shut down from another thread, serve_forever is blocking this one
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+
+
+class AssemblerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, service: AssemblerService):
+        if os.path.exists(socket_path):
+            if DaemonClient(socket_path, timeout=1.0).is_running():
+                raise OSError(f"An assembler server is already listening on '{socket_path}'")
+
+            # Remove a stale socket, left by a server that did not shut down cleanly
+            os.remove(socket_path)
+
+        super().__init__(socket_path, _RequestHandler)
+        self.service: AssemblerService = service
+        self.socket_path: str = socket_path
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def serve_socket(service: AssemblerService, socket_path: str | None = None) -> None:
+    """
+    Serves the requests of every client connecting to the Unix socket, until a shutdown request comes
+    """
+    with AssemblerServer(socket_path or default_socket_path(), service) as server:
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+class DaemonError(RuntimeError):
+    """
+    A request failed on the server. error_type is the name of the exception raised there
+    """
+
+    def __init__(self, error_type: str, message: str):
+        super().__init__(f"{error_type}: {message}")
+        self.error_type: str = error_type
+        self.message: str = message
+
+
+class DaemonClient:
+    """
+    Client of a running assembler server
+    """
+
+    def __init__(self, socket_path: str | None = None, timeout: float = 30.0):
+        self.socket_path: str = socket_path or default_socket_path()
+        self.timeout: float = timeout
+        self.__next_id: int = 0
+
+    def request(self, method: str, **params) -> dict:
+        """
+        Sends a request, returns its result. Raises a ConnectionError if the server cannot be reached, a DaemonError
+        if the request failed
+        """
+        self.__next_id += 1
+
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(self.timeout)
+                connection.connect(self.socket_path)
+                connection.sendall((json.dumps({"id": self.__next_id, "method": method, "params": params}) + "\n").encode())
+
+                with connection.makefile("rb") as response_stream:
+                    response: dict = json.loads(response_stream.readline())
+        except (OSError, ValueError) as e:
+            raise ConnectionError(f"Cannot reach the assembler server at '{self.socket_path}': {e}") from e
+
+        if "error" in response:
+            raise DaemonError(response["error"]["type"], response["error"]["message"])
+
+        return response["result"]
+
+    def is_running(self) -> bool:
+        try:
+            self.request("ping")
+        except (ConnectionError, DaemonError):
+            return False
+        return True
+
+    def assemble(self, input_path: str, output_path: str | None = None) -> dict:
+        """
+        Assembles the file on the server. Paths are sent as absolute paths, the server may run in another directory
+        """
+        return self.request(
+            "assemble",
+            input=os.path.abspath(input_path),
+            output=None if output_path is None else os.path.abspath(output_path)
+        )
@@ -0,0 +1,127 @@
+from typing import Sequence
+
+# Packing of data runs (e.g. sprites) into as few bytes as possible.
+#
+# The runs are laid out into a single block, as a short common superstring of
+# them:
+#     1. identical runs are laid out once
+#     2. runs found within a longer run are laid out within it
+#     3. the remaining runs are chained greedily, by decreasing overlap: a run
+#        ending with the bytes another one starts with is followed by it, the
+#        shared bytes laid out once
+# Step 3 looks the overlaps up by their bytes, one overlap length at a time,
+# so it never compares runs pairwise: thousands of sprites take milliseconds.
+#
+# The greedy chaining is the classic approximation of the shortest common
+# superstring (at most a few times longer than the shortest, and usually
+# close to it).
+
+
+def __contained(runs: list[bytes]) -> tuple[list[bytes], dict[bytes, tuple[int, int]]]:
+    # The runs not found within another one, longest first, and where every run lies: (kept run index, offset)
+    lengths: list[int] = sorted({len(run) for run in runs})
+    kept: list[bytes] = []
+    placed: dict[bytes, tuple[int, int]] = {}
+    # The substrings of the kept runs, by length, for the lengths of the runs
+    substrings: dict[int, dict[bytes, tuple[int, int]]] = {length: {} for length in lengths}
+
+    for run in runs:
+        found: tuple[int, int] | None = substrings[len(run)].get(run, None)
+        if found is not None:
+            placed[run] = found
+            continue
+
+        index: int = len(kept)
+        kept.append(run)
+        placed[run] = (index, 0)
+        for length in lengths:
+            if length >= len(run):
+                break
+            table: dict[bytes, tuple[int, int]] = substrings[length]
+            for offset in range(len(run) - length + 1):
+                table.setdefault(run[offset:offset + length], (index, offset))
+
+    return kept, placed
+
+
+def __chain(runs: list[bytes]) -> tuple[list[int], list[int], list[int]]:
+    # Links the runs (longest first) by decreasing overlap. Returns the successor of every run (-1 for none), its
+    # overlap with it, and the predecessor of every run
+    count: int = len(runs)
+    successors: list[int] = [-1] * count
+    predecessors: list[int] = [-1] * count
+    overlaps: list[int] = [0] * count
+    # The first run of the chain ending with every run, and the last run of the chain starting with every run
+    heads: list[int] = list(range(count))
+    tails: list[int] = list(range(count))
+
+    # The runs longer than the overlap take part, the runs being sorted by decreasing length
+    participants: int = 0
+    for overlap in range(len(runs[0]) - 1 if runs else 0, 0, -1):
+        while participants < count and len(runs[participants]) > overlap:
+            participants += 1
+
+        by_prefix: dict[bytes, list[int]] = {}
+        for run in range(participants):
+            if predecessors[run] == -1:
+                by_prefix.setdefault(runs[run][:overlap], []).append(run)
+        if not by_prefix:
+            continue
+
+        for run in range(participants):
+            if successors[run] != -1:
+                continue
+            candidates: list[int] | None = by_prefix.get(runs[run][-overlap:], None)
+            if not candidates:
+                continue
+
+            for position in range(len(candidates) - 1, -1, -1):
+                candidate: int = candidates[position]
+                # Linking the last run of a chain to its own first run would close a loop
+                if predecessors[candidate] != -1 or candidate == heads[run]:
+                    continue
+
+                successors[run], predecessors[candidate], overlaps[run] = candidate, run, overlap
+                head, tail = heads[run], tails[candidate]
+                heads[tail], tails[head] = head, tail
+                del candidates[position]
+                break
+
+    return successors, overlaps, predecessors
+
+
+def pack(runs: Sequence[bytes]) -> tuple[bytes, list[int]]:
+    """
+    Lays the runs out into a single block of bytes, sharing the bytes they have in common. Returns the block and the
+    offset of every run in it
+    :param runs: Sequence[bytes]
+    :return: tuple[bytes, list[int]]
+    """
+    # Longest first, in the order of the runs otherwise, so the layout does not depend on anything else
+    distinct: list[bytes] = sorted(dict.fromkeys(bytes(run) for run in runs if run), key=len, reverse=True)
+    kept, placed = __contained(distinct)
+    successors, overlaps, predecessors = __chain(kept)
+
+    block: bytearray = bytearray()
+    positions: list[int] = [0] * len(kept)
+    for head in range(len(kept)):
+        if predecessors[head] != -1:
+            continue
+
+        run: int = head
+        overlap: int = 0
+        while run != -1:
+            positions[run] = len(block) - overlap
+            block += kept[run][overlap:]
+            overlap = overlaps[run]
+            run = successors[run]
+
+    offsets: list[int] = []
+    for run in runs:
+        if not run:
+            offsets.append(0)
+            continue
+        index, offset = placed[bytes(run)]
+        offsets.append(positions[index] + offset)
+
+    return bytes(block), offsets
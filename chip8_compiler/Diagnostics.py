@@ -0,0 +1,172 @@
+from dataclasses import dataclass, asdict
+from enum import StrEnum
+from typing import Iterable, Iterator
+
+from .Globals import AssemblyContext
+from .Interfaces import AssemblyError, DuplicateDefinitionError, InvalidCodeError, PreprocessorError
+from .Lexer import parse_item, tokenize
+from .Parser import add_item, open_source, segment_lines, strip_comments
+from .Preprocessor import Preprocessor
+from .Types import Instruction, Label, Variable
+
+# Diagnostics of a source: every error it has, from a single pass.
+#
+# Assembling stops at the first error. Checking goes on instead: a line that
+# does not parse is reported and skipped, so one run gives every syntax error,
+# every duplicate definition and every reference to an undefined symbol (at
+# each line referencing it). The errors of the segments (missing, not
+# terminated) are found once the source is read. The errors of the
+# preprocessor end the check, the expansion cannot go on past them.
+#
+# The lines keep their number in the source through every stage, and the
+# columns count from the start of the line (its indentation included). The
+# lines expanded from an include or a macro are given the position of the
+# include or of the invocation.
+#
+# With fail_fast set, the check stops at the first error, e.g. for CI.
+
+
+class DiagnosticKind(StrEnum):
+    SYNTAX = "syntax"
+    DUPLICATE = "duplicate"
+    UNRESOLVED = "unresolved"
+    SEGMENT = "segment"
+    PREPROCESSOR = "preprocessor"
+
+
+@dataclass(slots=True, frozen=True)
+class Diagnostic:
+    """
+    An error of a source. The line and the column are 1-based, None when the error has no position (e.g. a missing
+    segment). The symbol is the name of the duplicate or undefined label or variable
+    """
+    kind: DiagnosticKind
+    message: str
+    line: int | None = None
+    column: int | None = None
+    source: str | None = None
+    symbol: str | None = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def __str__(self) -> str:
+        position: str = ""
+        if self.line is not None:
+            position = f":{self.line}" if self.column is None else f":{self.line}:{self.column}"
+        return f"{self.source or '<source>'}{position}: error: {self.message} [{self.kind}]"
+
+
+def __measure_indents(lines: Iterable[str], indents: dict[int, int]) -> Iterator[str]:
+    # The width of the indentation of every line, to turn the columns within the code into columns within the line
+    for line_number, line in enumerate(lines, start=1):
+        code: str = line.lstrip()
+        if code:
+            indents[line_number] = len(line) - len(code)
+        yield line
+
+
+def diagnose(
+        lines: Iterable[str],
+        source_path: str | None = None,
+        preprocessor: Preprocessor | None = None,
+        fail_fast: bool = False,
+        context: AssemblyContext | None = None
+) -> list[Diagnostic]:
+    """
+    Checks .mini8 code from any iterable of lines, see above. Returns every error found, by line (the ones without a
+    line last), none if the code assembles
+    :param lines: Iterable[str]
+    :param source_path: str | None, where the includes are resolved from, and the source of the diagnostics
+    :param preprocessor: Preprocessor | None, a fresh one unless given
+    :param fail_fast: bool, whether to stop at the first error
+    :param context: AssemblyContext | None, a fresh one unless given, holds the symbol tables afterwards
+    :return: list[Diagnostic]
+    """
+    if context is None:
+        context = AssemblyContext()
+    else:
+        context.reset()
+    # The items are only parsed, not encoded
+    context.program = None
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+
+    diagnostics: list[Diagnostic] = []
+    indents: dict[int, int] = {}
+    # The lines referencing every symbol: (line number, code, word index)
+    references: dict[str, list[tuple[int, str, int]]] = {}
+
+    def report(kind: DiagnosticKind, error: AssemblyError, line_number: int | None, symbol: str | None = None) -> None:
+        line: int | None = error.line if error.line is not None else line_number
+        column: int | None = None
+        if error.column is not None and line == line_number:
+            column = indents.get(line, 0) + error.column
+        diagnostics.append(Diagnostic(kind, error.reason, line, column, source_path, symbol))
+
+    lines = segment_lines(preprocessor.process(strip_comments(__measure_indents(lines, indents)), source_path))
+    try:
+        for line_number, line in lines:
+            try:
+                item = parse_item(line, context, line_number)
+            except DuplicateDefinitionError as e:
+                report(DiagnosticKind.DUPLICATE, e, line_number, e.symbol)
+            except AssemblyError as e:
+                report(DiagnosticKind.SYNTAX, e, line_number)
+            except ValueError as e:
+                report(DiagnosticKind.SYNTAX, AssemblyError(str(e)), line_number)
+            else:
+                if item.__class__ is Instruction:
+                    for index, operand in enumerate((item.operand1, item.operand2, item.optional_operand)):
+                        if operand.__class__ is Label or operand.__class__ is Variable:
+                            references.setdefault(operand.name, []).append((line_number, line, index + 1))
+                add_item(item, context)
+                continue
+
+            if fail_fast:
+                return diagnostics
+    except PreprocessorError as e:
+        report(DiagnosticKind.PREPROCESSOR, e, None)
+        return diagnostics
+    except InvalidCodeError as e:
+        report(DiagnosticKind.SEGMENT, e, None)
+        if fail_fast:
+            return diagnostics
+
+    for kind, symbols in (("Label", context.labels), ("Variable", context.variables)):
+        for name, symbol in symbols.items():
+            if symbol.address is not None:
+                continue
+            for line_number, line, word_index in references.get(name, [(None, "", 0)]):
+                tokens = tokenize(line)
+                diagnostics.append(Diagnostic(
+                    DiagnosticKind.UNRESOLVED,
+                    f"{kind} '{name}' is never defined",
+                    line_number,
+                    None if line_number is None else indents.get(line_number, 0) + tokens[word_index].column,
+                    source_path,
+                    name
+                ))
+                if fail_fast:
+                    return diagnostics
+
+    diagnostics.sort(key=lambda diagnostic: (diagnostic.line is None, diagnostic.line or 0))
+    return diagnostics
+
+
+def diagnose_file(
+        file_path: str,
+        preprocessor: Preprocessor | None = None,
+        fail_fast: bool = False,
+        context: AssemblyContext | None = None
+) -> list[Diagnostic]:
+    """
+    Checks the .mini8 file, see diagnose
+    :param file_path: str
+    :param preprocessor: Preprocessor | None
+    :param fail_fast: bool
+    :param context: AssemblyContext | None
+    :return: list[Diagnostic]
+    """
+    with open_source(file_path) as lines:
+        return diagnose(lines, file_path, preprocessor, fail_fast, context)
@@ -0,0 +1,296 @@
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import Iterator
+
+from .Globals import PROGRAM_START
+from .Interfaces import InstructionEncoding
+from ._ChipInstructions import NORMAL_REGISTER_KIND, LITERAL_KIND
+from .vm import dispatch_table
+
+# Disassembler of assembled programs, back to mnemonics and .mini8 sources.
+#
+# The decoding rules are not written down here: the dispatch table of the
+# interpreter (see vm.py) is derived from the encoding table, itself built
+# from the instruction LUTs the assembler encodes with, so both directions
+# always agree. Every 16-bit word of the program maps to its encoding through
+# the table, the overlapping encodings (NOOP, CLS, RET within SYS) resolving
+# to the most specific one.
+#
+# Whole programs are decoded at once: the words are looked up in the table in
+# bulk (a single gather with numpy, when installed), and the instructions are
+# only formatted when asked for.
+#
+# The program is swept linearly, from its first word: every word that is a
+# valid instruction is taken for one, the others are written back as data
+# bytes. Either way the source assembles into the same bytes. The addresses
+# jumped to, called and loaded into I within the program get labels.
+
+SUBROUTINE_LABEL_PREFIX: str = "__sub_"
+LOCATION_LABEL_PREFIX: str = "__loc_"
+
+_INVALID: int = 0xFF
+# The instructions whose address operand gets a label
+_ADDRESS_SHAPES: frozenset[tuple] = frozenset([
+    ("JP", LITERAL_KIND, None, None),
+    ("JP", NORMAL_REGISTER_KIND, LITERAL_KIND, None),
+    ("CALL", LITERAL_KIND, None, None),
+    ("LD", "I", LITERAL_KIND, None)
+])
+_CALL_SHAPE: tuple = ("CALL", LITERAL_KIND, None, None)
+
+# The numpy copy of the dispatch table, built on first use
+_NUMPY_TABLE: list = []
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _shape_key(encoding: InstructionEncoding) -> tuple:
+    return encoding.command, *encoding.shape
+
+
+@dataclass(frozen=True, slots=True)
+class DisassembledInstruction:
+    """
+    A word of the program, and the instruction it encodes (None if it is not a valid one)
+    """
+    address: int
+    opcode: int
+    encoding: InstructionEncoding | None
+
+    @property
+    def command(self) -> str | None:
+        return None if self.encoding is None else self.encoding.command
+
+    def operand_values(self) -> list[int | None]:
+        """
+        The values of the operands in the fields of the opcode, None for the ones implied by the instruction (special
+        registers, V0 of JP V0, addr)
+        :return: list[int | None]
+        """
+        values: list[int | None] = [None] * 3
+        for index, shift, mask in self.encoding.fields:
+            values[index] = (self.opcode >> shift) & mask
+        return values
+
+    def target(self) -> int | None:
+        """
+        The address the instruction jumps to, calls or loads into I, if any
+        :return: int | None
+        """
+        if self.encoding is None or _shape_key(self.encoding) not in _ADDRESS_SHAPES:
+            return None
+        return self.opcode & 0xFFF
+
+    def text(self, labels: dict[int, str] | None = None) -> str:
+        """
+        The instruction as a line of code, its address operand replaced by its label if any. The words which are not
+        instructions are given as their two data bytes
+        :param labels: dict[int, str] | None, the labels by address
+        :return: str
+        """
+        if self.encoding is None:
+            return f"$0x{self.opcode >> 8:02X} $0x{self.opcode & 0xFF:02X}"
+
+        target: int | None = self.target()
+        values: list[int | None] = self.operand_values()
+        operands: list[str] = []
+
+        for index, kind in enumerate(self.encoding.shape):
+            if kind is None:
+                break
+            value: int | None = values[index]
+
+            if kind == NORMAL_REGISTER_KIND:
+                operands.append(f"V0x{value or 0:X}")
+            elif kind != LITERAL_KIND:
+                operands.append(kind)
+            elif target is not None and labels is not None and target in labels:
+                operands.append(labels[target])
+            else:
+                operands.append(f"$0x{value:X}")
+
+        return f"{self.encoding.command} {', '.join(operands)}" if operands else self.encoding.command
+
+    def __str__(self) -> str:
+        return self.text()
+
+
+class Disassembly:
+    """
+    A decoded program: the opcodes of its words and the index of their encodings (in encodings), decoded in bulk. The
+    instructions are built and formatted on access
+    """
+
+    def __init__(self, rom: bytes, start: int = PROGRAM_START):
+        """
+        :param rom: bytes, the program
+        :param start: int, the address the program is loaded at
+        """
+        self.rom: bytes = bytes(rom)
+        self.start: int = start
+
+        table, self.encodings = dispatch_table()
+        word_count: int = len(self.rom) // 2
+        numpy = _numpy()
+
+        if numpy is not None:
+            if not _NUMPY_TABLE:
+                _NUMPY_TABLE.append(numpy.frombuffer(table.tobytes(), dtype=numpy.uint8))
+            self.opcodes = numpy.frombuffer(self.rom, dtype=">u2", count=word_count).astype(numpy.uint16)
+            self.indexes = _NUMPY_TABLE[0][self.opcodes]
+        else:
+            self.opcodes = array("H", self.rom[:word_count * 2])
+            if sys.byteorder == "little":
+                self.opcodes.byteswap()
+            self.indexes = bytes(map(table.__getitem__, self.opcodes))
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+    def __getitem__(self, index: int) -> DisassembledInstruction:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Instruction index out of range")
+
+        encoding_index: int = int(self.indexes[index])
+        return DisassembledInstruction(
+            self.start + 2 * index,
+            int(self.opcodes[index]),
+            None if encoding_index == _INVALID else self.encodings[encoding_index]
+        )
+
+    def __iter__(self) -> Iterator[DisassembledInstruction]:
+        return (self[index] for index in range(len(self)))
+
+    @property
+    def trailing_byte(self) -> int | None:
+        """
+        The last byte of a program of odd length, which is no word
+        """
+        return self.rom[-1] if len(self.rom) % 2 else None
+
+    def histogram(self) -> dict[str, int]:
+        """
+        How many words encode every command ('data' for the others)
+        :return: dict[str, int]
+        """
+        numpy = _numpy()
+        if numpy is not None and len(self) > 0:
+            counts = numpy.bincount(self.indexes, minlength=_INVALID + 1)
+            pairs = ((int(index), int(counts[index])) for index in numpy.flatnonzero(counts))
+        else:
+            pairs = ((index, self.indexes.count(index)) for index in set(self.indexes))
+
+        histogram: dict[str, int] = {}
+        for index, count in pairs:
+            command: str = "data" if index == _INVALID else self.encodings[index].command
+            histogram[command] = histogram.get(command, 0) + count
+        return histogram
+
+    def labels(self) -> dict[int, str]:
+        """
+        The labels of the addresses within the program that are jumped to, called or loaded into I
+        :return: dict[int, str]
+        """
+        end: int = self.start + len(self.rom)
+        calls: set[int] = set()
+        targets: set[int] = set()
+
+        for index, encoding in enumerate(self.encodings):
+            key: tuple = _shape_key(encoding)
+            if key not in _ADDRESS_SHAPES:
+                continue
+            found: set[int] = {
+                int(self.opcodes[word]) & 0xFFF
+                for word in self.__words_of(index)
+            }
+            (calls if key == _CALL_SHAPE else targets).update(found)
+
+        return {
+            address: f"{SUBROUTINE_LABEL_PREFIX if address in calls else LOCATION_LABEL_PREFIX}{address:X}"
+            for address in sorted(calls | targets)
+            if self.start <= address < end
+        }
+
+    def __words_of(self, encoding_index: int):
+        # The indexes of the words encoding the instruction
+        numpy = _numpy()
+        if numpy is not None:
+            return numpy.flatnonzero(self.indexes == encoding_index)
+        return (word for word, index in enumerate(self.indexes) if index == encoding_index)
+
+    def listing(self) -> str:
+        """
+        The program as address, opcode and instruction columns
+        :return: str
+        """
+        labels: dict[int, str] = self.labels()
+        lines: list[str] = []
+        for instruction in self:
+            if instruction.address in labels:
+                lines.append(f"{labels[instruction.address]}:")
+            lines.append(f"{instruction.address:03X}  {instruction.opcode:04X}  {instruction.text(labels)}")
+        if self.trailing_byte is not None:
+            address: int = self.start + len(self.rom) - 1
+            lines.append(f"{address:03X}  {self.trailing_byte:02X}    $0x{self.trailing_byte:02X}")
+        return "\n".join(lines) + "\n"
+
+    def to_source(self) -> str:
+        """
+        The program as a .mini8 source, assembling into the same bytes
+        :return: str
+        """
+        labels: dict[int, str] = self.labels()
+        lines: list[str] = ["segment code:"]
+
+        def data(address: int, value: int) -> None:
+            if address in labels:
+                lines.append(f"    label {labels[address]}:")
+            lines.append(f"    $0x{value:02X}")
+
+        for instruction in self:
+            address: int = instruction.address
+            if instruction.encoding is None or address + 1 in labels:
+                # Not an instruction, or a label points into its middle
+                data(address, instruction.opcode >> 8)
+                data(address + 1, instruction.opcode & 0xFF)
+                continue
+
+            if address in labels:
+                lines.append(f"    label {labels[address]}:")
+            lines.append(f"    {instruction.text(labels)}")
+
+        if self.trailing_byte is not None:
+            data(self.start + len(self.rom) - 1, self.trailing_byte)
+
+        lines += ["segment_end", "", "segment data:", "segment_end"]
+        return "\n".join(lines) + "\n"
+
+
+def disassemble(rom: bytes, start: int = PROGRAM_START) -> Disassembly:
+    """
+    Decodes the program, see Disassembly
+    :param rom: bytes
+    :param start: int, the address the program is loaded at
+    :return: Disassembly
+    """
+    return Disassembly(rom, start)
+
+
+def disassemble_file(file_path: str, start: int = PROGRAM_START) -> Disassembly:
+    """
+    Decodes the program file, see Disassembly
+    :param file_path: str
+    :param start: int
+    :return: Disassembly
+    """
+    with open(file_path, "rb") as f:
+        return Disassembly(f.read(), start)
@@ -1,3 +1,4 @@
+from dataclasses import dataclass, field
 from typing import TYPE_CHECKING, Union
 if TYPE_CHECKING:
     from .Types import (
@@ -7,23 +8,77 @@ if TYPE_CHECKING:
         Instruction,
         Literal
     )
+    from .Program import Program
 
-# Global variables to be used by the parsing tools
-__VARIABLES__: dict[str, 'Variable'] = {}
-__LABELS__: dict[str, 'Label'] = {}
-__RAW_OPCODES__: list['Bytecode'] = []
+# The address at which chip8 programs are loaded
+PROGRAM_START: int = 0x200
 
 
-def variables_instance() -> dict[str, 'Variable']:
-    global __VARIABLES__
-    return __VARIABLES__
+@dataclass
+class AssemblyContext:
+    """
+    The state of a single assembly: the symbol tables, the raw opcodes and the address counter.
 
+    Every assembly owns its own context, so multiple programs can be assembled at the same time (e.g. from different
+    threads) without interfering with each other.
 
-def labels_instance() -> dict[str, 'Label']:
-    global __LABELS__
-    return __LABELS__
+    The parsed items are kept either as objects in raw_opcodes or, when program is set, lowered into the compact
+    Program representation.
+    """
+    variables: dict[str, 'Variable'] = field(default_factory=dict)
+    labels: dict[str, 'Label'] = field(default_factory=dict)
+    raw_opcodes: list['Bytecode'] = field(default_factory=list)
+    current_addr: int = PROGRAM_START
+    program: Union['Program', None] = None
 
+    def reset(self) -> None:
+        """
+        Resets the context, so it can be reused for another assembly
+        :return:
+        """
+        self.variables.clear()
+        self.labels.clear()
+        self.raw_opcodes.clear()
+        self.current_addr = PROGRAM_START
+        if self.program is not None:
+            self.program = type(self.program)(PROGRAM_START)
 
-def raw_opcodes_instance() -> list['Bytecode']:
-    global __RAW_OPCODES__
-    return __RAW_OPCODES__
+    def symbol_table(self) -> dict:
+        """
+        Returns the resolved labels and variables, as plain data
+        :return: dict
+        """
+        return {
+            "labels": {
+                name: label.address
+                for name, label in self.labels.items()
+            },
+            "variables": {
+                name: {
+                    "address": variable.address,
+                    "value": None if variable.value is None else variable.value.value
+                }
+                for name, variable in self.variables.items()
+            }
+        }
+
+
+# Context used when the parsing tools are called without one
+__DEFAULT_CONTEXT__: AssemblyContext = AssemblyContext()
+
+
+def default_context() -> AssemblyContext:
+    global __DEFAULT_CONTEXT__
+    return __DEFAULT_CONTEXT__
+
+
+def variables_instance(context: AssemblyContext | None = None) -> dict[str, 'Variable']:
+    return (context if context is not None else default_context()).variables
+
+
+def labels_instance(context: AssemblyContext | None = None) -> dict[str, 'Label']:
+    return (context if context is not None else default_context()).labels
+
+
+def raw_opcodes_instance(context: AssemblyContext | None = None) -> list['Bytecode']:
+    return (context if context is not None else default_context()).raw_opcodes
@@ -0,0 +1,523 @@
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+from .Tokens import Tokens
+from .Types import Label, Variable
+from .Globals import AssemblyContext, PROGRAM_START
+from .Interfaces import AssemblyError, InvalidCodeError, PreprocessorError
+from .Lexer import parse_item
+from .Parser import SEGMENTS, SEGMENT_HEADERS, strip_comments, segment_lines, open_source
+from .Preprocessor import Preprocessor, include_name, is_directive
+from .Program import Program, ADDRESS_SYMBOL_PREFIX, field_value
+from ._ChipInstructions import INSTRUCTION_NAMES
+
+# Incremental reassembly.
+#
+# An IncrementalAssembler keeps, for every line of the source, the items it
+# was assembled into: their bytecode with the symbol fields left empty (as in
+# a relocatable Program), the symbols filling those fields in, and the label
+# or variable the line defines. The bytecode of every segment is kept as a
+# bytearray, patched in place.
+#
+# A new version of the source is diffed against the previous one (common
+# prefix and suffix), and only the lines in between are parsed again. Their
+# bytes are spliced into the segment, the items after them shifted, and only
+# the instructions referencing a symbol that moved or changed (or an __ADDR__
+# that moved) are patched again. The result is byte for byte the one of a
+# full assembly.
+#
+# Edits touching the structure of the source (segment markers, includes,
+# macro definitions and invocations), and changes to the included files, fall
+# back to a full assembly.
+
+LABEL_SYMBOL: str = "label"
+VARIABLE_SYMBOL: str = "variable"
+
+# The first words of the lines that are parsed on their own: anything else may be a macro invocation
+_PLAIN_KEYWORDS: frozenset[str] = INSTRUCTION_NAMES | frozenset([Tokens.LABEL_TOKEN, Tokens.VARIABLE_TOKEN])
+
+
+@dataclass(slots=True, eq=False)
+class _Item:
+    """
+    An item of the program:
+        segment: the segment it is in
+        code: its bytecode, with the symbol fields empty
+        references: the (offset in code, symbol, field) of the symbol fields. The symbol is a (kind, name) pair, or
+                    None for the address of the item itself (__ADDR__)
+        definition: the (kind, name) of the label or variable it defines
+        value: the value of the variable it defines
+        offset: its offset in the segment
+    """
+    segment: str
+    code: bytes
+    references: tuple[tuple[int, tuple[str, str] | None, int], ...] = ()
+    definition: tuple[str, str] | None = None
+    value: int | None = None
+    offset: int = 0
+
+
+@dataclass(slots=True, eq=False)
+class _Line:
+    """
+    The state of a line of the source. segment and macro are the state after it: the segment it leaves open (None
+    outside of the assembled segments), and whether it leaves a macro definition open. A line is plain when it was
+    assembled on its own, without the preprocessor changing it
+    """
+    segment: str | None
+    macro: bool
+    plain: bool
+    items: list[_Item]
+
+
+@dataclass
+class IncrementalResult:
+    """
+    The outcome of an update:
+        bytecode: the program, the same as a full assembly of the source
+        reparsed_lines: the number of lines parsed again
+        total_lines: the number of lines of the source
+        reencoded_instructions: the number of instructions whose symbol fields were patched again
+        full_build: whether the whole source had to be assembled again
+    """
+    bytecode: bytes
+    reparsed_lines: int
+    total_lines: int
+    reencoded_instructions: int
+    full_build: bool
+
+    def __str__(self) -> str:
+        return (f"{'full build' if self.full_build else 'incremental build'}: reparsed {self.reparsed_lines} of "
+                f"{self.total_lines} lines, re-encoded {self.reencoded_instructions} instructions")
+
+
+def _common_length(old: list[str], new: list[str], low: int, high: int, direction: int) -> int:
+    """
+    The length of the common prefix (direction 1) or suffix (direction -1) of the lists, at most high. Found by
+    comparing slices, which only compares the lines that are not the same objects
+    :param old: list[str]
+    :param new: list[str]
+    :param low: int
+    :param high: int
+    :param direction: int
+    :return: int
+    """
+    while low < high:
+        middle: int = (low + high + 1) // 2
+        if direction == 1:
+            same: bool = old[low:middle] == new[low:middle]
+        else:
+            same = old[len(old) - middle:len(old) - low] == new[len(new) - middle:len(new) - low]
+
+        if same:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _symbol_error(key: tuple[str, str], reason: str, error_type: type) -> AssemblyError:
+    return error_type(f"{key[0].capitalize()} '{key[1]}' {reason}")
+
+
+class IncrementalAssembler:
+    """
+    Assembles successive versions of a source, reusing the previous assembly (see above). Every version is given whole
+    (update) or as an edit of a range of lines (edit). A version with invalid code raises an AssemblyError and leaves
+    the assembler at the last valid one
+    """
+
+    def __init__(self, source_path: str | None = None, preprocessor: Preprocessor | None = None):
+        """
+        :param source_path: str | None, the path of the source, for finding its includes and for update_file
+        :param preprocessor: Preprocessor | None, see assemble
+        """
+        self.source_path: str | None = source_path
+        self.preprocessor: Preprocessor = preprocessor if preprocessor is not None else Preprocessor()
+
+        self.__texts: list[str] = []
+        self.__lines: list[_Line] | None = None
+        self.__segments: dict[str, bytearray] = {segment: bytearray() for segment in SEGMENTS}
+        # The item defining every symbol, and the items referencing it
+        self.__definitions: dict[tuple[str, str], _Item] = {}
+        self.__references: dict[tuple[str, str], set[_Item]] = {}
+        # The items referencing their own address
+        self.__address_items: set[_Item] = set()
+        # The (path, digest) of the included files
+        self.__includes: list[tuple[str, str]] = []
+
+        # Every line is parsed in a context of its own, so each of its symbols is left to a fixup
+        self.__context: AssemblyContext = AssemblyContext()
+        self.__program: Program = Program(PROGRAM_START, relocatable=True)
+
+    @property
+    def bytecode(self) -> bytes:
+        return bytes(self.__segments[SEGMENTS[0]] + self.__segments[SEGMENTS[1]])
+
+    @property
+    def lines(self) -> list[str]:
+        return list(self.__texts)
+
+    def update(self, lines: Iterable[str]) -> IncrementalResult:
+        """
+        Assembles a new version of the source, parsing again only the lines that differ from the previous version
+        :param lines: Iterable[str]
+        :return: IncrementalResult
+        """
+        texts: list[str] = list(lines)
+        if self.__lines is None or self.__includes_changed():
+            return self.__build(texts)
+
+        old_texts: list[str] = self.__texts
+        limit: int = min(len(old_texts), len(texts))
+
+        prefix: int = _common_length(old_texts, texts, 0, limit, 1)
+        suffix: int = _common_length(old_texts, texts, 0, limit - prefix, -1)
+
+        return self.__edit(prefix, len(old_texts) - suffix, texts[prefix:len(texts) - suffix])
+
+    def edit(self, start: int, stop: int, lines: Iterable[str]) -> IncrementalResult:
+        """
+        Replaces the lines from start to stop (0-based, stop excluded) of the source. An empty range inserts the lines,
+        no lines delete the range
+        :param start: int
+        :param stop: int
+        :param lines: Iterable[str]
+        :return: IncrementalResult
+        """
+        texts: list[str] = list(lines)
+        if self.__lines is None:
+            if start != 0 or stop != 0:
+                raise ValueError("Nothing to edit yet, the first version must be given whole")
+            return self.__build(texts)
+
+        if not 0 <= start <= stop <= len(self.__lines):
+            raise ValueError(f"Invalid line range {start}:{stop}, the source has {len(self.__lines)} lines")
+
+        if self.__includes_changed():
+            return self.__build(self.__texts[:start] + texts + self.__texts[stop:])
+        return self.__edit(start, stop, texts)
+
+    def update_file(self, use_mmap: bool = False) -> IncrementalResult:
+        """
+        Assembles the current version of the source file
+        :param use_mmap: see open_source
+        :return: IncrementalResult
+        """
+        if self.source_path is None:
+            raise ValueError("The assembler has no source file")
+
+        with open_source(self.source_path, use_mmap) as lines:
+            return self.update(lines)
+
+    # Parsing
+
+    def __parse(self, code: str, line_number: int, segment: str) -> _Item:
+        context: AssemblyContext = self.__context
+        context.labels.clear()
+        context.variables.clear()
+
+        parsed = parse_item(code, context, line_number)
+        parsed_class: type = parsed.__class__
+
+        if parsed_class is Label:
+            return _Item(segment, b"", definition=(LABEL_SYMBOL, parsed.name))
+        if parsed_class is Variable:
+            return _Item(segment, b"", definition=(VARIABLE_SYMBOL, parsed.name), value=parsed.value.value)
+
+        program: Program = self.__program
+        program.append(parsed)
+
+        references: list[tuple[int, tuple[str, str] | None, int]] = []
+        fixups = zip(program.fixup_offsets, program.fixup_symbols, program.fixup_fields)
+        for offset, symbol_index, fixup_field in fixups:
+            symbol: Label | Variable = program.symbols[symbol_index]
+            if symbol.__class__ is Variable:
+                key: tuple[str, str] | None = (VARIABLE_SYMBOL, symbol.name)
+            else:
+                key = None if symbol.name.startswith(ADDRESS_SYMBOL_PREFIX) else (LABEL_SYMBOL, symbol.name)
+            references.append((offset, key, fixup_field))
+
+        item: _Item = _Item(segment, bytes(program.code), tuple(references))
+        del program.code[:], program.fixup_offsets[:], program.fixup_symbols[:], program.fixup_fields[:]
+        return item
+
+    # Full assembly
+
+    def __build(self, texts: list[str]) -> IncrementalResult:
+        stripped: dict[int, str] = dict(strip_comments(texts))
+
+        # What the preprocessor made of every line: how many lines it expanded into, and the first of them
+        counts: list[int] = [0] * (len(texts) + 1)
+        expanded: list[str | None] = [None] * (len(texts) + 1)
+        segments_after: list[str | None] = [None] * (len(texts) + 1)
+        entries: list[tuple[int, str | None]] = []
+
+        def tagged(lines: Iterable[tuple[int, str]]) -> Iterator[tuple[int, str]]:
+            # Tags the preprocessed lines with their segment, the one segment_lines puts them in
+            segment: str | None = None
+            seen: set[str] = set()
+
+            for line_number, line in lines:
+                if segment is None:
+                    header: str | None = SEGMENT_HEADERS.get(line, None)
+                    if header is not None and header not in seen:
+                        seen.add(header)
+                        segment = header
+                elif line == Tokens.SEGMENT_END_TOKEN:
+                    segment = None
+
+                counts[line_number] += 1
+                if expanded[line_number] is None:
+                    expanded[line_number] = line
+                segments_after[line_number] = segment
+
+                entries.append((line_number, segment))
+                yield len(entries) - 1, line
+
+        lines: list[_Line] = [_Line(None, False, True, []) for _ in texts]
+
+        for index, line in segment_lines(tagged(self.preprocessor.process(stripped.items(), self.source_path))):
+            line_number, segment = entries[index]
+            lines[line_number - 1].items.append(self.__parse(line, line_number, segment))
+
+        definitions: dict[tuple[str, str], _Item] = {}
+        references: dict[tuple[str, str], set[_Item]] = {}
+        address_items: set[_Item] = set()
+        segments: dict[str, bytearray] = {segment: bytearray() for segment in SEGMENTS}
+        has_includes: bool = False
+
+        segment: str | None = None
+        in_macro: bool = False
+
+        for line_number, line in enumerate(lines, start=1):
+            code: str = stripped.get(line_number, "")
+
+            if counts[line_number]:
+                segment = segments_after[line_number]
+
+            if is_directive(code, Tokens.MACRO_TOKEN):
+                in_macro = True
+            line.plain = not in_macro and (code == "" or (
+                counts[line_number] == 1 and expanded[line_number] == code and
+                code not in SEGMENT_HEADERS and code != Tokens.SEGMENT_END_TOKEN
+            ))
+            if in_macro and code == Tokens.MACRO_END_TOKEN:
+                in_macro = False
+            has_includes = has_includes or is_directive(code, Tokens.INCLUDE_TOKEN)
+
+            line.segment = segment
+            line.macro = in_macro
+
+            for item in line.items:
+                buffer: bytearray = segments[item.segment]
+                item.offset = len(buffer)
+                buffer += item.code
+
+                if item.definition is not None:
+                    if item.definition in definitions:
+                        raise _symbol_error(item.definition, "was already defined", AssemblyError)
+                    definitions[item.definition] = item
+
+                for _, key, _ in item.references:
+                    if key is None:
+                        address_items.add(item)
+                    else:
+                        references.setdefault(key, set()).add(item)
+
+        for kind in [VARIABLE_SYMBOL, LABEL_SYMBOL]:
+            for key in references:
+                if key[0] == kind and key not in definitions:
+                    raise _symbol_error(key, "is never defined", InvalidCodeError)
+
+        includes: list[tuple[str, str]] = self.__include_digests(stripped.values()) if has_includes else []
+
+        self.__texts = texts
+        self.__lines = lines
+        self.__segments = segments
+        self.__definitions = definitions
+        self.__references = references
+        self.__address_items = address_items
+        self.__includes = includes
+
+        reencoded: int = 0
+        for line in lines:
+            for item in line.items:
+                if item.references:
+                    self.__encode(item)
+                    reencoded += 1
+
+        return IncrementalResult(self.bytecode, len(texts), len(texts), reencoded, True)
+
+    def __include_digests(self, codes: Iterable[str]) -> list[tuple[str, str]]:
+        digests: dict[str, str] = {}
+
+        for code in codes:
+            name: str | None = include_name(code)
+            if name is None:
+                continue
+
+            path: str = self.preprocessor.resolve(name, self.source_path)
+            digests[path] = self.preprocessor.cache.load(path).digest
+            digests.update(self.preprocessor.dependencies(path))
+
+        return sorted(digests.items())
+
+    def __includes_changed(self) -> bool:
+        for path, digest in self.__includes:
+            try:
+                if self.preprocessor.cache.load(path).digest != digest:
+                    return True
+            except (OSError, PreprocessorError):
+                return True
+        return False
+
+    # Incremental assembly
+
+    def __edit(self, start: int, stop: int, texts: list[str]) -> IncrementalResult:
+        lines: list[_Line] = self.__lines
+        removed: list[_Line] = lines[start:stop]
+        before: _Line | None = lines[start - 1] if start > 0 else None
+
+        if before is not None and before.macro or any(not line.plain for line in removed):
+            return self.__build(self.__texts[:start] + texts + self.__texts[stop:])
+
+        codes: list[str] = [next(strip_comments((text,)), (0, ""))[1] for text in texts]
+        for code in codes:
+            if code != "" and code[0] != Tokens.LITERAL_TOKEN and code.split(None, 1)[0] not in _PLAIN_KEYWORDS:
+                return self.__build(self.__texts[:start] + texts + self.__texts[stop:])
+
+        segment: str | None = before.segment if before is not None else None
+        added: list[_Line] = [
+            _Line(segment, False, True, [] if code == "" or segment is None else [
+                self.__parse(code, start + index + 1, segment)
+            ])
+            for index, (text, code) in enumerate(zip(texts, codes))
+        ]
+
+        removed_items: set[_Item] = {item for line in removed for item in line.items}
+        added_items: list[_Item] = [item for line in added for item in line.items]
+        self.__check_symbols(removed_items, added_items)
+
+        changed: set[tuple[str, str]] = set()
+        to_encode: set[_Item] = set()
+
+        # The symbol tables
+        for item in removed_items:
+            if item.definition is not None:
+                del self.__definitions[item.definition]
+                changed.add(item.definition)
+            for _, key, _ in item.references:
+                if key is None:
+                    self.__address_items.discard(item)
+                else:
+                    self.__references[key].discard(item)
+
+        for item in added_items:
+            if item.definition is not None:
+                self.__definitions[item.definition] = item
+                changed.add(item.definition)
+            for _, key, _ in item.references:
+                if key is None:
+                    self.__address_items.add(item)
+                else:
+                    self.__references.setdefault(key, set()).add(item)
+            if item.references:
+                to_encode.add(item)
+
+        # The bytecode, and the offsets of the items after the edit
+        if segment is not None:
+            buffer: bytearray = self.__segments[segment]
+            position: int = self.__position(start, segment)
+            old_size: int = sum(len(item.code) for item in removed_items)
+
+            offset: int = position
+            for item in added_items:
+                item.offset = offset
+                offset += len(item.code)
+            buffer[position:position + old_size] = b"".join(item.code for item in added_items)
+
+            delta: int = offset - position - old_size
+            if delta:
+                for line in lines[stop:]:
+                    for item in line.items:
+                        if item.segment != segment:
+                            continue
+                        item.offset += delta
+                        if item.definition is not None and item.definition[0] == LABEL_SYMBOL:
+                            changed.add(item.definition)
+                        if item in self.__address_items:
+                            to_encode.add(item)
+
+                if segment == SEGMENTS[0]:
+                    # The data segment follows the code, all of it moved
+                    for key, item in self.__definitions.items():
+                        if item.segment != segment and key[0] == LABEL_SYMBOL:
+                            changed.add(key)
+                    to_encode.update(item for item in self.__address_items if item.segment != segment)
+
+        lines[start:stop] = added
+        self.__texts[start:stop] = texts
+
+        for key in changed:
+            to_encode.update(self.__references.get(key, ()))
+        for item in to_encode:
+            self.__encode(item)
+
+        return IncrementalResult(self.bytecode, len(texts), len(lines), len(to_encode), False)
+
+    def __check_symbols(self, removed_items: set[_Item], added_items: list[_Item]) -> None:
+        # Checked before anything changes, so an invalid version leaves the assembler as it was
+        removed_definitions: set[tuple[str, str]] = {
+            item.definition for item in removed_items if item.definition is not None
+        }
+        added_definitions: set[tuple[str, str]] = set()
+
+        for item in added_items:
+            if item.definition is None:
+                continue
+            if item.definition in added_definitions or (
+                    item.definition in self.__definitions and item.definition not in removed_definitions):
+                raise _symbol_error(item.definition, "was already defined", AssemblyError)
+            added_definitions.add(item.definition)
+
+        for item in added_items:
+            for _, key, _ in item.references:
+                if key is not None and key not in added_definitions and (
+                        key not in self.__definitions or key in removed_definitions):
+                    raise _symbol_error(key, "is never defined", InvalidCodeError)
+
+        for key in removed_definitions - added_definitions:
+            if any(item not in removed_items for item in self.__references.get(key, ())):
+                raise _symbol_error(key, "is never defined", InvalidCodeError)
+
+    def __position(self, start: int, segment: str) -> int:
+        # The offset in the segment right after the items of the lines before start
+        lines: list[_Line] = self.__lines
+        for index in range(start - 1, -1, -1):
+            for item in reversed(lines[index].items):
+                if item.segment == segment:
+                    return item.offset + len(item.code)
+        return 0
+
+    def __address(self, item: _Item) -> int:
+        if item.segment == SEGMENTS[0]:
+            return PROGRAM_START + item.offset
+        return PROGRAM_START + len(self.__segments[SEGMENTS[0]]) + item.offset
+
+    def __encode(self, item: _Item) -> None:
+        # Fills the symbol fields of the item into its segment
+        code: bytearray = bytearray(item.code)
+
+        for offset, key, fixup_field in item.references:
+            if key is None:
+                value: int = self.__address(item)
+            else:
+                definition: _Item = self.__definitions[key]
+                value = definition.value if key[0] == VARIABLE_SYMBOL else self.__address(definition)
+
+            value = field_value(value, fixup_field)
+            code[offset] |= value >> 8
+            code[offset + 1] |= value & 0xFF
+
+        self.__segments[item.segment][item.offset:item.offset + len(code)] = code
@@ -4,10 +4,66 @@ from abc import ABC, abstractmethod
 from dataclasses import dataclass
 
 
+class AssemblyError(Exception):
+    """
+    Raised when the code cannot be assembled (invalid syntax, conflicting definitions, ...). When known, the line (in
+    the source) and the column (1-based, within the code of the line) of the error are given, and the reason is the
+    message without them
+    """
+
+    def __init__(self, *args, line: int | None = None, column: int | None = None, reason: str | None = None):
+        super().__init__(*args)
+        self.line: int | None = line
+        self.column: int | None = column
+        self.reason: str = reason if reason is not None else str(args[0]) if args else ""
+
+
+class InvalidCodeError(AssemblyError):
+    """
+    Raised when the code is syntactically valid, but incomplete (missing segments, undefined labels or variables)
+    """
+
+
+class DuplicateDefinitionError(AssemblyError):
+    """
+    Raised when a label or a variable is defined twice. The symbol is its name
+    """
+
+    def __init__(self, *args, symbol: str | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.symbol: str | None = symbol
+
+
+class PreprocessorError(AssemblyError):
+    """
+    Raised when the includes or the macros cannot be expanded (missing files, include cycles, recursive macros, ...)
+    """
+
+
+class LinkError(AssemblyError):
+    """
+    Raised when object files cannot be linked (undefined or duplicate symbols, invalid object files, ...)
+    """
+
+
+class OptimizationError(AssemblyError):
+    """
+    Raised when an optimized program fails its verification against the original one
+    """
+
+
+class MachineError(Exception):
+    """
+    Raised when a program cannot run on the interpreter (invalid opcodes, stack overflows, ...)
+    """
+
+
 class Bytecode(ABC):
     """
     Base absract class for byte-convertible classes
     """
+    __slots__ = ()
+
     @abstractmethod
     def to_bytes(self):
         pass
@@ -39,3 +95,27 @@ class InstructionsLUTEntry:
             operand3
         ).to_bytes(2, "big", signed=False)
 
+
+@dataclass(frozen=True)
+class InstructionEncoding:
+    """
+    A flattened InstructionsLUTEntry: the command code and the bit fields the operands are placed into.
+
+    Each field is an (operand index, shift, mask) triple, so encoding is just ORing the masked and shifted operand
+    values into the command code.
+    """
+    command: str
+    shape: tuple[str | None, str | None, str | None]
+    command_code: int
+    fields: tuple[tuple[int, int, int], ...]
+
+    def encode(self, operands: tuple[Any, Any, Any]) -> int:
+        """
+        Encodes the operands (anything with an operand_value() method) into the instruction code
+        :param operands: tuple
+        :return: int
+        """
+        instruction_code: int = self.command_code
+        for index, shift, mask in self.fields:
+            instruction_code |= (operands[index].operand_value() & mask) << shift
+        return instruction_code
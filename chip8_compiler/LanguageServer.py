@@ -0,0 +1,1097 @@
+import json
+import os
+import sys
+from dataclasses import dataclass, field
+from enum import StrEnum
+from typing import IO, Iterable, Iterator
+from urllib.parse import quote, unquote, urlparse
+
+from .Tokens import Tokens
+from .Globals import AssemblyContext, PROGRAM_START
+from .Interfaces import AssemblyError, InvalidCodeError, PreprocessorError
+from .Lexer import TokenKind, Token, parse_item, tokenize
+from .Parser import SEGMENTS, SEGMENT_HEADERS, iter_segments, strip_comments
+from .Preprocessor import Expansion, Macro, Preprocessor, include_name, is_directive, macro_signature
+from ._ChipInstructions import INSTRUCTION_NAMES
+
+# Language server (LSP, over stdio) for the editors, see chip8-language-extension.
+#
+# Every line of an open document is analyzed once into a LineInfo: its kind,
+# the bytes it emits, the symbol it defines, the symbols it references and its
+# syntax error, if any. An edit only analyzes the lines it touched again, and
+# updates the symbol index (the definitions and references of every name) for
+# those lines only.
+#
+# The layout of the document (the segment and address of every line, the
+# macros, the included files) is the one of the assembler: the lines go
+# through the Preprocessor and iter_segments (see Parser.py), and the lines
+# expanded from an include or a macro are analyzed like the others (once per
+# content). A line the preprocessor rejects is reported and left out, and the
+# expansion runs again, so a single error does not hide the rest of the
+# layout. The layout only runs when an edit changes the structure of the
+# document: lines added or removed, or a line emitting a different number of
+# bytes. Typing within an instruction does not move anything, so it does not
+# run.
+#
+# Diagnostics are published after every change, the addresses are shown on
+# hover, in the document symbols and as inlay hints on the labels.
+#
+# The columns are indexes in the Python strings (code points). The client
+# gets them in the position encoding negotiated on initialize: UTF-32 (the
+# same) if it offers it, UTF-16 (the default of the protocol) otherwise.
+
+HEADER_ENCODING: str = "ascii"
+UTF16: str = "utf-16"
+UTF32: str = "utf-32"
+
+# LSP constants
+_SEVERITY_ERROR: int = 1
+_SEVERITY_WARNING: int = 2
+_SYMBOL_KIND_FUNCTION: int = 12
+_SYMBOL_KIND_CONSTANT: int = 14
+_SYMBOL_KIND_OPERATOR: int = 25
+_COMPLETION_KIND_FUNCTION: int = 3
+_COMPLETION_KIND_VARIABLE: int = 6
+_COMPLETION_KIND_KEYWORD: int = 14
+_COMPLETION_KIND_CONSTANT: int = 21
+_TEXT_DOCUMENT_SYNC_INCREMENTAL: int = 2
+_METHOD_NOT_FOUND: int = -32601
+_INTERNAL_ERROR: int = -32603
+
+# How many lines the preprocessor may reject before the layout gives up
+_MAX_REJECTED_LINES: int = 16
+
+_KEYWORDS: tuple[str, ...] = (
+    Tokens.LABEL_TOKEN,
+    Tokens.VARIABLE_TOKEN,
+    Tokens.SEGMENT_BEGIN_TOKEN,
+    Tokens.SEGMENT_END_TOKEN,
+    Tokens.INCLUDE_TOKEN,
+    Tokens.MACRO_TOKEN,
+    Tokens.MACRO_END_TOKEN
+)
+
+
+class LineKind(StrEnum):
+    BLANK = "blank"
+    SEGMENT = "segment"
+    SEGMENT_END = "segment end"
+    INCLUDE = "include"
+    MACRO = "macro"
+    MACRO_END = "macro end"
+    MACRO_CALL = "macro call"
+    INSTRUCTION = "instruction"
+    LABEL = "label"
+    VARIABLE = "variable"
+    DATA = "data"
+
+
+# The lines shaping the layout by more than the bytes they emit
+_STRUCTURAL_KINDS: frozenset[LineKind] = frozenset([
+    LineKind.SEGMENT,
+    LineKind.SEGMENT_END,
+    LineKind.INCLUDE,
+    LineKind.MACRO,
+    LineKind.MACRO_END,
+    LineKind.MACRO_CALL
+])
+
+
+@dataclass(slots=True, eq=False)
+class LineInfo:
+    """
+    The analysis of a single line:
+        kind: LineKind
+        size: the bytes the line emits
+        name: the defined label or variable, the segment, the included file, or the (invoked) macro
+        name_start, name_end: the columns of the name
+        value: the value of a variable
+        parameters: the parameters of a macro definition, the arguments of a macro invocation
+        references: the (name, start column, end column) of every label or variable the line uses
+        error: the (message, start column, end column) of the syntax error of the line
+
+    The layout fields are set by the Document: the index of the line, its segment (None outside of the segments) and
+    its offset in the segment. In a macro body, macro holds the parameters of the macro
+    """
+    text: str
+    kind: LineKind
+    size: int = 0
+    name: str | None = None
+    name_start: int = 0
+    name_end: int = 0
+    value: int | None = None
+    parameters: tuple[str, ...] = ()
+    references: tuple[tuple[str, int, int], ...] = ()
+    error: tuple[str, int, int] | None = None
+
+    line: int = 0
+    segment: str | None = None
+    offset: int = 0
+    macro: tuple[str, ...] | None = None
+
+    def layout_key(self) -> tuple:
+        """
+        Two lines with the same key can replace each other without moving any other line
+        """
+        if self.kind in _STRUCTURAL_KINDS or self.kind is LineKind.BLANK:
+            return self.kind, self.size, self.name, self.parameters
+        return None, self.size
+
+
+def _references(tokens: list[Token], offset: int) -> tuple[tuple[str, int, int], ...]:
+    return tuple(
+        (token.text, offset + token.column - 1, offset + token.column - 1 + len(token.text))
+        for token in tokens
+        if token.kind is TokenKind.LABEL or token.kind is TokenKind.NAME
+    )
+
+
+def analyze_line(text: str, context: AssemblyContext | None = None) -> LineInfo:
+    """
+    Analyzes a single line of source, on its own. The columns are relative to the text of the line
+    :param text: str
+    :param context: AssemblyContext | None, a scratch context, reset before use
+    :return: LineInfo
+    """
+    comment_start: int = text.find(Tokens.COMMENT_TOKEN)
+    code: str = text if comment_start == -1 else text[:comment_start]
+    stripped_code: str = code.strip()
+
+    if stripped_code == "":
+        return LineInfo(text, LineKind.BLANK)
+
+    offset: int = len(code) - len(code.lstrip())
+    code_end: int = offset + len(stripped_code)
+
+    segment: str | None = SEGMENT_HEADERS.get(stripped_code, None)
+    if segment is not None:
+        return LineInfo(text, LineKind.SEGMENT, name=segment)
+    if stripped_code == Tokens.SEGMENT_END_TOKEN:
+        return LineInfo(text, LineKind.SEGMENT_END)
+
+    first_char: str = stripped_code[0]
+
+    if first_char == "i" and is_directive(stripped_code, Tokens.INCLUDE_TOKEN):
+        name: str | None = include_name(stripped_code)
+        if name is None:
+            return LineInfo(
+                text, LineKind.INCLUDE, error=("Invalid include, expected 'include \"file\"'", offset, code_end)
+            )
+        name_start: int = offset + stripped_code.index('"') + 1
+        return LineInfo(text, LineKind.INCLUDE, name=name, name_start=name_start, name_end=name_start + len(name))
+
+    if first_char == "m":
+        if stripped_code == Tokens.MACRO_END_TOKEN:
+            return LineInfo(text, LineKind.MACRO_END)
+
+        if is_directive(stripped_code, Tokens.MACRO_TOKEN):
+            signature: tuple[str, tuple[str, ...]] | None = macro_signature(stripped_code)
+            if signature is None:
+                return LineInfo(
+                    text, LineKind.MACRO,
+                    error=("Invalid macro definition, expected 'macro name a, b:'", offset, code_end)
+                )
+            name_start = offset + stripped_code.index(signature[0], len(Tokens.MACRO_TOKEN))
+            return LineInfo(
+                text, LineKind.MACRO, name=signature[0], name_start=name_start,
+                name_end=name_start + len(signature[0]), parameters=signature[1]
+            )
+
+    tokens: list[Token] = tokenize(stripped_code)
+    first_token: Token = tokens[0]
+    first_kind: TokenKind = first_token.kind
+
+    if first_kind is TokenKind.INSTRUCTION:
+        info: LineInfo = LineInfo(text, LineKind.INSTRUCTION, size=2, references=_references(tokens[1:], offset))
+    elif first_kind is TokenKind.LITERAL:
+        info = LineInfo(text, LineKind.DATA, size=1)
+    elif first_kind is TokenKind.LABEL_KEYWORD:
+        info = LineInfo(text, LineKind.LABEL)
+        if len(tokens) > 1:
+            name_token: Token = tokens[1]
+            info.name = name_token.text.removesuffix(Tokens.DECLARATION_END_TOKEN)
+            info.name_start = offset + name_token.column - 1
+            info.name_end = info.name_start + len(info.name)
+    elif first_kind is TokenKind.VARIABLE_KEYWORD:
+        info = LineInfo(text, LineKind.VARIABLE)
+        if len(tokens) > 1:
+            name_token = tokens[1]
+            info.name = name_token.text
+            info.name_start = offset + name_token.column - 1
+            info.name_end = info.name_start + len(info.name)
+    else:
+        # Anything else can only be the invocation of a macro, checked by the layout
+        return LineInfo(
+            text, LineKind.MACRO_CALL, name=first_token.text,
+            name_start=offset, name_end=offset + len(first_token.text),
+            parameters=tuple(token.text for token in tokens[1:]),
+            references=_references(tokens[1:], offset)
+        )
+
+    # The syntax is checked by the parser itself
+    if context is None:
+        context = AssemblyContext()
+    context.reset()
+
+    try:
+        item = parse_item(stripped_code, context)
+    except (AssemblyError, ValueError) as e:
+        message: str = e.reason if isinstance(e, AssemblyError) else str(e)
+        column: int = (e.column if isinstance(e, AssemblyError) else None) or 1
+
+        end: int = next(
+            (offset + token.column - 1 + len(token.text) for token in tokens if token.column == column), code_end
+        )
+        info.error = (message, offset + column - 1, end)
+        return info
+
+    if info.kind is LineKind.VARIABLE:
+        info.value = item.value.value
+
+    return info
+
+
+@dataclass(slots=True)
+class Symbol:
+    """
+    A defined label or variable. The address of a label is given by its segment and offset, see Document.address
+    """
+    name: str
+    uri: str
+    line: int
+    start: int
+    end: int
+    segment: str | None = None
+    offset: int = 0
+    value: int | None = None
+
+    @property
+    def is_label(self) -> bool:
+        return self.name.startswith(Tokens.LABEL_NAME_TOKEN)
+
+
+def path_to_uri(path: str) -> str:
+    return "file://" + quote(os.path.abspath(path).replace(os.sep, "/"))
+
+
+def uri_to_path(uri: str) -> str | None:
+    parsed = urlparse(uri)
+    if parsed.scheme != "file":
+        return None
+    return unquote(parsed.path)
+
+
+def _range(line: int, start: int, end: int) -> dict:
+    return {"start": {"line": line, "character": start}, "end": {"line": line, "character": end}}
+
+
+def _diagnostic(line: int, start: int, end: int, message: str, severity: int = _SEVERITY_ERROR) -> dict:
+    return {"range": _range(line, start, end), "severity": severity, "source": "mini8", "message": message}
+
+
+class Document:
+    """
+    An open document: the analysis of its lines, its symbol index and its layout
+    """
+
+    def __init__(
+            self,
+            uri: str,
+            text: str,
+            version: int = 0,
+            preprocessor: Preprocessor | None = None,
+            expanded: dict[str, LineInfo] | None = None,
+            position_encoding: str = UTF16
+    ):
+        """
+        :param uri: str
+        :param text: str
+        :param version: int
+        :param preprocessor: Preprocessor | None, finds and loads the included files
+        :param expanded: dict[str, LineInfo] | None, the analysis of the lines expanded from the includes and the
+                         macros by code, shared by the documents
+        :param position_encoding: str, UTF16 or UTF32, how the client counts the characters of a line
+        """
+        self.uri: str = uri
+        self.path: str | None = uri_to_path(uri)
+        self.source_path: str | None = os.path.abspath(self.path) if self.path is not None else None
+        self.version: int = version
+        self.preprocessor: Preprocessor = preprocessor if preprocessor is not None else Preprocessor()
+        self.expanded: dict[str, LineInfo] = expanded if expanded is not None else {}
+        self.position_encoding: str = position_encoding
+
+        self.lines: list[LineInfo] = []
+        # The symbol index, of the lines of the document
+        self.definitions: dict[str, list[LineInfo]] = {}
+        self.references: dict[str, list[LineInfo]] = {}
+        self.errors: dict[LineInfo, None] = {}
+
+        # Set by the layout
+        self.code_size: int = 0
+        self.macros: dict[str, Macro] = {}
+        self.external_symbols: dict[str, list[Symbol]] = {}
+        self.layout_diagnostics: list[dict] = []
+        self.layouts: int = 0
+        # How many lines were analyzed
+        self.analyzed: int = 0
+
+        self.__context: AssemblyContext = AssemblyContext()
+        self.set_text(text)
+
+    def set_text(self, text: str) -> None:
+        self.definitions.clear()
+        self.references.clear()
+        self.errors.clear()
+        self.lines = []
+        self.__replace(0, 0, text.split("\n"))
+
+    def apply_change(self, change: dict) -> None:
+        """
+        Applies a content change of a didChange notification: the whole text, or a range of it
+        :param change: dict
+        """
+        change_range: dict | None = change.get("range", None)
+        if change_range is None:
+            self.set_text(change["text"])
+            return
+
+        start: dict = change_range["start"]
+        end: dict = change_range["end"]
+        start_line: int = min(start["line"], len(self.lines) - 1)
+        end_line: int = min(end["line"], len(self.lines) - 1)
+
+        first: str = self.lines[start_line].text
+        last: str = self.lines[end_line].text
+        text: str = (first[:self.from_client(start_line, start["character"])] + change["text"] +
+                     last[self.from_client(end_line, end["character"]):])
+
+        self.__replace(start_line, end_line + 1, text.split("\n"))
+
+    # Positions
+
+    def to_client(self, line: int, column: int) -> int:
+        """
+        The column of the line, counted in the position encoding of the client
+        """
+        text: str = self.lines[line].text if 0 <= line < len(self.lines) else ""
+        if self.position_encoding != UTF16 or text.isascii():
+            return column
+        # The characters past the basic plane take two UTF-16 code units
+        return column + sum(1 for char in text[:column] if ord(char) > 0xFFFF)
+
+    def from_client(self, line: int, character: int) -> int:
+        """
+        The column of the line, from a character counted in the position encoding of the client
+        """
+        text: str = self.lines[line].text if 0 <= line < len(self.lines) else ""
+        if self.position_encoding != UTF16 or text.isascii():
+            return character
+
+        units: int = 0
+        for column, char in enumerate(text):
+            if units >= character:
+                return column
+            units += 2 if ord(char) > 0xFFFF else 1
+        return len(text)
+
+    def range(self, line: int, start: int, end: int) -> dict:
+        """
+        The range of the columns of the line, for the client
+        """
+        return _range(line, self.to_client(line, start), self.to_client(line, end))
+
+    # Analysis
+
+    def __analyze(self, text: str) -> LineInfo:
+        self.analyzed += 1
+        return analyze_line(text.removesuffix("\r"), self.__context)
+
+    def __index(self, info: LineInfo) -> None:
+        if info.kind is LineKind.LABEL or info.kind is LineKind.VARIABLE:
+            if info.name is not None:
+                self.definitions.setdefault(info.name, []).append(info)
+        for name, _, _ in info.references:
+            self.references.setdefault(name, []).append(info)
+        if info.error is not None:
+            self.errors[info] = None
+
+    def __unindex(self, info: LineInfo) -> None:
+        if info.kind is LineKind.LABEL or info.kind is LineKind.VARIABLE:
+            if info.name is not None:
+                definitions: list[LineInfo] = self.definitions[info.name]
+                definitions.remove(info)
+                if not definitions:
+                    del self.definitions[info.name]
+        for name, _, _ in info.references:
+            references: list[LineInfo] = self.references.get(name, [])
+            if info in references:
+                references.remove(info)
+                if not references:
+                    del self.references[name]
+        self.errors.pop(info, None)
+
+    def __replace(self, start: int, stop: int, texts: list[str]) -> None:
+        old_lines: list[LineInfo] = self.lines[start:stop]
+        new_lines: list[LineInfo] = [self.__analyze(text) for text in texts]
+
+        for info in old_lines:
+            self.__unindex(info)
+        for info in new_lines:
+            self.__index(info)
+
+        # Nothing moves if every line is replaced by one of the same shape
+        if len(old_lines) == len(new_lines) and all(
+            old.macro is None and old.layout_key() == new.layout_key()
+            for old, new in zip(old_lines, new_lines)
+        ):
+            self.lines[start:stop] = new_lines
+            for old, new in zip(old_lines, new_lines):
+                new.line = old.line
+                new.segment = old.segment
+                new.offset = old.offset
+            return
+
+        if start > 0 and self.__shift(start, old_lines, new_lines):
+            return
+
+        self.lines[start:stop] = new_lines
+        self.layout()
+
+    def __shift(self, start: int, old_lines: list[LineInfo], new_lines: list[LineInfo]) -> bool:
+        """
+        Replaces lines of code by other lines of code, moving the following lines instead of laying the whole document
+        out again. Returns False if the replaced lines or the line before them are not plain code
+        """
+        # The blank lines are in no segment, the new lines follow the code before them
+        index: int = start - 1
+        while index > 0 and self.lines[index].kind is LineKind.BLANK:
+            index -= 1
+        previous: LineInfo = self.lines[index]
+        if previous.kind in _STRUCTURAL_KINDS or previous.kind is LineKind.BLANK or previous.macro is not None:
+            return False
+        for info in old_lines + new_lines:
+            if info.kind in _STRUCTURAL_KINDS or info.macro is not None:
+                return False
+
+        segment: str | None = previous.segment
+        offset: int = previous.offset + previous.size
+        size_delta: int = 0 if segment is None else sum(info.size for info in new_lines) - sum(
+            info.size for info in old_lines
+        )
+        # The symbols of the includes and the macros after the lines would move too
+        if size_delta != 0 and self.external_symbols:
+            return False
+
+        for index, info in enumerate(new_lines, start=start):
+            info.line = index
+            if info.kind is not LineKind.BLANK:
+                info.segment = segment
+                info.offset = offset
+            if segment is not None:
+                offset += info.size
+
+        stop: int = start + len(old_lines)
+        line_delta: int = len(new_lines) - len(old_lines)
+        self.lines[start:stop] = new_lines
+
+        if line_delta != 0 or size_delta != 0:
+            for info in self.lines[start + len(new_lines):]:
+                info.line += line_delta
+                if info.segment == segment:
+                    info.offset += size_delta
+
+        if line_delta != 0:
+            for diagnostic in self.layout_diagnostics:
+                for position in diagnostic["range"].values():
+                    if position["line"] >= stop:
+                        position["line"] += line_delta
+            # The lines of the document are 1-based in the macros
+            for macro in self.macros.values():
+                if macro.path == self.source_path and macro.line > stop:
+                    macro.line += line_delta
+            for symbols in self.external_symbols.values():
+                for symbol in symbols:
+                    if symbol.uri == self.uri and symbol.line >= stop:
+                        symbol.line += line_delta
+
+        if segment == SEGMENTS[0]:
+            self.code_size += size_delta
+        return True
+
+    # Layout
+
+    def layout(self) -> None:
+        """
+        Lays the document out as the assembler does: numbers the lines, expands the includes and the macros, and
+        places the lines in their segments
+        """
+        rejected: set[int] = set()
+        # The errors of the preprocessor, on the lines it rejected
+        errors: list[dict] = []
+
+        while True:
+            diagnostics: list[dict] = []
+            try:
+                self.__place(rejected, diagnostics)
+            except PreprocessorError as e:
+                line: int = (e.line or 0) - 1
+                if not 0 <= line < len(self.lines):
+                    errors.append(_diagnostic(0, 0, 0, e.reason))
+                    break
+                errors.append(_diagnostic(line, 0, len(self.lines[line].text), e.reason))
+                if line in rejected or len(rejected) == _MAX_REJECTED_LINES:
+                    break
+                rejected.add(line)
+                continue
+            except InvalidCodeError as e:
+                # A document without any segment is a file meant to be included
+                if any(info.kind is LineKind.SEGMENT for info in self.lines):
+                    line = (e.line or 1) - 1
+                    diagnostics.append(_diagnostic(line, 0, len(self.lines[line].text) if e.line else 0, e.reason))
+            break
+
+        # The segments opened again are ignored
+        opened: set[str] = set()
+        for info in self.lines:
+            if info.kind is LineKind.SEGMENT and info.segment is None and info.line not in rejected:
+                if info.name in opened:
+                    diagnostics.append(_diagnostic(
+                        info.line, 0, len(info.text), f"Segment '{info.name}' was already defined, this one is ignored",
+                        _SEVERITY_WARNING
+                    ))
+                opened.add(info.name)
+
+        self.layout_diagnostics = errors + diagnostics
+        self.layouts += 1
+
+    def __place(self, rejected: set[int], diagnostics: list[dict]) -> None:
+        # A pass of the layout, leaving the rejected lines out
+        lines: list[LineInfo] = self.lines
+        for index, info in enumerate(lines):
+            info.line = index
+            info.segment = None
+            info.offset = 0
+            info.macro = None
+        self.code_size = 0
+        self.macros = {}
+        self.external_symbols = {}
+
+        expansion: Expansion = Expansion(self.source_path)
+        # Where every expanded line comes from: (file, line in it, line of the document)
+        origins: list[tuple[str | None, int, int]] = []
+
+        def tagged(expanded_lines: Iterable[tuple[int, str]]) -> Iterator[tuple[int, str]]:
+            for position, code in expanded_lines:
+                origins.append((expansion.origin_path, expansion.origin_line, position))
+                yield len(origins) - 1, code
+
+        def report(info: LineInfo, message: str) -> None:
+            code: str = info.text.strip()
+            start: int = info.text.index(code) if code else 0
+            diagnostics.append(_diagnostic(info.line, start, start + len(code), message))
+
+        codes: Iterator[tuple[int, str]] = (
+            (line_number, code)
+            for line_number, code in strip_comments(info.text for info in lines)
+            if line_number - 1 not in rejected
+        )
+        offsets: dict[str, int] = dict.fromkeys(SEGMENTS, 0)
+
+        try:
+            for segment, entry, code in iter_segments(
+                    tagged(self.preprocessor.process(codes, self.source_path, expansion))):
+                path, line_number, position = origins[entry]
+                info: LineInfo = lines[position - 1]
+
+                if path != self.source_path or line_number != position:
+                    self.__place_expanded(code, path, line_number, info, segment, offsets[segment], report)
+                    offsets[segment] += self.__expanded(code).size
+                    continue
+
+                if info.kind is LineKind.MACRO_CALL:
+                    report(info, f"Unknown instruction or macro '{info.name}'")
+                    continue
+
+                info.segment = segment
+                info.offset = offsets[segment]
+                if info.kind is LineKind.SEGMENT:
+                    report(info, f"Segment '{segment}' is missing its '{Tokens.SEGMENT_END_TOKEN}'")
+                offsets[segment] += info.size
+        finally:
+            self.code_size = offsets[SEGMENTS[0]]
+            self.macros = expansion.macros
+            for macro in self.macros.values():
+                if macro.path == self.source_path:
+                    for body_line_number, _ in macro.body:
+                        lines[body_line_number - 1].macro = macro.parameters
+
+    def __expanded(self, code: str) -> LineInfo:
+        info: LineInfo | None = self.expanded.get(code, None)
+        if info is None:
+            info = analyze_line(code, self.__context)
+            self.expanded[code] = info
+        return info
+
+    def __place_expanded(
+            self,
+            code: str,
+            path: str | None,
+            line_number: int,
+            origin: LineInfo,
+            segment: str,
+            offset: int,
+            report
+    ) -> None:
+        # A line expanded from the origin, a line of the document including a file or invoking a macro
+        if origin.segment is None:
+            origin.segment = segment
+            origin.offset = offset
+
+        info: LineInfo = self.__expanded(code)
+        where: str = f"{os.path.basename(path) if path is not None else 'line'}:{line_number}"
+        if info.kind is LineKind.MACRO_CALL:
+            report(origin, f"Unknown instruction or macro '{info.name}' ({where})")
+        elif info.error is not None:
+            report(origin, f"{info.error[0]} ({where})")
+        elif (info.kind is LineKind.LABEL or info.kind is LineKind.VARIABLE) and info.name is not None:
+            self.external_symbols.setdefault(info.name, []).append(Symbol(
+                info.name, self.__uri(path), line_number - 1, info.name_start, info.name_end, segment, offset,
+                info.value
+            ))
+
+    def __uri(self, path: str | None) -> str:
+        return self.uri if path == self.source_path else path_to_uri(path)
+
+    def macro_location(self, macro: Macro) -> tuple[str, int]:
+        """
+        The uri and the (0-based) line of the definition of the macro
+        """
+        return self.__uri(macro.path), macro.line - 1
+
+    def address(self, segment: str | None, offset: int) -> int | None:
+        """
+        The address of the offset in the segment. The data segment comes after the code
+        """
+        if segment is None:
+            return None
+        return PROGRAM_START + offset + (self.code_size if segment != SEGMENTS[0] else 0)
+
+    def symbol(self, name: str) -> Symbol | None:
+        """
+        Finds the definition of a label or a variable, in the document or in the files it includes
+        """
+        for info in self.definitions.get(name, ()):
+            if info.macro is None:
+                return Symbol(name, self.uri, info.line, info.name_start, info.name_end, info.segment, info.offset,
+                              info.value)
+
+        symbols: list[Symbol] = self.external_symbols.get(name, [])
+        return symbols[0] if symbols else None
+
+    def symbols(self) -> list[Symbol]:
+        """
+        Every label and variable defined by the document or the files it includes
+        """
+        found: dict[str, Symbol] = {}
+        for name in self.definitions:
+            symbol: Symbol | None = self.symbol(name)
+            if symbol is not None:
+                found[name] = symbol
+        for name, symbols in self.external_symbols.items():
+            found.setdefault(name, symbols[0])
+        return list(found.values())
+
+    def diagnostics(self) -> list[dict]:
+        """
+        The syntax errors of the lines, the duplicate and the undefined symbols, and the problems found by the layout,
+        in the position encoding of the client
+        :return: list[dict]
+        """
+        diagnostics: list[dict] = list(self.layout_diagnostics)
+
+        for info in self.errors:
+            # The lines outside of the segments are never parsed, nor are the macro bodies as such. The directives are
+            # always expanded
+            if info.segment is not None or info.kind is LineKind.INCLUDE or info.kind is LineKind.MACRO:
+                message, start, end = info.error
+                diagnostics.append(_diagnostic(info.line, start, end, message))
+
+        for name, infos in self.definitions.items():
+            defined: list[LineInfo] = [info for info in infos if info.macro is None and info.segment is not None]
+            if len(defined) + len(self.external_symbols.get(name, ())) < 2:
+                continue
+
+            kind: str = "Label" if name.startswith(Tokens.LABEL_NAME_TOKEN) else "Variable"
+            defined.sort(key=lambda line_info: line_info.line)
+            for info in defined[0 if name in self.external_symbols else 1:]:
+                diagnostics.append(_diagnostic(
+                    info.line, info.name_start, info.name_end, f"{kind} '{name}' was already defined"
+                ))
+
+        for name, infos in self.references.items():
+            if name in self.external_symbols or any(info.macro is None for info in self.definitions.get(name, ())):
+                continue
+
+            kind = "Label" if name.startswith(Tokens.LABEL_NAME_TOKEN) else "Variable"
+            for info in infos:
+                # Already reported as a syntax error
+                if info.error is not None:
+                    continue
+                if info.macro is not None:
+                    if name in info.macro:
+                        continue
+                elif info.segment is None:
+                    continue
+
+                for reference, start, end in info.references:
+                    if reference == name:
+                        diagnostics.append(_diagnostic(info.line, start, end, f"{kind} '{name}' is never defined"))
+
+        if self.position_encoding != UTF16:
+            return diagnostics
+        return [self.__encoded(diagnostic) for diagnostic in diagnostics]
+
+    def __encoded(self, diagnostic: dict) -> dict:
+        # The diagnostic with its range in UTF-16
+        start, end = diagnostic["range"]["start"], diagnostic["range"]["end"]
+        if not 0 <= start["line"] < len(self.lines) or self.lines[start["line"]].text.isascii():
+            return diagnostic
+        return {**diagnostic, "range": self.range(start["line"], start["character"], end["character"])}
+
+    def word_at(self, line: int, character: int) -> str | None:
+        """
+        The word at the character of the line, counted in the position encoding of the client
+        """
+        if not 0 <= line < len(self.lines):
+            return None
+        column: int = self.from_client(line, character)
+        for token in tokenize(self.lines[line].text):
+            if token.column - 1 <= column <= token.column - 1 + len(token.text):
+                return token.text.removesuffix(Tokens.DECLARATION_END_TOKEN)
+        return None
+
+
+class LanguageServer:
+    """
+    The language server: reads the JSON-RPC messages from the input stream and answers on the output stream
+    """
+
+    def __init__(
+            self,
+            input_stream: IO[bytes] | None = None,
+            output_stream: IO[bytes] | None = None,
+            include_dirs: Iterable[str] = ()
+    ):
+        self.input_stream: IO[bytes] = input_stream if input_stream is not None else sys.stdin.buffer
+        self.output_stream: IO[bytes] = output_stream if output_stream is not None else sys.stdout.buffer
+        self.preprocessor: Preprocessor = Preprocessor(include_dirs)
+        self.documents: dict[str, Document] = {}
+        self.running: bool = True
+        self.shutdown_requested: bool = False
+        # Negotiated on initialize
+        self.position_encoding: str = UTF16
+        # The analysis of the expanded lines, shared by the documents
+        self.__expanded: dict[str, LineInfo] = {}
+
+        self.__requests: dict = {
+            "initialize": self.initialize,
+            "shutdown": self.shutdown,
+            "textDocument/hover": self.hover,
+            "textDocument/definition": self.definition,
+            "textDocument/references": self.find_references,
+            "textDocument/completion": self.completion,
+            "textDocument/documentSymbol": self.document_symbols,
+            "textDocument/inlayHint": self.inlay_hints
+        }
+        self.__notifications: dict = {
+            "exit": self.exit,
+            "textDocument/didOpen": self.did_open,
+            "textDocument/didChange": self.did_change,
+            "textDocument/didSave": self.did_save,
+            "textDocument/didClose": self.did_close
+        }
+
+    # Transport
+    def read_message(self) -> dict | None:
+        """
+        Reads a message, None at the end of the input
+        """
+        content_length: int | None = None
+
+        while True:
+            header: bytes = self.input_stream.readline()
+            if header == b"":
+                return None
+
+            header = header.strip()
+            if header == b"":
+                if content_length is not None:
+                    break
+                continue
+
+            name, _, value = header.decode(HEADER_ENCODING).partition(":")
+            if name.strip().lower() == "content-length":
+                content_length = int(value.strip())
+
+        return json.loads(self.input_stream.read(content_length))
+
+    def send(self, message: dict) -> None:
+        body: bytes = json.dumps({"jsonrpc": "2.0", **message}, separators=(",", ":")).encode()
+        self.output_stream.write(f"Content-Length: {len(body)}\r\n\r\n".encode(HEADER_ENCODING) + body)
+        self.output_stream.flush()
+
+    def run(self) -> int:
+        """
+        Serves until the exit notification or the end of the input. Returns the exit code
+        """
+        while self.running:
+            message: dict | None = self.read_message()
+            if message is None:
+                break
+            self.handle(message)
+
+        return 0 if self.shutdown_requested else 1
+
+    def handle(self, message: dict) -> None:
+        method: str | None = message.get("method", None)
+        params: dict = message.get("params", None) or {}
+
+        if "id" not in message:
+            notification = self.__notifications.get(method, None)
+            if notification is not None:
+                notification(params)
+            return
+
+        request = self.__requests.get(method, None)
+        if request is None:
+            self.send({
+                "id": message["id"], "error": {"code": _METHOD_NOT_FOUND, "message": f"Unknown method '{method}'"}
+            })
+            return
+
+        try:
+            self.send({"id": message["id"], "result": request(params)})
+        except Exception as e:
+            self.send({"id": message["id"], "error": {"code": _INTERNAL_ERROR, "message": f"{type(e).__name__}: {e}"}})
+
+    def publish_diagnostics(self, document: Document) -> None:
+        self.send({
+            "method": "textDocument/publishDiagnostics",
+            "params": {"uri": document.uri, "version": document.version, "diagnostics": document.diagnostics()}
+        })
+
+    # Lifecycle
+    def initialize(self, params: dict) -> dict:
+        offered: list[str] = params.get("capabilities", {}).get("general", {}).get("positionEncodings", [])
+        self.position_encoding = UTF32 if UTF32 in offered else UTF16
+        return {
+            "capabilities": {
+                "positionEncoding": self.position_encoding,
+                "textDocumentSync": {"openClose": True, "change": _TEXT_DOCUMENT_SYNC_INCREMENTAL, "save": True},
+                "hoverProvider": True,
+                "definitionProvider": True,
+                "referencesProvider": True,
+                "completionProvider": {"triggerCharacters": ["_"]},
+                "documentSymbolProvider": True,
+                "inlayHintProvider": True
+            },
+            "serverInfo": {"name": "chip8_compiler"}
+        }
+
+    def shutdown(self, params: dict) -> None:
+        self.shutdown_requested = True
+        return None
+
+    def exit(self, params: dict) -> None:
+        self.running = False
+
+    # Documents
+    def did_open(self, params: dict) -> None:
+        text_document: dict = params["textDocument"]
+        document: Document = Document(
+            text_document["uri"], text_document["text"], text_document.get("version", 0),
+            self.preprocessor, self.__expanded, self.position_encoding
+        )
+        self.documents[document.uri] = document
+        self.publish_diagnostics(document)
+
+    def did_change(self, params: dict) -> None:
+        document: Document | None = self.documents.get(params["textDocument"]["uri"], None)
+        if document is None:
+            return
+
+        for change in params["contentChanges"]:
+            document.apply_change(change)
+        document.version = params["textDocument"].get("version", document.version)
+        self.publish_diagnostics(document)
+
+    def did_save(self, params: dict) -> None:
+        # The documents including the saved file see its new content
+        for document in self.documents.values():
+            if document.uri != params["textDocument"]["uri"]:
+                document.layout()
+                self.publish_diagnostics(document)
+
+    def did_close(self, params: dict) -> None:
+        document: Document | None = self.documents.pop(params["textDocument"]["uri"], None)
+        if document is not None:
+            self.send({
+                "method": "textDocument/publishDiagnostics",
+                "params": {"uri": document.uri, "diagnostics": []}
+            })
+
+    # Features
+    def __document(self, params: dict) -> Document:
+        return self.documents[params["textDocument"]["uri"]]
+
+    @staticmethod
+    def __location(document: Document, symbol: Symbol) -> dict:
+        if symbol.uri == document.uri:
+            return {"uri": symbol.uri, "range": document.range(symbol.line, symbol.start, symbol.end)}
+        return {"uri": symbol.uri, "range": _range(symbol.line, symbol.start, symbol.end)}
+
+    @staticmethod
+    def __describe(document: Document, symbol: Symbol) -> str:
+        if symbol.is_label:
+            address: int | None = document.address(symbol.segment, symbol.offset)
+            return f"label {symbol.name}" + (f" at 0x{address:03X}" if address is not None else "")
+        return f"variable {symbol.name} = " + (f"0x{symbol.value:02X} ($d{symbol.value})" if symbol.value is not None
+                                               else "?")
+
+    def hover(self, params: dict) -> dict | None:
+        document: Document = self.__document(params)
+        position: dict = params["position"]
+        line: int = position["line"]
+        word: str | None = document.word_at(line, position["character"])
+        if word is None:
+            return None
+
+        symbol: Symbol | None = document.symbol(word)
+        if symbol is not None:
+            contents: str = self.__describe(document, symbol)
+        elif word in document.macros:
+            macro: Macro = document.macros[word]
+            contents = f"macro {macro.name} {', '.join(macro.parameters)}"
+        else:
+            info: LineInfo = document.lines[line]
+            address: int | None = document.address(info.segment, info.offset)
+            if address is None or info.size == 0:
+                return None
+            contents = f"0x{address:03X}, {info.size} byte{'s' if info.size > 1 else ''}"
+
+        return {"contents": {"kind": "plaintext", "value": contents}}
+
+    def definition(self, params: dict) -> dict | None:
+        document: Document = self.__document(params)
+        word: str | None = document.word_at(params["position"]["line"], params["position"]["character"])
+        if word is None:
+            return None
+
+        symbol: Symbol | None = document.symbol(word)
+        if symbol is not None:
+            return self.__location(document, symbol)
+
+        macro: Macro | None = document.macros.get(word, None)
+        if macro is not None:
+            uri, line = document.macro_location(macro)
+            return {"uri": uri, "range": _range(line, 0, 0)}
+        return None
+
+    def find_references(self, params: dict) -> list[dict]:
+        document: Document = self.__document(params)
+        word: str | None = document.word_at(params["position"]["line"], params["position"]["character"])
+        if word is None:
+            return []
+
+        locations: list[dict] = []
+        if params.get("context", {}).get("includeDeclaration", False):
+            symbol: Symbol | None = document.symbol(word)
+            if symbol is not None:
+                locations.append(self.__location(document, symbol))
+
+        for info in sorted(document.references.get(word, ()), key=lambda line_info: line_info.line):
+            for name, start, end in info.references:
+                if name == word:
+                    locations.append({"uri": document.uri, "range": document.range(info.line, start, end)})
+
+        return locations
+
+    def completion(self, params: dict) -> list[dict]:
+        document: Document = self.__document(params)
+        position: dict = params["position"]
+        line: int = position["line"]
+        text: str = document.lines[line].text[:document.from_client(line, position["character"])]
+
+        # The first word of a line is an instruction, a keyword or a macro
+        words: list[str] = [token.text for token in tokenize(text)]
+        if len(words) == 0 or len(words) == 1 and text.endswith(words[0]):
+            items: list[dict] = [
+                {"label": name, "kind": _COMPLETION_KIND_KEYWORD} for name in sorted(INSTRUCTION_NAMES)
+            ]
+            items.extend({"label": keyword, "kind": _COMPLETION_KIND_KEYWORD} for keyword in _KEYWORDS)
+            items.extend(
+                {"label": name, "kind": _COMPLETION_KIND_FUNCTION, "detail": ", ".join(macro.parameters)}
+                for name, macro in document.macros.items()
+            )
+            return items
+
+        return [
+            {
+                "label": symbol.name,
+                "kind": _COMPLETION_KIND_CONSTANT if symbol.is_label else _COMPLETION_KIND_VARIABLE,
+                "detail": self.__describe(document, symbol)
+            }
+            for symbol in document.symbols()
+        ]
+
+    def document_symbols(self, params: dict) -> list[dict]:
+        document: Document = self.__document(params)
+        symbols: list[dict] = []
+
+        for symbol in document.symbols():
+            if symbol.uri != document.uri:
+                continue
+            symbol_range: dict = document.range(symbol.line, symbol.start, symbol.end)
+            symbols.append({
+                "name": symbol.name,
+                "detail": self.__describe(document, symbol),
+                "kind": _SYMBOL_KIND_FUNCTION if symbol.is_label else _SYMBOL_KIND_CONSTANT,
+                "range": symbol_range,
+                "selectionRange": symbol_range
+            })
+
+        for macro in document.macros.values():
+            uri, line = document.macro_location(macro)
+            if uri == document.uri:
+                macro_range: dict = document.range(line, 0, len(document.lines[line].text))
+                symbols.append({
+                    "name": macro.name,
+                    "detail": ", ".join(macro.parameters),
+                    "kind": _SYMBOL_KIND_OPERATOR,
+                    "range": macro_range,
+                    "selectionRange": macro_range
+                })
+
+        return sorted(symbols, key=lambda item: item["range"]["start"]["line"])
+
+    def inlay_hints(self, params: dict) -> list[dict]:
+        document: Document = self.__document(params)
+        first_line: int = params["range"]["start"]["line"]
+        last_line: int = min(params["range"]["end"]["line"], len(document.lines) - 1)
+
+        hints: list[dict] = []
+        for info in document.lines[first_line:last_line + 1]:
+            if info.kind is LineKind.LABEL and info.segment is not None and info.error is None:
+                hints.append({
+                    "position": {"line": info.line, "character": document.to_client(info.line, len(info.text))},
+                    "label": f" 0x{document.address(info.segment, info.offset):03X}",
+                    "paddingLeft": True
+                })
+        return hints
+
+
+def serve_lsp(include_dirs: Iterable[str] = ()) -> int:
+    """
+    Runs the language server over stdio. Returns the exit code
+    """
+    return LanguageServer(include_dirs=include_dirs).run()
@@ -0,0 +1,312 @@
+import re
+from dataclasses import dataclass
+from enum import StrEnum
+
+from .Tokens import Tokens
+from .Globals import AssemblyContext
+from .Types import (
+    Literal,
+    AddressLiteral,
+    Label,
+    Variable,
+    Register,
+    Instruction
+)
+from .Interfaces import (
+    AssemblyError,
+    Bytecode,
+    InstructionEncoding
+)
+from ._ChipInstructions import (
+    LITERAL_KIND,
+    INSTRUCTION_NAMES,
+    encoding_table
+)
+
+# Lexer of the lines of code.
+#
+# Every line is split into words once, and its first word tells what the line
+# is: an instruction, a label or a variable definition, or a data literal. The
+# line then goes straight to the matching constructor, instead of trying every
+# kind of line in turn. Data literals are recognised by their first character,
+# before the line is even split.
+#
+# The operands are classified the same way, by their first characters:
+#   __ADDR__            the address of the instruction
+#   $...                a literal
+#   __...               a label
+#   V...                a register
+#   I, K, B, F, R..., DT, ST
+#                       a special register
+#   anything else       a variable
+
+# Words are separated by whitespace and commas
+_WORD_PATTERN: re.Pattern = re.compile(r"[^\s,]+")
+
+_SPECIAL_REGISTER_STARTS: frozenset[str] = frozenset("IKBFR")
+_SPECIAL_REGISTER_NAMES: frozenset[str] = frozenset(["DT", "ST"])
+
+# The registers are never modified, so the parsed ones are shared
+_REGISTER_CACHE_SIZE: int = 256
+_REGISTER_CACHE: dict[str, Register] = {}
+
+
+class TokenKind(StrEnum):
+    INSTRUCTION = "instruction",
+    LABEL_KEYWORD = "label keyword",
+    VARIABLE_KEYWORD = "variable keyword",
+    LABEL_DEFINITION = "label definition",
+    ADDRESS = "address",
+    LITERAL = "literal",
+    LABEL = "label",
+    REGISTER = "register",
+    SPECIAL_REGISTER = "special register",
+    NAME = "name"
+
+
+@dataclass(slots=True, frozen=True)
+class Token:
+    """
+    A word of a line of code. The column is 1-based, within the code of the line
+    """
+    kind: TokenKind
+    text: str
+    line: int
+    column: int
+
+
+def classify(word: str, first: bool = False) -> TokenKind:
+    """
+    Classifies a word of a line of code. The first word of a line can also be a keyword
+    :param word: str
+    :param first: bool, whether the word starts the line
+    :return: TokenKind
+    """
+    if first:
+        if word in INSTRUCTION_NAMES:
+            return TokenKind.INSTRUCTION
+        if word == Tokens.LABEL_TOKEN:
+            return TokenKind.LABEL_KEYWORD
+        if word == Tokens.VARIABLE_TOKEN:
+            return TokenKind.VARIABLE_KEYWORD
+
+    if word == Tokens.ADDRESS_SPECIAL_TOKEN:
+        return TokenKind.ADDRESS
+
+    first_char: str = word[0]
+    if first_char == Tokens.LITERAL_TOKEN:
+        return TokenKind.LITERAL
+    if word.startswith(Tokens.LABEL_NAME_TOKEN):
+        return TokenKind.LABEL_DEFINITION if word[-1] == Tokens.DECLARATION_END_TOKEN else TokenKind.LABEL
+    if first_char == "V":
+        return TokenKind.REGISTER
+    if first_char in _SPECIAL_REGISTER_STARTS or word in _SPECIAL_REGISTER_NAMES:
+        return TokenKind.SPECIAL_REGISTER
+
+    return TokenKind.NAME
+
+
+def tokenize(line: str, line_number: int = 0) -> list[Token]:
+    """
+    Splits a line of code (without comments) into typed tokens
+    :param line: str
+    :param line_number: int
+    :return: list[Token]
+    """
+    return [
+        Token(classify(match.group(), index == 0), match.group(), line_number, match.start() + 1)
+        for index, match in enumerate(_WORD_PATTERN.finditer(line))
+    ]
+
+
+def __column(line: str, word_index: int) -> int:
+    tokens: list[Token] = tokenize(line)
+    return tokens[min(word_index, len(tokens) - 1)].column if tokens else 1
+
+
+def __syntax_error(line: str, line_number: int, word_index: int = 0, reason: str = "") -> AssemblyError:
+    column: int = __column(line, word_index)
+    reason = f"Invalid syntax present! {reason}".rstrip()
+
+    return AssemblyError(
+        f"{reason} Line in question: {line} (line {line_number}, column {column})",
+        line=line_number, column=column, reason=reason
+    )
+
+
+def __locate(error: AssemblyError, line: str, line_number: int, word_index: int) -> AssemblyError:
+    # Gives its position to an error raised without one
+    if error.line is None:
+        error.line, error.column = line_number, __column(line, word_index)
+    return error
+
+
+def __literal(word: str, line: str, line_number: int, word_index: int) -> Literal:
+    try:
+        return Literal.parse_value(word)
+    except ValueError:
+        raise __syntax_error(line, line_number, word_index, f"Invalid literal '{word}'.") from None
+
+
+def __register(word: str, line: str, line_number: int, word_index: int) -> Register | None:
+    register: Register | None = _REGISTER_CACHE.get(word, None)
+    if register is not None:
+        return register
+
+    first_char: str = word[0]
+    if first_char != "V" and first_char not in _SPECIAL_REGISTER_STARTS and word not in _SPECIAL_REGISTER_NAMES:
+        return None
+
+    try:
+        register = Register.parse_value(word)
+    except ValueError:
+        raise __syntax_error(line, line_number, word_index, f"Invalid register '{word}'.") from None
+    except AssemblyError as e:
+        raise __syntax_error(line, line_number, word_index, e.reason) from None
+
+    if len(_REGISTER_CACHE) < _REGISTER_CACHE_SIZE:
+        _REGISTER_CACHE[word] = register
+    return register
+
+
+def __parse_instruction(
+        words: list[str],
+        line: str,
+        line_number: int,
+        address: int,
+        context: AssemblyContext
+) -> Instruction:
+    word_count: int = len(words)
+    operand1 = operand2 = optional_operand = None
+    # The kinds of the operands, see get_encoding. Only the registers have a kind of their own
+    kind1 = kind2 = kind3 = None
+    # The word of the literal operand, if any (there is at most one)
+    literal_index: int = 0
+
+    if word_count > 4:
+        raise __syntax_error(line, line_number, 4, "Too many operands.")
+
+    if word_count == 2:
+        # A register, a label or a literal
+        word: str = words[1]
+        kind1 = LITERAL_KIND
+        if word == Tokens.ADDRESS_SPECIAL_TOKEN:
+            operand1 = AddressLiteral(value=address)
+        elif word[0] == Tokens.LITERAL_TOKEN:
+            operand1 = __literal(word, line, line_number, 1)
+            literal_index = 1
+        elif word.startswith(Tokens.LABEL_NAME_TOKEN):
+            operand1 = Label.parse_value(word, context)
+        else:
+            operand1 = __register(word, line, line_number, 1)
+            if operand1 is None:
+                raise __syntax_error(line, line_number, 1, f"Invalid operand '{word}'.")
+            kind1 = operand1.operand_kind()
+
+    elif word_count >= 3:
+        # The second operand is a register, a literal, a label or a variable
+        word = words[2]
+        kind2 = LITERAL_KIND
+        if word == Tokens.ADDRESS_SPECIAL_TOKEN:
+            operand2 = AddressLiteral(value=address)
+        elif word[0] == Tokens.LITERAL_TOKEN:
+            operand2 = __literal(word, line, line_number, 2)
+            literal_index = 2
+        elif word.startswith(Tokens.LABEL_NAME_TOKEN):
+            operand2 = Label.parse_value(word, context)
+        else:
+            operand2 = __register(word, line, line_number, 2)
+            if operand2 is None:
+                operand2 = Variable.parse_value(word, context)
+            else:
+                kind2 = operand2.operand_kind()
+
+        # The first one can only be a register
+        operand1 = __register(words[1], line, line_number, 1)
+        if operand1 is not None:
+            kind1 = operand1.operand_kind()
+
+        if word_count == 4:
+            # The optional operand is a literal or a variable
+            word = words[3]
+            kind3 = LITERAL_KIND
+            if word == Tokens.ADDRESS_SPECIAL_TOKEN:
+                optional_operand = AddressLiteral(value=address)
+            elif word[0] == Tokens.LITERAL_TOKEN:
+                optional_operand = __literal(word, line, line_number, 3)
+                literal_index = 3
+            else:
+                optional_operand = Variable.parse_value(word, context)
+
+    encoding: InstructionEncoding | None = encoding_table().get((words[0], kind1, kind2, kind3), None)
+    if encoding is None:
+        raise __syntax_error(line, line_number, 0, f"No '{words[0]}' instruction takes these operands.")
+
+    # The literal must fit into its field, the symbols are only known once resolved
+    if literal_index:
+        for index, _, mask in encoding.fields:
+            if index == literal_index - 1:
+                value: int = (operand1, operand2, optional_operand)[index].value
+                if not 0 <= value <= mask:
+                    reason: str = f"The literal '{words[literal_index]}' does not fit in {mask.bit_length()} bits."
+                    raise __syntax_error(line, line_number, literal_index, reason)
+
+    return Instruction(words[0], address, operand1, operand2, optional_operand, encoding)
+
+
+def parse_item(line: str, context: AssemblyContext, line_number: int = 0) -> Bytecode | Label | Variable:
+    """
+    Parses a single line of code (without comments) at the current address of the context, without adding it to the
+    context. Raises an AssemblyError in case of invalid syntax
+    :param line: str
+    :param context: AssemblyContext
+    :param line_number: int, for the error messages
+    :return: Bytecode | Label | Variable
+    """
+    address: int = context.current_addr
+
+    # Data literals, the bulk of the data segment
+    if line[0] == Tokens.LITERAL_TOKEN:
+        literal: Literal = __literal(line, line, line_number, 0)
+        if not 0 <= literal.value <= 0xFF:
+            raise __syntax_error(line, line_number, 0, f"Literal '{line}' does not fit in a byte.")
+        return literal
+
+    words: list[str] = _WORD_PATTERN.findall(line)
+    if not words:
+        raise __syntax_error(line, line_number)
+
+    keyword: str = words[0]
+
+    if keyword in INSTRUCTION_NAMES:
+        return __parse_instruction(words, line, line_number, address, context)
+
+    if keyword == Tokens.LABEL_TOKEN:
+        # label __name:
+        if len(words) != 2:
+            raise __syntax_error(line, line_number, min(len(words), 2), "Expected 'label __name:'.")
+
+        name: str = words[1]
+        if name[-1] != Tokens.DECLARATION_END_TOKEN or not name.startswith(Tokens.LABEL_NAME_TOKEN):
+            raise __syntax_error(line, line_number, 1, "Expected 'label __name:'.")
+
+        try:
+            return Label.define(name[:-1], address, context)
+        except AssemblyError as e:
+            raise __locate(e, line, line_number, 1)
+
+    if keyword == Tokens.VARIABLE_TOKEN:
+        # variable name $value
+        if len(words) != 3:
+            raise __syntax_error(line, line_number, min(len(words), 3), "Expected 'variable name $value'.")
+
+        if words[2][0] != Tokens.LITERAL_TOKEN:
+            raise __syntax_error(line, line_number, 2, "Expected 'variable name $value'.")
+
+        value: Literal = __literal(words[2], line, line_number, 2)
+        try:
+            return Variable.define(words[1], value, address, context)
+        except AssemblyError as e:
+            raise __locate(e, line, line_number, 1)
+
+    raise __syntax_error(line, line_number)
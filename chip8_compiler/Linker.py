@@ -0,0 +1,378 @@
+import json
+import os
+import sys
+from array import array
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from . import __version__
+from .Globals import AssemblyContext, PROGRAM_START
+from .Interfaces import LinkError
+from .Parser import assemble_relocatable, open_source
+from .Preprocessor import Preprocessor
+from .Program import Program, ADDRESS_SYMBOL_PREFIX, patch_fixups, write_atomically
+from .Types import Label
+
+# Separate assembly: relocatable object files and the linker.
+#
+# A source assembled into an object file (see assemble_object) keeps its
+# bytecode with every address field left empty, and the relocations filling
+# them in: the same fixup table a Program patches at the end of an assembly,
+# recorded for every label and __ADDR__ reference instead of only for the
+# forward references. The labels and variables the source defines are its
+# exports, the ones it uses without defining them are its imports.
+#
+# The linker lays the modules out one after the other from 0x200, in the given
+# order (so the first module holds the entry point), and patches the
+# relocations in a single pass over them.
+#
+# Object file layout: the magic, the 4-byte big-endian length of the header,
+# the header as JSON, the relocations (offsets, symbol indexes and fields, as
+# little-endian arrays), then the bytecode.
+
+OBJECT_MAGIC: bytes = b"C8O\x01"
+OBJECT_EXTENSION: str = ".c8o"
+
+LABEL_SYMBOL: str = "label"
+VARIABLE_SYMBOL: str = "variable"
+ADDRESS_SYMBOL: str = "address"
+
+
+def _little_endian(values: array) -> array:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+@dataclass
+class ObjectModule:
+    """
+    A relocatable module:
+        code: the bytecode, assembled at 0x200, with the address fields left empty
+        symbols: the (name, kind, value) of every symbol the relocations refer to. The value is the offset of a label
+                 (or an __ADDR__) in the module, the value of a variable, or None for the imports
+        relocation_offsets, relocation_symbols, relocation_fields: the relocations, as in the fixups of a Program
+        exported_labels: the offset of every label defined by the module
+        exported_variables: the value of every variable defined by the module
+        dependencies: the (path, mtime_ns, size) of the source and of the files it includes
+    """
+    code: bytes
+    symbols: list[tuple[str, str, int | None]]
+    relocation_offsets: array
+    relocation_symbols: array
+    relocation_fields: array
+    exported_labels: dict[str, int] = field(default_factory=dict)
+    exported_variables: dict[str, int] = field(default_factory=dict)
+    dependencies: list[tuple[str, int, int]] = field(default_factory=list)
+    version: str = __version__
+
+    @property
+    def size(self) -> int:
+        return len(self.code)
+
+    @property
+    def imports(self) -> list[str]:
+        return [name for name, _, value in self.symbols if value is None]
+
+    @staticmethod
+    def from_program(
+            program: Program,
+            context: AssemblyContext,
+            dependencies: Iterable[tuple[str, int, int]] = ()
+    ) -> 'ObjectModule':
+        """
+        Builds the module of a relocatable program (see assemble_relocatable) and the context it was assembled in
+        :param program: Program
+        :param context: AssemblyContext
+        :param dependencies: Iterable[tuple[str, int, int]]
+        :return: ObjectModule
+        """
+        symbols: list[tuple[str, str, int | None]] = []
+
+        for symbol in program.symbols:
+            if isinstance(symbol, Label):
+                kind: str = ADDRESS_SYMBOL if symbol.name.startswith(ADDRESS_SYMBOL_PREFIX) else LABEL_SYMBOL
+                offset: int | None = None if symbol.address is None else symbol.address - program.start
+                symbols.append((symbol.name, kind, offset))
+            else:
+                symbols.append((symbol.name, VARIABLE_SYMBOL, None if symbol.value is None else symbol.value.value))
+
+        return ObjectModule(
+            code=bytes(program.code),
+            symbols=symbols,
+            relocation_offsets=array("I", program.fixup_offsets),
+            relocation_symbols=array("i", program.fixup_symbols),
+            relocation_fields=array("H", program.fixup_fields),
+            exported_labels={
+                name: label.address - program.start
+                for name, label in context.labels.items()
+                if label.address is not None
+            },
+            exported_variables={
+                name: variable.value.value
+                for name, variable in context.variables.items()
+                if variable.address is not None
+            },
+            dependencies=list(dependencies)
+        )
+
+    def is_stale(self) -> bool:
+        """
+        Whether the module must be reassembled: it was assembled by another version, or its source or one of the
+        files it includes changed since
+        :return: bool
+        """
+        if self.version != __version__ or len(self.dependencies) == 0:
+            return True
+
+        for path, mtime_ns, size in self.dependencies:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return True
+            if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+                return True
+
+        return False
+
+    def to_bytes(self) -> bytes:
+        header: bytes = json.dumps({
+            "version": self.version,
+            "size": len(self.code),
+            "relocations": len(self.relocation_offsets),
+            "symbols": self.symbols,
+            "exports": {"labels": self.exported_labels, "variables": self.exported_variables},
+            "dependencies": self.dependencies
+        }, separators=(",", ":")).encode()
+
+        return b"".join([
+            OBJECT_MAGIC,
+            len(header).to_bytes(4, "big"),
+            header,
+            _little_endian(self.relocation_offsets).tobytes(),
+            _little_endian(self.relocation_symbols).tobytes(),
+            _little_endian(self.relocation_fields).tobytes(),
+            self.code
+        ])
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'ObjectModule':
+        """
+        Reads an object file. Raises a LinkError if it is not one
+        :param data: bytes
+        :return: ObjectModule
+        """
+        if data[:len(OBJECT_MAGIC)] != OBJECT_MAGIC:
+            raise LinkError("Not an object file")
+
+        try:
+            return ObjectModule.__decode(data)
+        except (KeyError, TypeError, ValueError) as e:
+            raise LinkError(f"Invalid object file: {type(e).__name__}: {e}") from None
+
+    @staticmethod
+    def __decode(data: bytes) -> 'ObjectModule':
+        # Decodes the header and the arrays after the magic, raising whatever an invalid one raises
+        position: int = len(OBJECT_MAGIC)
+        header_length: int = int.from_bytes(data[position:position + 4], "big")
+        position += 4
+
+        header: dict = json.loads(data[position:position + header_length])
+        position += header_length
+
+        relocations: list[array] = []
+        for typecode in ["I", "i", "H"]:
+            values: array = array(typecode)
+            length: int = header["relocations"] * values.itemsize
+            values.frombytes(data[position:position + length])
+            relocations.append(_little_endian(values))
+            position += length
+
+        code: bytes = data[position:position + header["size"]]
+        if len(code) != header["size"]:
+            raise ValueError("Truncated object file")
+
+        return ObjectModule(
+            code=code,
+            symbols=[tuple(symbol) for symbol in header["symbols"]],
+            relocation_offsets=relocations[0],
+            relocation_symbols=relocations[1],
+            relocation_fields=relocations[2],
+            exported_labels=header["exports"]["labels"],
+            exported_variables=header["exports"]["variables"],
+            dependencies=[tuple(dependency) for dependency in header["dependencies"]],
+            version=header["version"]
+        )
+
+    def write(self, file_path: str) -> None:
+        """
+        Writes the object file atomically, so a concurrent build never reads a partial one
+        :param file_path: str
+        :return:
+        """
+        write_atomically(file_path, self.to_bytes())
+
+    @staticmethod
+    def read(file_path: str) -> 'ObjectModule':
+        with open(file_path, "rb") as f:
+            return ObjectModule.from_bytes(f.read())
+
+
+def __dependency_stats(paths: Iterable[str]) -> list[tuple[str, int, int]]:
+    return [
+        (path, stat.st_mtime_ns, stat.st_size)
+        for path in paths
+        for stat in (os.stat(path),)
+    ]
+
+
+def assemble_object(file_path: str, preprocessor: Preprocessor | None = None, use_mmap: bool = False) -> ObjectModule:
+    """
+    Assembles the .mini8 file into a relocatable module. Raises an AssemblyError in case of invalid code
+    :param file_path: str
+    :param preprocessor: Preprocessor | None, see assemble
+    :param use_mmap: see open_source
+    :return: ObjectModule
+    """
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+
+    source_path: str = os.path.abspath(file_path)
+    # Taken before reading, so a change made while assembling makes the module stale
+    source_dependency: list[tuple[str, int, int]] = __dependency_stats([source_path])
+
+    context: AssemblyContext = AssemblyContext()
+    with open_source(file_path, use_mmap) as lines:
+        program: Program = assemble_relocatable(lines, context, preprocessor, source_path)
+
+    dependencies = source_dependency + __dependency_stats(sorted(preprocessor.graph.dependencies(source_path)))
+    return ObjectModule.from_program(program, context, dependencies)
+
+
+def link(modules: list[ObjectModule], start: int = PROGRAM_START) -> bytes:
+    """
+    Links the modules into a program: lays them out one after the other from the start address, and patches their
+    relocations. Raises a LinkError on duplicate or undefined symbols
+    :param modules: list[ObjectModule]
+    :param start: int
+    :return: bytes
+    """
+    bases: list[int] = []
+    address: int = start
+    for module in modules:
+        bases.append(address)
+        address += module.size
+
+    # The kind and value of every exported symbol
+    definitions: dict[str, tuple[str, int]] = {}
+    duplicates: set[str] = set()
+
+    for module, base in zip(modules, bases):
+        for exports, kind, offset in [
+            (module.exported_labels, LABEL_SYMBOL, base),
+            (module.exported_variables, VARIABLE_SYMBOL, 0)
+        ]:
+            for name, value in exports.items():
+                if name in definitions:
+                    duplicates.add(name)
+                definitions[name] = (kind, value + offset)
+
+    if duplicates:
+        raise LinkError(f"Symbols defined by more than one module: {', '.join(sorted(duplicates))}")
+
+    code: bytearray = bytearray()
+    undefined: set[str] = set()
+
+    for module, base in zip(modules, bases):
+        symbol_values: list[int] = []
+
+        for name, kind, value in module.symbols:
+            if value is not None:
+                symbol_values.append(value if kind == VARIABLE_SYMBOL else base + value)
+                continue
+
+            definition: tuple[str, int] | None = definitions.get(name, None)
+            if definition is None or definition[0] != kind:
+                undefined.add(name)
+                symbol_values.append(0)
+            else:
+                symbol_values.append(definition[1])
+
+        base_offset: int = len(code)
+        code += module.code
+        patch_fixups(
+            code, module.relocation_offsets, module.relocation_symbols, module.relocation_fields, symbol_values,
+            base_offset
+        )
+
+    if undefined:
+        raise LinkError(f"Undefined symbols: {', '.join(sorted(undefined))}")
+
+    return bytes(code)
+
+
+@dataclass
+class LinkResult:
+    """
+    The outcome of link_files: the linked bytecode, and the sources that had to be (re)assembled
+    """
+    bytecode: bytes
+    assembled: list[str] = field(default_factory=list)
+
+
+def object_path(source: str, object_dir: str | None = None) -> str:
+    """
+    The object file of a source: next to it, or in the object directory
+    :param source: str
+    :param object_dir: str | None
+    :return: str
+    """
+    name: str = os.path.splitext(os.path.basename(source))[0] + OBJECT_EXTENSION
+    return os.path.join(object_dir if object_dir is not None else os.path.dirname(source), name)
+
+
+def link_files(
+        paths: Iterable[str],
+        object_dir: str | None = None,
+        preprocessor: Preprocessor | None = None
+) -> LinkResult:
+    """
+    Links object files and sources, in the given order. The object file of a source is reused while it is up to date
+    (see ObjectModule.is_stale), otherwise the source is assembled again and its object file rewritten. Touching a
+    single source thus only reassembles that source before relinking
+    :param paths: Iterable[str], object files and .mini8 sources
+    :param object_dir: str | None, where the object files of the sources go (next to the sources by default)
+    :param preprocessor: Preprocessor | None, see assemble
+    :return: LinkResult
+    """
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+    if object_dir is not None:
+        os.makedirs(object_dir, exist_ok=True)
+
+    modules: list[ObjectModule] = []
+    assembled: list[str] = []
+
+    for path in paths:
+        if path.endswith(OBJECT_EXTENSION):
+            modules.append(ObjectModule.read(path))
+            continue
+
+        module_path: str = object_path(path, object_dir)
+        module: ObjectModule | None = None
+
+        if os.path.exists(module_path):
+            try:
+                module = ObjectModule.read(module_path)
+            except LinkError:
+                module = None
+
+        if module is None or module.is_stale():
+            module = assemble_object(path, preprocessor)
+            module.write(module_path)
+            assembled.append(path)
+
+        modules.append(module)
+
+    return LinkResult(bytecode=link(modules), assembled=assembled)
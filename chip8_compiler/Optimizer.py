@@ -0,0 +1,676 @@
+from bisect import bisect_right
+from dataclasses import dataclass, field
+
+from .Globals import AssemblyContext, PROGRAM_START
+from .Interfaces import Bytecode, InstructionEncoding, OptimizationError
+from .Types import AddressLiteral, Label, Literal, Variable, Instruction
+from ._ChipInstructions import LITERAL_KIND, NORMAL_REGISTER_KIND, get_encoding
+from .vm import MEMORY_SIZE, decode
+from .ControlFlow import ControlFlowGraph, _CALL, _INDIRECT_JUMP_RANGE, _JP, _JP_V0, _RET, _SKIP_COMMANDS
+from .DataLayout import pack
+
+# Peephole optimizer of the parsed instructions.
+#
+# Runs between parsing and encoding, over the raw opcodes of the context (the
+# assembly is not compacted, see Parser.py), and rewrites short runs of
+# instructions:
+#     dead_code:        instructions no flow from the entry reaches (see
+#                       ControlFlow.py) -> (removed)
+#     tail_call:        CALL x, RET      -> JP x
+#     jump_threading:   JP/CALL to a JP  -> JP/CALL to where that JP goes
+#     noop:             NOOP             -> (removed)
+#     jump_to_next:     JP to the next instruction -> (removed)
+#     redundant_load_i: LD I, a, LD I, b -> LD I, b
+# The rules run again until none applies. The labels, variables and __ADDR__
+# operands are then moved along with the code. Once done, the variables no
+# instruction references are dropped from the context.
+#
+# The data bytes ending the program (the data segment) are then packed:
+#     data_packing:     the runs of bytes between the labels of the data are
+#                       laid out sharing their common bytes (see
+#                       DataLayout.py), and their labels moved along
+# The labels I may hold are followed along the control flow, and every read
+# through I (DRW, LD Vx, [I]) must stay within the run of the label, up to the
+# next label. The data is left as is when a read may go past its run or read
+# from an address moved by ADD I, when the program writes to memory (LD B, Vx,
+# LD I, Vx), the shared bytes would change for every run, or when a label of
+# the data is used otherwise than by LD I, label.
+#
+# An instruction right after a skip (SE, SNE, SKP, SKNP) is never removed or
+# merged, the skip would then skip the next one. A RET with a label is kept,
+# it may be jumped to, and so are the instructions JP V0, addr may jump to.
+# Removing code moves everything after it, so nothing is removed when the
+# program references its own addresses by value (a literal address within the
+# program) - only the jumps are threaded. Dead code is kept when the program
+# loads the address of an instruction into I, it may be read as data.
+# A program too large for the memory is left as is, its addresses wrap.
+#
+# With verify set, the reachable control flow of the program before and after
+# is compared (see equivalent), and an OptimizationError raised if it differs.
+
+DEAD_CODE: str = "dead_code"
+TAIL_CALL: str = "tail_call"
+JUMP_THREADING: str = "jump_threading"
+NOOP: str = "noop"
+JUMP_TO_NEXT: str = "jump_to_next"
+REDUNDANT_LOAD_I: str = "redundant_load_i"
+DATA_PACKING: str = "data_packing"
+RULES: tuple[str, ...] = (DEAD_CODE, TAIL_CALL, JUMP_THREADING, NOOP, JUMP_TO_NEXT, REDUNDANT_LOAD_I, DATA_PACKING)
+
+_NOOP: tuple = ("NOOP", None, None, None)
+_LD_I: tuple = ("LD", "I", LITERAL_KIND, None)
+# The instructions writing to the memory at I
+_MEMORY_WRITES: frozenset[tuple] = frozenset([
+    ("LD", "I", NORMAL_REGISTER_KIND, None),
+    ("LD", "B", NORMAL_REGISTER_KIND, None)
+])
+_DRW: tuple = ("DRW", NORMAL_REGISTER_KIND, NORMAL_REGISTER_KIND, LITERAL_KIND)
+_ADD_I: tuple = ("ADD", "I", NORMAL_REGISTER_KIND, None)
+_LD_F: tuple = ("LD", "F", NORMAL_REGISTER_KIND, None)
+# I once moved by ADD I, see __data_kept
+_UNKNOWN_I: int = -1
+# The instructions reading the memory at I
+_MEMORY_READS: frozenset[tuple] = frozenset([_DRW, ("LD", NORMAL_REGISTER_KIND, "I", None)])
+# The instructions taking an address, and the operand holding it
+_ADDRESS_OPERANDS: dict[tuple, int] = {_JP: 0, _CALL: 0, _LD_I: 1, _JP_V0: 1}
+
+
+def _key(encoding: InstructionEncoding) -> tuple:
+    return encoding.command, *encoding.shape
+
+
+def _operand(instruction: Instruction, index: int):
+    return instruction.operand1 if index == 0 else instruction.operand2
+
+
+@dataclass
+class OptimizationReport:
+    """
+    What the optimizer did: how many times every rule applied and the bytes it saved
+    """
+    size_before: int = 0
+    size_after: int = 0
+    rewrites: dict[str, int] = field(default_factory=lambda: dict.fromkeys(RULES, 0))
+    bytes_saved: dict[str, int] = field(default_factory=lambda: dict.fromkeys(RULES, 0))
+    # Why only the jumps were threaded, if so
+    restricted: str | None = None
+    # Why nothing was done, if so
+    skipped: str | None = None
+    # Why the dead code was kept, if so
+    dead_code_kept: str | None = None
+    # Why the data was not packed, if so
+    data_kept: str | None = None
+    # The variables no instruction references, dropped
+    removed_variables: list[str] = field(default_factory=list)
+    # Whether the control flow was checked, see Optimizer
+    verified: bool = False
+
+    def format(self) -> str:
+        lines: list[str] = [f"{'rule':<18}{'rewrites':>10}{'bytes saved':>13}"]
+        for rule in RULES:
+            lines.append(f"{rule:<18}{self.rewrites[rule]:>10}{self.bytes_saved[rule]:>13}")
+        lines.append(f"{'total':<18}{sum(self.rewrites.values()):>10}{self.size_before - self.size_after:>13}")
+        lines.append(f"{self.size_before} -> {self.size_after} bytes{', verified' if self.verified else ''}")
+        if self.removed_variables:
+            lines.append(f"Unreferenced variables dropped: {', '.join(self.removed_variables)}")
+        if self.skipped is not None:
+            lines.append(f"Not optimized: {self.skipped}")
+        elif self.restricted is not None:
+            lines.append(f"Only the jumps were threaded: {self.restricted}")
+        elif self.dead_code_kept is not None:
+            lines.append(f"Dead code kept: {self.dead_code_kept}")
+        if self.skipped is None and self.restricted is None and self.data_kept is not None:
+            lines.append(f"Data not packed: {self.data_kept}")
+        return "\n".join(lines)
+
+    def __str__(self) -> str:
+        return self.format()
+
+
+class Optimizer:
+    """
+    The peephole optimizer, given to the assembly functions of Parser.py. The report of the last assembly it optimized
+    is kept in report
+    """
+
+    def __init__(self, rules: tuple[str, ...] = RULES, verify: bool = False):
+        """
+        :param rules: tuple[str, ...], the rules to apply, see RULES
+        :param verify: bool, whether to check the control flow of the optimized program against the original one
+        """
+        unknown: set[str] = set(rules) - set(RULES)
+        if unknown:
+            raise ValueError(f"Unknown optimization rules: {', '.join(sorted(unknown))}")
+
+        self.rules: frozenset[str] = frozenset(rules)
+        self.verify: bool = verify
+        self.report: OptimizationReport | None = None
+
+    def optimize(self, context: AssemblyContext, start: int = PROGRAM_START) -> OptimizationReport:
+        """
+        Rewrites the raw opcodes of the context in place, moving its labels and variables along. Every symbol must be
+        resolved
+        :param context: AssemblyContext
+        :param start: int, the address of the first opcode
+        :return: OptimizationReport
+        """
+        items: list[Bytecode] = context.raw_opcodes
+        report: OptimizationReport = OptimizationReport()
+        report.size_before = sum(item.byte_length() for item in items)
+        report.size_after = report.size_before
+        self.report = report
+
+        if start + report.size_before > MEMORY_SIZE:
+            report.skipped = f"the program does not fit in memory ({report.size_before} bytes)"
+            return report
+
+        original: bytes | None = _encode(items) if self.verify else None
+        # The data segment: the data bytes after the last instruction
+        data_index: int = len(items)
+        while data_index > 0 and items[data_index - 1].__class__ is Literal:
+            data_index -= 1
+        data: list[Bytecode] = items[data_index:]
+        data_lengths: dict[int, int] = _run_lengths(
+            context, start + report.size_before - len(data), start + report.size_before
+        )
+
+        report.restricted = self.__self_referencing(items, start, start + report.size_before)
+        removing: bool = report.restricted is None
+
+        while True:
+            changed: bool = False
+            if JUMP_THREADING in self.rules:
+                changed |= self.__thread_jumps(items, report)
+            if removing and DEAD_CODE in self.rules:
+                changed |= self.__remove(items, self.__dead_code(items, start, report), context, start)
+            if removing:
+                changed |= self.__remove(items, self.__peephole(items, context, start, report), context, start)
+            if not changed:
+                break
+
+        if DEAD_CODE in self.rules:
+            report.removed_variables = self.__drop_unreferenced_variables(items, context)
+        if removing and data and DATA_PACKING in self.rules:
+            self.__pack_data(items, len(items) - len(data), context, start, report)
+
+        report.size_after = sum(item.byte_length() for item in items)
+
+        if original is not None:
+            difference: str | None = equivalent(original, _encode(items), start, data_lengths)
+            if difference is not None:
+                raise OptimizationError(f"The optimized program does not behave as the original one: {difference}")
+            report.verified = True
+
+        return report
+
+    @staticmethod
+    def __self_referencing(items: list[Bytecode], start: int, end: int) -> str | None:
+        # Why the program cannot move, None if it can
+        for item in items:
+            if item.__class__ is not Instruction:
+                continue
+
+            index: int | None = _ADDRESS_OPERANDS.get(_key(item.encoding), None)
+            if index is None:
+                continue
+            operand = _operand(item, index)
+            if operand.__class__ in (Label, AddressLiteral):
+                continue
+            if start <= operand.operand_value() <= end:
+                return f"address 0x{operand.operand_value():X} given by value at 0x{item.address:X}"
+
+        return None
+
+    @staticmethod
+    def __thread_jumps(items: list[Bytecode], report: OptimizationReport) -> bool:
+        # The JPs to labels, by address
+        jumps: dict[int, Instruction] = {
+            item.address: item
+            for item in items
+            if item.__class__ is Instruction and _key(item.encoding) == _JP and item.operand1.__class__ is Label
+        }
+        changed: bool = False
+
+        for item in items:
+            if item.__class__ is not Instruction or _key(item.encoding) not in (_JP, _CALL):
+                continue
+            label = item.operand1
+            if label.__class__ is not Label:
+                continue
+
+            target: Label = label
+            seen: set[int] = {item.address}
+            while target.address in jumps and target.address not in seen:
+                seen.add(target.address)
+                target = jumps[target.address].operand1
+
+            if target is not label and target.address != label.address:
+                item.operand1 = target
+                report.rewrites[JUMP_THREADING] += 1
+                changed = True
+
+        return changed
+
+    def __peephole(
+            self,
+            items: list[Bytecode],
+            context: AssemblyContext,
+            start: int,
+            report: OptimizationReport
+    ) -> list[Bytecode]:
+        labeled: set[int] = {label.address for label in context.labels.values()}
+        # The instructions JP V0, addr may jump to, where nothing may move
+        protected: set[int] = set()
+        for item in items:
+            if item.__class__ is Instruction and _key(item.encoding) == _JP_V0:
+                base: int = item.operand2.operand_value()
+                protected.update(range(base, base + _INDIRECT_JUMP_RANGE))
+
+        kept: list[Bytecode] = []
+        address: int = start
+        index: int = 0
+
+        while index < len(items):
+            item: Bytecode = items[index]
+            following: Bytecode | None = items[index + 1] if index + 1 < len(items) else None
+            previous: Bytecode | None = items[index - 1] if index > 0 else None
+            address_after: int = address + item.byte_length()
+            index += 1
+
+            if item.__class__ is not Instruction or address in protected or address_after in protected or (
+                    previous.__class__ is Instruction and previous.command in _SKIP_COMMANDS
+            ):
+                kept.append(item)
+                address = address_after
+                continue
+
+            key: tuple = _key(item.encoding)
+            following_key: tuple | None = _key(following.encoding) if following.__class__ is Instruction else None
+            rule: str | None = None
+
+            if key == _NOOP:
+                rule = NOOP
+            elif key == _JP and item.operand1.operand_value() == address_after:
+                rule = JUMP_TO_NEXT
+            elif key == _LD_I and following_key == _LD_I:
+                rule = REDUNDANT_LOAD_I
+            elif key == _CALL and following_key == _RET and address_after not in labeled and TAIL_CALL in self.rules:
+                item.command, item.encoding = "JP", get_encoding(*_JP)
+                kept.append(item)
+                report.rewrites[TAIL_CALL] += 1
+                report.bytes_saved[TAIL_CALL] += following.byte_length()
+                # The RET goes
+                index += 1
+                address = address_after + following.byte_length()
+                continue
+
+            if rule is None or rule not in self.rules:
+                kept.append(item)
+            else:
+                report.rewrites[rule] += 1
+                report.bytes_saved[rule] += item.byte_length()
+            address = address_after
+
+        return kept
+
+    @staticmethod
+    def __dead_code(items: list[Bytecode], start: int, report: OptimizationReport) -> list[Bytecode]:
+        # The items left once the unreachable instructions are removed
+        graph: ControlFlowGraph = ControlFlowGraph(items, start)
+        dead: list[int] = graph.unreachable_instructions()
+        if not dead:
+            return items
+
+        report.dead_code_kept = graph.unresolved
+        for item in items:
+            if item.__class__ is Instruction and _key(item.encoding) == _LD_I:
+                index: int | None = graph.index_at(item.operand2.operand_value())
+                if index is not None and items[index].__class__ is Instruction:
+                    report.dead_code_kept = f"the instruction at 0x{graph.addresses[index]:X} is loaded into I"
+                    break
+        if report.dead_code_kept is not None:
+            return items
+
+        report.rewrites[DEAD_CODE] += len(dead)
+        report.bytes_saved[DEAD_CODE] += sum(items[index].byte_length() for index in dead)
+        dead_indexes: set[int] = set(dead)
+        return [item for index, item in enumerate(items) if index not in dead_indexes]
+
+    @staticmethod
+    def __drop_unreferenced_variables(items: list[Bytecode], context: AssemblyContext) -> list[str]:
+        referenced: set[str] = {
+            operand.name
+            for item in items
+            if item.__class__ is Instruction
+            for operand in (item.operand1, item.operand2, item.optional_operand)
+            if operand.__class__ is Variable
+        }
+        removed: list[str] = [name for name in context.variables if name not in referenced]
+        for name in removed:
+            del context.variables[name]
+        return removed
+
+    @staticmethod
+    def __data_kept(items: list[Bytecode], context: AssemblyContext, start: int, lengths: dict[int, int]) -> str | None:
+        # Why the data cannot be packed, None if it can. Every read from memory must stay within the run of the label
+        # loaded into I: the labels I may hold are followed along the control flow (see ControlFlow.py)
+        for item in items:
+            if item.__class__ is not Instruction:
+                continue
+            key: tuple = _key(item.encoding)
+            if key in _MEMORY_WRITES:
+                return f"the instruction at 0x{item.address:X} writes to memory"
+            for index, operand in enumerate((item.operand1, item.operand2, item.optional_operand)):
+                if operand.__class__ is Label and operand.address in lengths and (key != _LD_I or index != 1):
+                    return f"the label {operand.name} is used by the instruction at 0x{item.address:X}"
+
+        graph: ControlFlowGraph = ControlFlowGraph(items, start)
+        if graph.unresolved is not None:
+            return graph.unresolved
+
+        # The runs I may point to before every item reached, by their address (_UNKNOWN_I once ADD I moved it)
+        states: dict[int, frozenset[int]] = {0: frozenset()} if items else {}
+        # The runs I may point to when a subroutine returns, to every CALL
+        returned: frozenset[int] = frozenset()
+        calls: list[int] = []
+        pending: list[int] = list(states)
+
+        while pending:
+            index: int = pending.pop()
+            item: Bytecode = items[index]
+            state: frozenset[int] = states[index]
+            successors: list[int] = graph.item_successors(index)
+            after_call: int | None = None
+
+            if item.__class__ is Instruction:
+                key = _key(item.encoding)
+                if key in _MEMORY_READS:
+                    read: int = (
+                        item.optional_operand.operand_value() if key == _DRW else item.operand1.operand_value() + 1
+                    )
+                    for address in state:
+                        if address == _UNKNOWN_I:
+                            return f"the instruction at 0x{item.address:X} reads from an address moved by ADD I"
+                        if read > lengths[address]:
+                            return f"the instruction at 0x{item.address:X} reads {read} bytes from 0x{address:X}"
+
+                if key == _LD_I:
+                    address = item.operand2.address if item.operand2.__class__ is Label else None
+                    state = frozenset([address]) if address in lengths else frozenset()
+                elif key == _LD_F:
+                    state = frozenset()
+                elif key == _ADD_I:
+                    state = frozenset([_UNKNOWN_I])
+                elif key == _RET and not state <= returned:
+                    # Every return site gets the runs again
+                    returned |= state
+                    pending.extend(calls)
+                elif key == _CALL and index + 1 < len(items):
+                    if index not in calls:
+                        calls.append(index)
+                    after_call = index + 1
+
+            for successor in successors:
+                # Past a CALL, I is either as before the call, or as the subroutine left it
+                reached: frozenset[int] = state | returned if successor == after_call else state
+                previous: frozenset[int] | None = states.get(successor, None)
+                if previous is None or not reached <= previous:
+                    states[successor] = reached if previous is None else previous | reached
+                    pending.append(successor)
+
+        return None
+
+    def __pack_data(
+            self,
+            items: list[Bytecode],
+            data_index: int,
+            context: AssemblyContext,
+            start: int,
+            report: OptimizationReport
+    ) -> None:
+        data_start: int = start + sum(item.byte_length() for item in items[:data_index])
+        data_end: int = data_start + len(items) - data_index
+        # The runs start at the labels, the bytes before the first one stay first
+        lengths: dict[int, int] = _run_lengths(context, data_start, data_end)
+        if not lengths:
+            return
+        report.data_kept = self.__data_kept(items, context, start, lengths)
+        if report.data_kept is not None:
+            return
+
+        boundaries: list[int] = list(lengths)
+        data: bytes = _encode(items[data_index:])
+        runs: list[bytes] = [
+            data[address - data_start:address - data_start + lengths[address]] for address in boundaries
+        ]
+        head: bytes = data[:boundaries[0] - data_start]
+        block, offsets = pack(runs)
+        if len(block) >= len(data) - len(head):
+            return
+
+        # Every byte of a run moves with it
+        packed_start: int = data_start + len(head)
+        for symbol in (*context.labels.values(), *context.variables.values()):
+            if symbol.address == data_end:
+                symbol.address = packed_start + len(block)
+            elif packed_start <= symbol.address < data_end:
+                run: int = bisect_right(boundaries, symbol.address) - 1
+                symbol.address = packed_start + offsets[run] + symbol.address - boundaries[run]
+
+        # The runs laid out on bytes of another run
+        coverage: list[int] = [0] * len(block)
+        for run, offset in zip(runs, offsets):
+            for position in range(offset, offset + len(run)):
+                coverage[position] += 1
+        report.rewrites[DATA_PACKING] += sum(
+            1
+            for run, offset in zip(runs, offsets)
+            if any(coverage[position] > 1 for position in range(offset, offset + len(run)))
+        )
+        report.bytes_saved[DATA_PACKING] += len(data) - len(head) - len(block)
+        items[data_index:] = [*items[data_index:data_index + len(head)], *(Literal(value=value) for value in block)]
+
+    def __remove(self, items: list[Bytecode], kept: list[Bytecode], context: AssemblyContext, start: int) -> bool:
+        # Keeps only the kept items, moving the symbols along. Returns whether anything was removed
+        if len(kept) == len(items):
+            return False
+        self.__move_symbols(items, kept, context, start)
+        items[:] = kept
+        return True
+
+    @staticmethod
+    def __move_symbols(items: list[Bytecode], kept: list[Bytecode], context: AssemblyContext, start: int) -> None:
+        # The new address of every old address: the removed items go where the next kept one goes
+        kept_ids: set[int] = {id(item) for item in kept}
+        moved: dict[int, int] = {}
+        old_address: int = start
+        new_address: int = start
+
+        for item in items:
+            moved[old_address] = new_address
+            old_address += item.byte_length()
+            if id(item) in kept_ids:
+                new_address += item.byte_length()
+        moved[old_address] = new_address
+
+        for item in kept:
+            if item.__class__ is not Instruction:
+                continue
+            item.address = moved[item.address]
+            for operand in (item.operand1, item.operand2, item.optional_operand):
+                if operand.__class__ is AddressLiteral:
+                    operand.value = item.address
+
+        for symbol in (*context.labels.values(), *context.variables.values()):
+            symbol.address = moved.get(symbol.address, symbol.address)
+
+
+def _run_lengths(context: AssemblyContext, data_start: int, data_end: int) -> dict[int, int]:
+    # The length of the run of data at every label of the data, up to the next label
+    boundaries: list[int] = sorted({
+        label.address for label in context.labels.values() if data_start <= label.address < data_end
+    })
+    return {
+        address: (boundaries[index + 1] if index + 1 < len(boundaries) else data_end) - address
+        for index, address in enumerate(boundaries)
+    }
+
+
+def _encode(items: list[Bytecode]) -> bytes:
+    code: bytearray = bytearray()
+    for item in items:
+        code += item.to_bytes()
+    return bytes(code)
+
+
+def __decode(code: bytes, start: int, address: int) -> tuple[int, tuple | None] | None:
+    # The opcode at the address and the key of its instruction, None out of the program
+    offset: int = address - start
+    if not 0 <= offset <= len(code) - 2:
+        return None
+    opcode: int = code[offset] << 8 | code[offset + 1]
+    encoding: InstructionEncoding | None = decode(opcode)
+    return opcode, None if encoding is None else _key(encoding)
+
+
+def __follow(code: bytes, start: int, address: int) -> int:
+    # Where the flow goes from the address, through NOOPs and jumps
+    seen: set[int] = set()
+    while address not in seen:
+        seen.add(address)
+        decoded = __decode(code, start, address)
+        if decoded is None:
+            return address
+        opcode, key = decoded
+        if key == _NOOP:
+            address += 2
+        elif key == _JP:
+            address = opcode & 0xFFF
+        else:
+            return address
+    return -1
+
+
+def __normalize(code: bytes, start: int, address: int) -> int:
+    # The next instruction with an effect: past NOOPs, jumps, tail calls and loads of I overwritten right away. -1 for
+    # an endless loop of jumps
+    seen: set[int] = set()
+    while address not in seen:
+        seen.add(address)
+        address = __follow(code, start, address)
+        decoded = __decode(code, start, address)
+        if decoded is None:
+            return address
+        opcode, key = decoded
+
+        if key == _CALL or key == _LD_I:
+            following: tuple[int, tuple | None] | None = __decode(code, start, __follow(code, start, address + 2))
+            following_key: tuple | None = None if following is None else following[1]
+            if key == _CALL and following_key == _RET:
+                address = opcode & 0xFFF
+                continue
+            if key == _LD_I and following_key == _LD_I:
+                address = __follow(code, start, address + 2)
+                continue
+
+        return address
+    return -1
+
+
+def __read(code: bytes, start: int, address: int, length: int) -> bytes:
+    # The bytes at the address, the memory past the program being zeros. The memory before it is the same for every
+    # program, none of it is returned
+    if address < start:
+        return b""
+    data: bytes = code[address - start:address - start + length]
+    return data + bytes(min(length, MEMORY_SIZE - address) - len(data))
+
+
+def equivalent(
+        before: bytes,
+        after: bytes,
+        start: int = PROGRAM_START,
+        data_lengths: dict[int, int] | None = None
+) -> str | None:
+    """
+    Compares the control flow of two programs, from their entry point: every path through the first one must run the
+    same instructions as through the second one, once the NOOPs, jumps and dead loads of I are left out and the tail
+    calls taken for jumps. The addresses loaded into I are followed along the paths, and every read through I (DRW,
+    LD Vx, [I]) must read the same bytes. Once moved by ADD I, the reads compare the bytes at the address loaded (16
+    of them, or as many as given for the address in data_lengths). I is not followed past a CALL, and JP V0, addr is
+    followed to addr only. Returns None if the programs are equivalent, what differs otherwise
+    :param before: bytes
+    :param after: bytes
+    :param start: int, the address of the programs
+    :param data_lengths: dict[int, int] | None, how many bytes ADD I may reach from the addresses of the first program
+    :return: str | None
+    """
+    # The flow: (address before, address after, I), I being the addresses loaded before and after, and whether ADD I
+    # moved them, or None when unknown
+    pending: list[tuple[int, int, tuple[int, int, bool] | None]] = [(start, start, (0, 0, False))]
+    seen: set[tuple[int, int, tuple[int, int, bool] | None]] = set()
+    # Where every address loaded into I went
+    data_addresses: dict[int, int] = {}
+
+    while pending:
+        address_before, address_after, i = pending.pop()
+        address_before = __normalize(before, start, address_before)
+        address_after = __normalize(after, start, address_after)
+        if (address_before, address_after, i) in seen:
+            continue
+        seen.add((address_before, address_after, i))
+
+        where: str = f"0x{address_before:X} (0x{address_after:X} after)"
+        if (address_before == -1) != (address_after == -1):
+            return f"an endless loop of jumps at {where}"
+        if address_before == -1:
+            continue
+
+        decoded_before = __decode(before, start, address_before)
+        decoded_after = __decode(after, start, address_after)
+        if decoded_before is None or decoded_after is None:
+            if decoded_before != decoded_after:
+                return f"the program is left at {where}"
+            continue
+
+        (opcode_before, key), (opcode_after, key_after) = decoded_before, decoded_after
+        if key != key_after:
+            return f"{key[0] if key else 'data'} becomes {key_after[0] if key_after else 'data'} at {where}"
+
+        if key in (_CALL, _LD_I, _JP_V0):
+            target_before, target_after = opcode_before & 0xFFF, opcode_after & 0xFFF
+            if opcode_before & 0xF000 != opcode_after & 0xF000:
+                return f"different operands at {where}"
+        elif opcode_before != opcode_after:
+            return f"different operands at {where}"
+
+        if key == _RET or key is None:
+            continue
+        if key == _CALL:
+            pending.append((target_before, target_after, i))
+            i = None
+        elif key == _JP_V0:
+            # Where it goes depends on V0, only the base address is followed
+            pending.append((target_before, target_after, i))
+            continue
+        elif key == _LD_I:
+            if data_addresses.setdefault(target_before, target_after) != target_after:
+                return f"0x{target_before:X} moves to several addresses, at {where}"
+            i = (target_before, target_after, False)
+        elif key == _LD_F:
+            i = None
+        elif key == _ADD_I and i is not None:
+            i = (i[0], i[1], True)
+        elif key in _MEMORY_READS and i is not None:
+            i_before, i_after, moved = i
+            length: int = (opcode_before & 0xF) if key == _DRW else (opcode_before >> 8 & 0xF) + 1
+            if moved:
+                length = 16 if data_lengths is None else data_lengths.get(i_before, 16)
+            if __read(before, start, i_before, length) != __read(after, start, i_after, length):
+                return f"different data read at {where}, from 0x{i_before:X} (0x{i_after:X} after)"
+
+        pending.append((address_before + 2, address_after + 2, i))
+        if key[0] in _SKIP_COMMANDS:
+            pending.append((address_before + 4, address_after + 4, i))
+
+    return None
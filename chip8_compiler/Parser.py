@@ -1,3 +1,7 @@
+import mmap
+from contextlib import contextmanager, nullcontext
+from typing import TYPE_CHECKING, Iterable, Iterator
+
 from .Tokens import Tokens
 from .Types import (
     Literal,
@@ -5,185 +9,545 @@ from .Types import (
     Variable,
     Instruction
 )
-from .Globals import (
-    variables_instance,
-    labels_instance,
-    raw_opcodes_instance
+from .Globals import AssemblyContext
+from .Program import Program, _is_resolved
+from .Lexer import parse_item
+from .Preprocessor import Preprocessor
+
+from .Interfaces import (
+    AssemblyError,
+    InvalidCodeError,
+    Bytecode
 )
 
-from .Interfaces import Bytecode
+# Only needed by the instrumented and the optimized assemblies
+if TYPE_CHECKING:
+    from .Optimizer import Optimizer
+    from .Stats import AssemblyStats
 
 # Steps:
-# 1. Load code and remove comments
-# 2. Parse lines of code into instructions
+# 1. Stream the lines of code and remove comments
+# 1.5. Expand the includes and the macros (see Preprocessor.py)
+# 2. Track the current segment and parse each line into instructions
 # 3. Convert instructions into byecode
-
-# Global address
-CURRENT_ADDR: int = 0x200
-
-
-def __remove_comments(code: str) -> str:
+#
+# Everything up to the bytecode conversion happens in a single pass over the
+# source, so the source is never held in memory as a whole.
+#
+# All the state of an assembly lives in its AssemblyContext, so separate
+# assemblies can run concurrently.
+
+# The segments that get assembled, in the order they are laid out in memory
+SEGMENTS: tuple[str, ...] = ("code", "data")
+# The line opening every segment
+SEGMENT_HEADERS: dict[str, str] = {
+    f"{Tokens.SEGMENT_BEGIN_TOKEN} {segment}{Tokens.DECLARATION_END_TOKEN}": segment
+    for segment in SEGMENTS
+}
+# The parsed items that emit bytes (checked by class, isinstance on an ABC is slow)
+_BYTECODE_TYPES: frozenset[type] = frozenset([Instruction, Literal])
+
+
+def strip_comments(lines: Iterable[str]) -> Iterator[tuple[int, str]]:
     """
-    Removes the comments from the .chip8 file. Comments are defined by the ";" token
-    :param code: str
-    :return: list[str]
+    Lazily removes the comments and the blank lines from the source. Comments are defined by the ";" token.
+    Yields the (1-based) line number alongside the remaining code
+    :param lines: Iterable[str]
+    :return: Iterator[tuple[int, str]]
     """
-    code: list[str] = code.splitlines()
-    new_code: list[str] = []
+    comment_token: str = Tokens.COMMENT_TOKEN
 
-    for line in code:
+    for line_number, line in enumerate(lines, start=1):
         line = line.strip()
         if line == "":
             continue
 
-        if Tokens.COMMENT_TOKEN not in line:
-            new_code.append(line)
+        if comment_token not in line:
+            yield line_number, line
             continue
 
         # If the whole line is a comment
-        if line[0] == Tokens.COMMENT_TOKEN:
+        if line[0] == comment_token:
             # Skip the line
             continue
 
-        final_index: int = line.index(Tokens.COMMENT_TOKEN)
-        line = line[:final_index].strip()
+        final_index: int = line.index(comment_token)
+        yield line_number, line[:final_index].strip()
 
-        new_code.append(line)
 
-    return "\n".join(new_code)
+def iter_buffer_lines(buffer) -> Iterator[str]:
+    """
+    Lazily yields the lines of a bytes-like buffer of source code (e.g. an mmap of a file), one line per source line.
+    The comments are cut off before decoding, so only the code gets decoded; blank and comment-only lines are yielded
+    as empty strings
+    :param buffer: bytes-like
+    :return: Iterator[str]
+    """
+    comment_token: bytes = Tokens.COMMENT_TOKEN.encode()
+    length: int = len(buffer)
 
+    start: int = 0
+    while start < length:
+        end: int = buffer.find(b"\n", start)
+        if end == -1:
+            end = length
 
-def __parse_code_segment(code: str):
-    global CURRENT_ADDR
+        comment_index: int = buffer.find(comment_token, start, end)
+        code_end: int = end if comment_index == -1 else comment_index
 
-    code_lines: list[str] = code.splitlines()
+        # Only the code part of the line is copied out of the buffer
+        yield buffer[start:code_end].decode().strip()
+        start = end + 1
 
-    for line in code_lines:
 
-        # print("CURRENT LINE:", line)
+@contextmanager
+def open_source(file_path: str, use_mmap: bool = False) -> Iterator[Iterable[str]]:
+    """
+    Opens a source file as an iterable of lines. With use_mmap set, the file is memory-mapped and scanned as bytes
+    instead of being read through a text buffer (see iter_buffer_lines)
+    :param file_path: str
+    :param use_mmap: bool
+    :return: Iterator[Iterable[str]]
+    """
+    if not use_mmap:
+        with open(file_path, "r") as f:
+            yield f
+        return
 
-        # Try to get an instruction
-        # If the line is an instruction
-        curr_instr = Instruction.parse_definition(line, CURRENT_ADDR) or \
-                     Label.parse_definition(line, CURRENT_ADDR) or \
-                     Variable.parse_definition(line, CURRENT_ADDR) or \
-                     Literal.parse_value(line)
+    with open(file_path, "rb") as f:
+        try:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            yield iter(())
+            return
 
-        # Shouldn't be None
-        if curr_instr is None:
-            raise Exception("Invalid syntax present! "
-                            f"Line in question: {line}")
-        # Add the address
-        if isinstance(curr_instr, Bytecode):
-            codes = raw_opcodes_instance()
-            codes.append(curr_instr)
+        with mapped_file:
+            yield iter_buffer_lines(mapped_file)
 
-            # Increment the current address of the program
-            CURRENT_ADDR += curr_instr.byte_length()
 
-        # print("CURRENT ADDR: ", hex(CURRENT_ADDR))
+def segment_lines(lines: Iterable[tuple[int, str]]) -> Iterator[tuple[int, str]]:
+    """
+    Yields the lines of the segments, in the order given by SEGMENTS. Only the first occurrence of every segment is
+    used and the lines outside of segments are ignored.
 
+    The code segment is expected to come first. In case the data segment comes before it, the data lines are held back
+    until the code segment is done.
 
-def __parse_code(code: str) -> bool:
-    """
-    Function parses the code into Segments and Instructions. Returns True if code is parsable, False otherwise
-    :param code:
-    :return: bool
+    Raises an InvalidCodeError in case a segment is missing or not terminated.
+    :param lines: Iterable[tuple[int, str]]
+    :return: Iterator[tuple[int, str]]
     """
+    for _, line_number, line in iter_segments(lines):
+        yield line_number, line
 
-    # Remove comments
-    code = __remove_comments(code)
 
-    # print(code)
+def iter_segments(lines: Iterable[tuple[int, str]]) -> Iterator[tuple[str, int, str]]:
+    """
+    Yields the lines of the segments along with their segment: (segment, line number, code), see segment_lines
+    :param lines: Iterable[tuple[int, str]]
+    :return: Iterator[tuple[str, int, str]]
+    """
+    headers: dict[str, str] = SEGMENT_HEADERS
+    segment_end: str = Tokens.SEGMENT_END_TOKEN
+
+    # Index of the next segment to be emitted
+    next_segment: int = 0
+    current_segment: str | None = None
+    # The line of the header of the current segment
+    segment_line: int = 0
+    held_back: dict[str, list[tuple[str, int, str]]] = {}
+
+    def release_held_back() -> Iterator[tuple[str, int, str]]:
+        nonlocal next_segment
+        while next_segment < len(SEGMENTS) and SEGMENTS[next_segment] in held_back:
+            yield from held_back.pop(SEGMENTS[next_segment])
+            next_segment += 1
+
+    for line_number, line in lines:
+        if current_segment is None:
+            segment: str | None = headers.get(line, None)
+
+            # Only the first occurrence of a segment is assembled
+            if segment is not None and segment not in held_back and SEGMENTS.index(segment) >= next_segment:
+                current_segment, segment_line = segment, line_number
+                if segment != SEGMENTS[next_segment]:
+                    held_back[segment] = []
+            continue
 
-    # print(code)
+        if line == segment_end:
+            if current_segment == SEGMENTS[next_segment]:
+                next_segment += 1
+                yield from release_held_back()
+            current_segment = None
+            continue
 
-    def __get_segment_code(segment: str) -> str:
-        code_lines = code.splitlines()
-        seg_start = code_lines.index(f"{Tokens.SEGMENT_BEGIN_TOKEN} {segment}{Tokens.DECLARATION_END_TOKEN}")
-        seg_end = code_lines[seg_start + 1:].index(Tokens.SEGMENT_END_TOKEN)
-        return "\n".join(code_lines[seg_start + 1:seg_start + seg_end + 1])
+        if current_segment == SEGMENTS[next_segment]:
+            yield current_segment, line_number, line
+        else:
+            held_back[current_segment].append((current_segment, line_number, line))
 
-    code_segment_code: str = ""
-    try:
-        code_segment_code = __get_segment_code("code")
-    except ValueError as e:
-        print(e)
-        return False
+    if current_segment is not None:
+        raise InvalidCodeError(f"Segment '{current_segment}' is missing its '{segment_end}'", line=segment_line)
 
-    # print(code_segment_code)
+    if next_segment < len(SEGMENTS):
+        raise InvalidCodeError(f"Segment '{SEGMENTS[next_segment]}' is missing")
 
-    # Parse the code group
-    __parse_code_segment(code=code_segment_code)
 
-    # Set the data segment
-    data_segment_code: str = ""
-    try:
-        data_segment_code = __get_segment_code("data")
-    except ValueError as e:
-        print(e)
-        return False
+def add_item(item: Bytecode | Label | Variable, context: AssemblyContext) -> None:
+    """
+    Adds a parsed item to the context. Labels and variables are added to the symbol tables while parsing, only the
+    bytecode is added here
+    :param item: Bytecode | Label | Variable
+    :param context: AssemblyContext
+    :return:
+    """
+    # Add the address
+    if item.__class__ in _BYTECODE_TYPES:
+        if context.program is not None:
+            context.program.append(item)
+        else:
+            context.raw_opcodes.append(item)
 
-    # Parse the data
-    __parse_code_segment(code=data_segment_code)
+        # Increment the current address of the program
+        context.current_addr += item.byte_length()
 
-    # Final check on labels, variables, to see if they have an address
-    variables = variables_instance()
-    labels = labels_instance()
 
-    # print("VARIABLES: ", variables)
-    # print("LABELS: ", labels)
+def parse_line(line: str, context: AssemblyContext, line_number: int = 0) -> None:
+    """
+    Parses a single line of code (without comments) at the current address of the context, adding the parsed item to
+    the context. Raises an AssemblyError in case of invalid syntax
+    :param line: str
+    :param context: AssemblyContext
+    :param line_number: int, for the error messages
+    :return:
+    """
+    add_item(parse_item(line, context, line_number), context)
+
 
-    for _, variable in variables.items():
+def __check_symbols(context: AssemblyContext) -> None:
+    # Final check on labels, variables, to see if they have an address
+    for name, variable in context.variables.items():
         if variable.address is None:
-            return False
+            raise InvalidCodeError(f"Variable '{name}' is never defined")
 
-    for _, label in labels.items():
+    for name, label in context.labels.items():
         if label.address is None:
-            return False
+            raise InvalidCodeError(f"Label '{name}' is never defined")
 
-    return True
 
-
-def __reset_instances() -> None:
+def __parse_code(
+        lines: Iterable[str],
+        context: AssemblyContext,
+        preprocessor: Preprocessor,
+        source_path: str | None,
+        check_symbols: bool = True
+) -> None:
     """
-    Resets all prior instances of variables
+    Function parses the code into Segments and Instructions, in a single pass over the lines.
+    Raises an AssemblyError if the code is not parsable
+    :param lines:
+    :param context:
+    :param preprocessor:
+    :param source_path:
+    :param check_symbols: whether every referenced symbol must be defined
     :return:
     """
-    global CURRENT_ADDR
 
-    vars = variables_instance()
-    labels = labels_instance()
-    opcodes = raw_opcodes_instance()
+    for line_number, line in segment_lines(preprocessor.process(strip_comments(lines), source_path)):
+        add_item(parse_item(line, context, line_number), context)
+
+    if check_symbols:
+        __check_symbols(context)
 
-    vars.clear()
-    labels.clear()
-    opcodes.clear()
-    CURRENT_ADDR = 0x200
 
+def __count_lines(lines: Iterable[str], stats: 'AssemblyStats') -> Iterator[str]:
+    counters: dict[str, int] = stats.counters
+    for line in lines:
+        counters["lines"] += 1
+        yield line
 
-def parse_file(file_path: str) -> bytes:
+
+def __parse_code_instrumented(
+        lines: Iterable[str],
+        context: AssemblyContext,
+        preprocessor: Preprocessor,
+        source_path: str | None,
+        stats: 'AssemblyStats'
+) -> None:
     """
-    Parses the .chip8 file. Returns a list of bytes
-    :param file_path:
+    Same as __parse_code, recording the phases and the counters into the stats
+    :param lines:
+    :param context:
+    :param preprocessor:
+    :param source_path:
+    :param stats:
     :return:
     """
+    counters: dict[str, int] = stats.counters
+    outcomes: dict[str, float] = stats.outcomes
+
+    read_lines = stats.timed(__count_lines(lines, stats), "read")
+    stripped_lines = stats.timed(strip_comments(read_lines), "strip_comments")
+    expanded_lines = stats.timed(preprocessor.process(stripped_lines, source_path), "preprocess")
+
+    for line_number, line in stats.timed(segment_lines(expanded_lines), "segments"):
+        counters["code_lines"] += 1
+
+        stats.enter("parse")
+        try:
+            item = parse_item(line, context, line_number)
+        finally:
+            parse_time: float = stats.exit()
+
+        outcome: str = type(item).__name__
+        outcomes[outcome] += parse_time
+
+        if outcome == "Instruction":
+            counters["instructions"] += 1
+            counters["forward_references"] += sum(
+                1 for operand in (item.operand1, item.operand2, item.optional_operand)
+                if isinstance(operand, (Label, Variable)) and not _is_resolved(operand)
+            )
+        elif outcome == "Label":
+            counters["labels"] += 1
+        elif outcome == "Variable":
+            counters["variables"] += 1
+        else:
+            counters["data_bytes"] += item.byte_length()
+
+        with stats.phase("encode" if context.program is not None else "parse"):
+            add_item(item, context)
+
+    with stats.phase("check"):
+        __check_symbols(context)
+
+
+def __phase(stats: 'AssemblyStats | None', phase: str):
+    return nullcontext() if stats is None else stats.phase(phase)
+
+
+def __assemble(
+        lines: Iterable[str],
+        context: AssemblyContext | None,
+        compact: bool,
+        stats: 'AssemblyStats | None',
+        preprocessor: Preprocessor | None,
+        source_path: str | None,
+        relocatable: bool = False,
+        optimizer: 'Optimizer | None' = None
+) -> Program:
+    if context is None:
+        context = AssemblyContext()
+    else:
+        # Reset all prior instances
+        context.reset()
+
+    start: int = context.current_addr
+    # The optimizer rewrites the parsed items, so they are kept as objects
+    context.program = Program(start, relocatable) if compact and optimizer is None else None
+
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+
+    if relocatable:
+        # The undefined symbols are imports, and the fixups are left to the linker
+        __parse_code(lines, context, preprocessor, source_path, check_symbols=False)
+        return context.program
+
+    if stats is None:
+        __parse_code(lines, context, preprocessor, source_path)
+    else:
+        __parse_code_instrumented(lines, context, preprocessor, source_path, stats)
+
+    if context.program is None:
+        if optimizer is not None:
+            with __phase(stats, "optimize"):
+                optimizer.optimize(context, start)
+
+        # Every symbol is known by now, so there is nothing to patch
+        program: Program = Program()
+        with __phase(stats, "encode"):
+            program.extend(context.raw_opcodes)
+        return program
+
+    with __phase(stats, "patch"):
+        context.program.patch()
+    return context.program
+
+
+def assemble_program(
+        lines: Iterable[str],
+        context: AssemblyContext | None = None,
+        compact: bool = True,
+        stats: 'AssemblyStats | None' = None,
+        preprocessor: Preprocessor | None = None,
+        source_path: str | None = None,
+        optimizer: 'Optimizer | None' = None
+) -> Program:
+    """
+    Assembles .mini8 code from any iterable of lines (e.g. an open file). The lines are consumed lazily, in a single
+    pass. Returns the Program, or raises an AssemblyError in case of invalid code.
+
+    A fresh AssemblyContext is used unless one is given. A given context is reset first and holds the symbol tables
+    afterwards.
+
+    With compact set, the parsed items are encoded into the Program (see Program.py) as they are parsed, and only the
+    forward references are patched afterwards. Otherwise, the parsed items are kept as objects in the raw opcodes of the
+    context and encoded once parsing is done.
+
+    The bytecode can then be copied out (Program.to_bytes), viewed without copying (Program.view) or written into a
+    buffer such as an mmap (Program.write_into).
+
+    With stats given, the phases of the assembly and its counters are recorded into them (see Stats.py).
+
+    The includes and macros are expanded by the preprocessor (see Preprocessor.py), a fresh one unless one is given.
+    Sharing one between assemblies shares its cache of included files. The includes are searched relative to the
+    source path, the working directory if there is none.
+
+    With an optimizer given, the parsed items are rewritten by its peephole rules before being encoded (see
+    Optimizer.py), and its report tells what was saved. The items are not compacted then.
+    :param lines: Iterable[str]
+    :param context: AssemblyContext | None
+    :param compact: bool
+    :param stats: AssemblyStats | None
+    :param preprocessor: Preprocessor | None
+    :param source_path: str | None
+    :param optimizer: Optimizer | None
+    :return: Program
+    """
+    if stats is None:
+        return __assemble(lines, context, compact, None, preprocessor, source_path, optimizer=optimizer)
 
-    # Reset all prior instances
-    __reset_instances()
+    stats.start()
+    try:
+        return __assemble(lines, context, compact, stats, preprocessor, source_path, optimizer=optimizer)
+    finally:
+        stats.finish()
+
+
+def assemble(
+        lines: Iterable[str],
+        context: AssemblyContext | None = None,
+        compact: bool = True,
+        stats: 'AssemblyStats | None' = None,
+        preprocessor: Preprocessor | None = None,
+        source_path: str | None = None,
+        optimizer: 'Optimizer | None' = None
+) -> bytes:
+    """
+    Assembles .mini8 code from any iterable of lines, see assemble_program. Returns the bytecode, or raises an
+    AssemblyError in case of invalid code
+    :param lines: Iterable[str]
+    :param context: AssemblyContext | None
+    :param compact: bool
+    :param stats: AssemblyStats | None
+    :param preprocessor: Preprocessor | None
+    :param source_path: str | None
+    :param optimizer: Optimizer | None
+    :return: bytes
+    """
+    if stats is None:
+        return __assemble(lines, context, compact, None, preprocessor, source_path, optimizer=optimizer).to_bytes()
+
+    stats.start()
+    try:
+        program: Program = __assemble(lines, context, compact, stats, preprocessor, source_path, optimizer=optimizer)
+        with stats.phase("emit"):
+            return program.to_bytes()
+    finally:
+        stats.finish()
+
+
+def assemble_relocatable(
+        lines: Iterable[str],
+        context: AssemblyContext | None = None,
+        preprocessor: Preprocessor | None = None,
+        source_path: str | None = None
+) -> Program:
+    """
+    Assembles .mini8 code into a relocatable Program (see Program.py), for linking with other programs (see Linker.py).
+    Unlike assemble_program, the symbols left undefined are not an error, and the program is not patched: every address
+    it references is left to the linker
+    :param lines: Iterable[str]
+    :param context: AssemblyContext | None, holds the symbol tables afterwards
+    :param preprocessor: see assemble_program
+    :param source_path: see assemble_program
+    :return: Program
+    """
+    return __assemble(lines, context, True, None, preprocessor, source_path, relocatable=True)
 
-    code: str = ""
-    with open(file_path, "r") as f:
-        code = f.read()
 
-    valid_code: bool = __parse_code(code)
+def parse_stream(
+        lines: Iterable[str],
+        context: AssemblyContext | None = None,
+        compact: bool = True,
+        stats: 'AssemblyStats | None' = None,
+        preprocessor: Preprocessor | None = None,
+        source_path: str | None = None
+) -> bytes:
+    """
+    Parses .mini8 code from any iterable of lines (e.g. an open file). Returns the bytecode, or no bytes in case the
+    code is incomplete (see assemble)
+    :param lines: Iterable[str]
+    :param context: AssemblyContext | None
+    :param compact: see assemble
+    :param stats: see assemble
+    :param preprocessor: see assemble
+    :param source_path: see assemble
+    :return: bytes
+    """
 
-    if valid_code is False:
+    try:
+        return assemble(lines, context, compact, stats, preprocessor, source_path)
+    except InvalidCodeError as e:
+        print(e)
         print("Invalid code!")
         return b''
 
-    # Print the raw instructions
-    opcodes = raw_opcodes_instance()
-    bytecodes = [opcode.to_bytes() for opcode in opcodes]
 
-    return b''.join(bytecodes)
+def assemble_file(
+        file_path: str,
+        context: AssemblyContext | None = None,
+        compact: bool = True,
+        use_mmap: bool = False,
+        stats: 'AssemblyStats | None' = None,
+        preprocessor: Preprocessor | None = None,
+        optimizer: 'Optimizer | None' = None
+) -> Program:
+    """
+    Assembles the .mini8 file into a Program, see assemble_program. Raises an AssemblyError in case of invalid code
+    :param file_path: str
+    :param context: AssemblyContext | None
+    :param compact: bool
+    :param use_mmap: see open_source
+    :param stats: AssemblyStats | None
+    :param preprocessor: Preprocessor | None
+    :param optimizer: Optimizer | None
+    :return: Program
+    """
+    with open_source(file_path, use_mmap) as lines:
+        return assemble_program(lines, context, compact, stats, preprocessor, file_path, optimizer)
+
+
+def parse_file(
+        file_path: str,
+        context: AssemblyContext | None = None,
+        compact: bool = True,
+        use_mmap: bool = False,
+        stats: 'AssemblyStats | None' = None,
+        preprocessor: Preprocessor | None = None
+) -> bytes:
+    """
+    Parses the .chip8 file. Returns a list of bytes
+    :param file_path:
+    :param context: see parse_stream
+    :param compact: see assemble
+    :param use_mmap: see open_source
+    :param stats: see assemble
+    :param preprocessor: see assemble
+    :return:
+    """
+
+    with open_source(file_path, use_mmap) as lines:
+        return parse_stream(lines, context, compact, stats, preprocessor, file_path)
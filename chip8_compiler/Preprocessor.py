@@ -0,0 +1,476 @@
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator
+
+from .Tokens import Tokens
+from .Interfaces import PreprocessorError
+from ._ChipInstructions import INSTRUCTION_NAMES
+
+# Preprocessor of the source, run between the comment removal and the segments.
+#
+#   include "sprites.mini8"
+#       is replaced by the lines of the file, searched relative to the including
+#       file first, then in the include directories
+#
+#   macro draw_at x, y:
+#       LD V0, x
+#       LD V1, y
+#       DRW V0, V1, $5
+#   macro_end
+#       defines a macro, invoked as "draw_at $d10, $d20". The parameters are
+#       replaced word by word in the body. Macros can invoke other macros
+#
+# The included files are read and stripped of their comments once per content
+# (see SourceCache), however many sources include them. The includes are
+# recorded into a DependencyGraph, for rebuilding the dependents of a changed
+# file.
+#
+# Include cycles and recursive macros are detected with the set of the files
+# (and macros) being expanded.
+#
+# The expanded lines keep the line number of the include or macro invocation
+# in the source, so the errors point at the source. Where every line really
+# comes from (its file, its line in it) is kept in the Expansion while the
+# lines are read, e.g. for the language server.
+
+_INCLUDE_PATTERN: re.Pattern = re.compile(rf'^{Tokens.INCLUDE_TOKEN}\s+"([^"]+)"$')
+_MACRO_PATTERN: re.Pattern = re.compile(rf"^{Tokens.MACRO_TOKEN}\s+([A-Za-z_]\w*)\s*([^:]*){Tokens.DECLARATION_END_TOKEN}$")
+# Words are separated by whitespace and commas, as in the lexer
+_WORD_PATTERN: re.Pattern = re.compile(r"[^\s,]+")
+
+# The words that cannot name a macro
+RESERVED_NAMES: frozenset[str] = INSTRUCTION_NAMES | frozenset([
+    Tokens.LABEL_TOKEN,
+    Tokens.VARIABLE_TOKEN,
+    Tokens.SEGMENT_BEGIN_TOKEN,
+    Tokens.SEGMENT_END_TOKEN,
+    Tokens.INCLUDE_TOKEN,
+    Tokens.MACRO_TOKEN,
+    Tokens.MACRO_END_TOKEN
+])
+
+
+def _error(reason: str, position: int) -> PreprocessorError:
+    return PreprocessorError(f"{reason} (line {position})", line=position, reason=reason)
+
+
+def is_directive(line: str, token: str) -> bool:
+    """
+    Whether the code of the line (stripped, see strip_comments) starts with the directive token, as a whole word
+    :param line: str
+    :param token: str, e.g. Tokens.INCLUDE_TOKEN
+    :return: bool
+    """
+    return line.startswith(token) and (len(line) == len(token) or line[len(token)].isspace())
+
+
+def include_name(line: str) -> str | None:
+    """
+    The file named by an include directive, None if the line is not a valid one
+    :param line: str, the code of the line
+    :return: str | None
+    """
+    match = _INCLUDE_PATTERN.match(line) if is_directive(line, Tokens.INCLUDE_TOKEN) else None
+    return None if match is None else match.group(1)
+
+
+def macro_signature(line: str) -> tuple[str, tuple[str, ...]] | None:
+    """
+    The name and the parameters of a macro definition, None if the line is not a valid one
+    :param line: str, the code of the line
+    :return: tuple[str, tuple[str, ...]] | None
+    """
+    match = _MACRO_PATTERN.match(line) if is_directive(line, Tokens.MACRO_TOKEN) else None
+    return None if match is None else (match.group(1), tuple(_WORD_PATTERN.findall(match.group(2))))
+
+
+@dataclass(slots=True, frozen=True)
+class SourceUnit:
+    """
+    A source file stripped of its comments: (line number, code) pairs
+    """
+    path: str
+    digest: str
+    lines: tuple[tuple[int, str], ...]
+
+
+@dataclass(slots=True)
+class Macro:
+    """
+    A macro definition: its body as (line number, code) pairs, and the file and the line it is defined at
+    """
+    name: str
+    parameters: tuple[str, ...]
+    body: list[tuple[int, str]] = field(default_factory=list)
+    path: str | None = None
+    line: int = 0
+
+
+class SourceCache:
+    """
+    Cache of the included files, stripped of their comments. Files are checked by their modification time and size,
+    and a changed file is only stripped again if its content changed. Thread-safe
+    """
+
+    def __init__(self):
+        # Imported here, Parser imports this module
+        from .Parser import strip_comments
+
+        self.__strip_comments = strip_comments
+        self.__units: dict[str, SourceUnit] = {}
+        self.__files: dict[str, tuple[int, int, str]] = {}
+        self.__lock: threading.Lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def load(self, path: str) -> SourceUnit:
+        """
+        Returns the unit of the file. Raises an OSError if it cannot be read
+        :param path: str, an absolute path
+        :return: SourceUnit
+        """
+        stat = os.stat(path)
+
+        with self.__lock:
+            known_file: tuple[int, int, str] | None = self.__files.get(path, None)
+            if known_file is not None and known_file[:2] == (stat.st_mtime_ns, stat.st_size):
+                self.hits += 1
+                return self.__units[known_file[2]]
+
+        # Only needed once a file is included
+        import hashlib
+
+        with open(path, "rb") as f:
+            source: bytes = f.read()
+        digest: str = hashlib.sha256(source).hexdigest()
+
+        with self.__lock:
+            unit: SourceUnit | None = self.__units.get(digest, None)
+            if unit is None:
+                self.misses += 1
+                unit = SourceUnit(path, digest, tuple(self.__strip_comments(source.decode().splitlines())))
+                self.__units[digest] = unit
+            else:
+                self.hits += 1
+
+            self.__files[path] = (stat.st_mtime_ns, stat.st_size, digest)
+            return unit
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__units.clear()
+            self.__files.clear()
+
+
+class DependencyGraph:
+    """
+    The includes of every preprocessed source. Thread-safe
+    """
+
+    def __init__(self):
+        self.__includes: dict[str, set[str]] = {}
+        self.__lock: threading.Lock = threading.Lock()
+
+    def set_includes(self, path: str, includes: Iterable[str]) -> None:
+        with self.__lock:
+            self.__includes[path] = set(includes)
+
+    def includes(self, path: str) -> set[str]:
+        """
+        Returns the files directly included by the file
+        """
+        with self.__lock:
+            return set(self.__includes.get(path, ()))
+
+    def dependencies(self, path: str) -> set[str]:
+        """
+        Returns every file the file depends on, directly or not
+        """
+        with self.__lock:
+            found: set[str] = set()
+            pending: list[str] = [path]
+            while pending:
+                for include in self.__includes.get(pending.pop(), ()):
+                    if include not in found:
+                        found.add(include)
+                        pending.append(include)
+            return found
+
+    def dependents(self, path: str) -> set[str]:
+        """
+        Returns every file depending on the file, directly or not
+        """
+        with self.__lock:
+            included_by: dict[str, set[str]] = {}
+            for source, includes in self.__includes.items():
+                for include in includes:
+                    included_by.setdefault(include, set()).add(source)
+
+        found: set[str] = set()
+        pending: list[str] = [path]
+        while pending:
+            for source in included_by.get(pending.pop(), ()):
+                if source not in found:
+                    found.add(source)
+                    pending.append(source)
+        return found
+
+    def sources(self) -> list[str]:
+        with self.__lock:
+            return list(self.__includes)
+
+
+class Preprocessor:
+    """
+    Expands the includes and the macros of the sources. A single Preprocessor can be shared by every assembly of a
+    build, so the included files are only loaded once
+    """
+
+    def __init__(
+            self,
+            include_dirs: Iterable[str] = (),
+            cache: SourceCache | None = None,
+            graph: DependencyGraph | None = None
+    ):
+        self.include_dirs: list[str] = [os.path.abspath(include_dir) for include_dir in include_dirs]
+        self.cache: SourceCache = cache if cache is not None else SourceCache()
+        self.graph: DependencyGraph = graph if graph is not None else DependencyGraph()
+
+    def resolve(self, name: str, including_path: str | None) -> str:
+        """
+        Finds an included file: relative to the including file (the working directory if there is none), then in the
+        include directories. Raises a PreprocessorError if there is no such file
+        :param name: str
+        :param including_path: str | None
+        :return: str, an absolute path
+        """
+        base_dir: str = os.path.dirname(including_path) if including_path is not None else os.getcwd()
+
+        for directory in [base_dir, *self.include_dirs]:
+            path: str = os.path.abspath(os.path.join(directory, name))
+            if os.path.isfile(path):
+                return path
+
+        raise PreprocessorError(f"Included file '{name}' not found")
+
+    def process(
+            self,
+            lines: Iterable[tuple[int, str]],
+            source_path: str | None = None,
+            expansion: 'Expansion | None' = None
+    ) -> Iterator[tuple[int, str]]:
+        """
+        Lazily expands the includes and the macros of (line number, code) pairs (see strip_comments). Raises a
+        PreprocessorError on invalid directives, missing files, include cycles or recursive macros
+        :param lines: Iterable[tuple[int, str]]
+        :param source_path: str | None, the path of the source, for finding its includes
+        :param expansion: Expansion | None, a new one for the source, to follow the expansion from the outside
+        :return: Iterator[tuple[int, str]]
+        """
+        source_path = os.path.abspath(source_path) if source_path is not None else None
+        if expansion is None:
+            expansion = Expansion(source_path)
+
+        yield from self.__expand(lines, source_path, None, expansion)
+
+        for path, includes in expansion.includes.items():
+            if path is not None:
+                self.graph.set_includes(path, includes)
+
+    def dependencies(self, source_path: str) -> list[tuple[str, str]]:
+        """
+        Returns the (path, content digest) of every file the source includes, directly or not, in a stable order. Only
+        the include directives are followed, no macro gets expanded. The includes found are recorded into the graph
+        :param source_path: str
+        :return: list[tuple[str, str]]
+        """
+        found: dict[str, str] = {}
+        pending: list[str] = [os.path.abspath(source_path)]
+
+        while pending:
+            path: str = pending.pop()
+            includes: list[str] = []
+            for _, line in self.cache.load(path).lines:
+                name: str | None = include_name(line)
+                if name is None:
+                    continue
+
+                include_path: str = self.resolve(name, path)
+                includes.append(include_path)
+                if include_path not in found:
+                    found[include_path] = self.cache.load(include_path).digest
+                    pending.append(include_path)
+            self.graph.set_includes(path, includes)
+
+        return sorted(found.items())
+
+    def __expand(
+            self,
+            lines: Iterable[tuple[int, str]],
+            path: str | None,
+            origin_line: int | None,
+            expansion: 'Expansion'
+    ) -> Iterator[tuple[int, str]]:
+        macros: dict[str, Macro] = expansion.macros
+        lines = iter(lines)
+
+        for line_number, line in lines:
+            position: int = line_number if origin_line is None else origin_line
+            expansion.origin_line = line_number
+            first_char: str = line[0]
+
+            if first_char == "i" and is_directive(line, Tokens.INCLUDE_TOKEN):
+                match = _INCLUDE_PATTERN.match(line)
+                if match is None:
+                    raise _error("Invalid include, expected 'include \"file\"'", position)
+
+                yield from self.__include(match.group(1), path, position, expansion)
+                continue
+
+            if first_char == "m":
+                if is_directive(line, Tokens.MACRO_TOKEN):
+                    self.__define(line, lines, path, line_number, position, expansion)
+                    continue
+
+                if line == Tokens.MACRO_END_TOKEN:
+                    raise _error(f"'{Tokens.MACRO_END_TOKEN}' without a macro", position)
+
+            if macros:
+                words: list[str] = _WORD_PATTERN.findall(line)
+                macro: Macro | None = macros.get(words[0], None) if words else None
+                if macro is not None:
+                    yield from self.__invoke(macro, words[1:], path, position, expansion)
+                    continue
+
+            yield position, line
+
+    def __include(
+            self,
+            name: str,
+            including_path: str | None,
+            position: int,
+            expansion: 'Expansion'
+    ) -> Iterator[tuple[int, str]]:
+        try:
+            path: str = self.resolve(name, including_path)
+        except PreprocessorError as e:
+            raise _error(str(e), position) from None
+
+        expansion.includes.setdefault(including_path, set()).add(path)
+
+        if path in expansion.active_files:
+            cycle: list[str] = expansion.file_stack[expansion.file_stack.index(path):] + [path]
+            raise _error(f"Include cycle: {' -> '.join(os.path.basename(file) for file in cycle)}", position)
+
+        try:
+            unit: SourceUnit = self.cache.load(path)
+        except OSError as e:
+            raise _error(f"Cannot read the included file '{name}': {e}", position) from None
+
+        expansion.includes.setdefault(path, set())
+        expansion.active_files.add(path)
+        expansion.file_stack.append(path)
+        origin_path: str | None = expansion.origin_path
+        expansion.origin_path = path
+        try:
+            yield from self.__expand(unit.lines, path, position, expansion)
+        finally:
+            expansion.origin_path = origin_path
+            expansion.file_stack.pop()
+            expansion.active_files.discard(path)
+
+    @staticmethod
+    def __define(
+            line: str,
+            lines: Iterator[tuple[int, str]],
+            path: str | None,
+            line_number: int,
+            position: int,
+            expansion: 'Expansion'
+    ) -> None:
+        signature: tuple[str, tuple[str, ...]] | None = macro_signature(line)
+        if signature is None:
+            raise _error("Invalid macro definition, expected 'macro name a, b:'", position)
+
+        name, parameters = signature
+        if name in RESERVED_NAMES:
+            raise _error(f"'{name}' cannot name a macro", position)
+        if name in expansion.macros:
+            raise _error(f"Macro '{name}' was already defined", position)
+        if len(set(parameters)) != len(parameters):
+            raise _error(f"Macro '{name}' has duplicate parameters", position)
+
+        macro: Macro = Macro(name, parameters, path=path, line=line_number)
+
+        for body_line_number, body_line in lines:
+            if body_line == Tokens.MACRO_END_TOKEN:
+                expansion.macros[name] = macro
+                return
+
+            if is_directive(body_line, Tokens.MACRO_TOKEN):
+                raise _error(f"Macro definitions cannot be nested (in macro '{name}')", body_line_number)
+
+            macro.body.append((body_line_number, body_line))
+
+        raise _error(f"Macro '{name}' is missing its '{Tokens.MACRO_END_TOKEN}'", position)
+
+    def __invoke(
+            self,
+            macro: Macro,
+            arguments: list[str],
+            path: str | None,
+            position: int,
+            expansion: 'Expansion'
+    ) -> Iterator[tuple[int, str]]:
+        if len(arguments) != len(macro.parameters):
+            raise _error(
+                f"Macro '{macro.name}' takes {len(macro.parameters)} arguments, {len(arguments)} given", position
+            )
+
+        if macro.name in expansion.active_macros:
+            raise _error(f"Macro '{macro.name}' invokes itself", position)
+
+        values: dict[str, str] = dict(zip(macro.parameters, arguments))
+
+        def substitute(match: re.Match) -> str:
+            word: str = match.group()
+            return values.get(word, word)
+
+        body: Iterator[tuple[int, str]] = (
+            (line_number, _WORD_PATTERN.sub(substitute, line) if values else line)
+            for line_number, line in macro.body
+        )
+
+        expansion.active_macros.add(macro.name)
+        origin_path: str | None = expansion.origin_path
+        expansion.origin_path = macro.path
+        try:
+            yield from self.__expand(body, path, position, expansion)
+        finally:
+            expansion.origin_path = origin_path
+            expansion.active_macros.discard(macro.name)
+
+
+class Expansion:
+    """
+    The state of the expansion of a source. While the expanded lines are read, origin_path and origin_line tell where
+    the last one comes from: the file (of the include, or of the definition of the macro) and the line in it
+    """
+    __slots__ = (
+        "macros", "includes", "active_files", "file_stack", "active_macros", "origin_path", "origin_line"
+    )
+
+    def __init__(self, source_path: str | None = None):
+        """
+        :param source_path: str | None, the absolute path of the source
+        """
+        self.macros: dict[str, Macro] = {}
+        # The files included by every expanded file
+        self.includes: dict[str | None, set[str]] = {source_path: set()}
+        self.active_files: set[str] = set() if source_path is None else {source_path}
+        self.file_stack: list[str] = [] if source_path is None else [source_path]
+        self.active_macros: set[str] = set()
+        self.origin_path: str | None = source_path
+        self.origin_line: int = 0
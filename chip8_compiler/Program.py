@@ -0,0 +1,249 @@
+import mmap
+import os
+from array import array
+from typing import Iterable
+
+from .Globals import PROGRAM_START
+from .Interfaces import Bytecode
+from .Types import (
+    Literal,
+    AddressLiteral,
+    Label,
+    Variable,
+    Instruction
+)
+
+# Compact representation of a parsed program: its bytecode and a fixup table.
+#
+# Instead of keeping an Instruction (with its operand objects) per line, every
+# item of the program is encoded straight into one bytearray as soon as it is
+# parsed. Operands referencing a Label or Variable that is not defined yet
+# (forward references) are encoded as zero and recorded in the fixup table,
+# which is patched in a second pass over just the fixups once every symbol is
+# known.
+
+# Packing of a fixup field: the mask in the low 12 bits, the shift above it
+_FIELD_MASK_BITS: int = 12
+_FIELD_MASK: int = (1 << _FIELD_MASK_BITS) - 1
+# The names of the local labels standing for the __ADDR__ operands of a relocatable program. Source labels start with
+# "__", so these never clash with them
+ADDRESS_SYMBOL_PREFIX: str = ".ADDR@"
+# The mode of the files written atomically, as open would create them. The umask can only be read by setting it, so it
+# is read once, on import
+_UMASK: int = os.umask(0)
+os.umask(_UMASK)
+_FILE_MODE: int = 0o666 & ~_UMASK
+
+
+def _is_resolved(symbol: Label | Variable) -> bool:
+    if symbol.__class__ is Label:
+        return symbol.address is not None
+    return symbol.value is not None
+
+
+def field_value(value: int, fixup_field: int) -> int:
+    """
+    The bits a symbol value sets in the instruction, for a fixup field (mask | shift << 12)
+    :param value: int
+    :param fixup_field: int
+    :return: int
+    """
+    return (value & (fixup_field & _FIELD_MASK)) << (fixup_field >> _FIELD_MASK_BITS)
+
+
+def patch_fixups(
+        code: bytearray,
+        offsets: Iterable[int],
+        symbols: Iterable[int],
+        fields: Iterable[int],
+        symbol_values: list[int],
+        base_offset: int = 0
+) -> None:
+    """
+    Fills the symbol values into the fields of the code, in a single pass over the fixups (see Program)
+    :param code: bytearray
+    :param offsets: the offsets of the fixups, relative to base_offset
+    :param symbols: the indexes of their symbols, in symbol_values
+    :param fields: their fields (mask | shift << 12)
+    :param symbol_values: list[int]
+    :param base_offset: int
+    :return:
+    """
+    field_mask: int = _FIELD_MASK
+
+    for offset, symbol, fixup_field in zip(offsets, symbols, fields):
+        value: int = (symbol_values[symbol] & (fixup_field & field_mask)) << (fixup_field >> _FIELD_MASK_BITS)
+        offset += base_offset
+        code[offset] |= value >> 8
+        code[offset + 1] |= value & 0xFF
+
+
+class Program:
+    """
+    A parsed program:
+        code: the bytecode, with the forward references left unfilled until patch() is called
+        fixup_offsets: the offset of each unfilled instruction in code
+        fixup_symbols: the index (in symbols) of the symbol filling it in
+        fixup_fields: where the symbol value goes (mask | shift << 12)
+
+    A relocatable program records a fixup for every address it references (labels and __ADDR__ operands), not only for
+    the forward references, so it can be moved to another address (see Linker.py). It is never patched
+    """
+    __slots__ = (
+        "start", "relocatable", "code", "fixup_offsets", "fixup_symbols", "fixup_fields", "symbols", "__symbol_indexes"
+    )
+
+    def __init__(self, start: int = PROGRAM_START, relocatable: bool = False):
+        self.start: int = start
+        self.relocatable: bool = relocatable
+        self.code: bytearray = bytearray()
+
+        self.fixup_offsets: array = array("I")
+        self.fixup_symbols: array = array("i")
+        self.fixup_fields: array = array("H")
+
+        # The labels and variables referenced by the fixups
+        self.symbols: list[Label | Variable] = []
+        self.__symbol_indexes: dict[str, int] = {}
+
+    @property
+    def size(self) -> int:
+        return len(self.code)
+
+    def __symbol_index(self, symbol: Label | Variable) -> int:
+        index: int | None = self.__symbol_indexes.get(symbol.name, None)
+        if index is None:
+            index = len(self.symbols)
+            self.symbols.append(symbol)
+            self.__symbol_indexes[symbol.name] = index
+        return index
+
+    def append(self, item: Bytecode) -> None:
+        """
+        Encodes a parsed Instruction or Literal at the end of the program
+        :param item: Bytecode
+        :return:
+        """
+        if item.__class__ is Literal:
+            self.code.append(item.value)
+            return
+
+        instruction: Instruction = item
+        encoding = instruction.encoding
+        instruction_code: int = encoding.command_code
+
+        for index, shift, mask in encoding.fields:
+            operand = instruction.optional_operand if index == 2 else \
+                instruction.operand2 if index == 1 else instruction.operand1
+
+            # The symbols are checked by class, so the resolved ones do not need a second lookup
+            operand_class: type = operand.__class__
+            if operand_class is Label:
+                value: int | None = None if self.relocatable else operand.address
+            elif operand_class is Variable:
+                value = None if operand.value is None else operand.value.value
+            elif operand_class is AddressLiteral and self.relocatable:
+                operand = Label(f"{ADDRESS_SYMBOL_PREFIX}{operand.value:X}", operand.value)
+                value = None
+            else:
+                value = operand.operand_value()
+
+            if value is None:
+                # Only the literal operand can be symbolic or an address, so there is at most one fixup per instruction
+                self.fixup_offsets.append(len(self.code))
+                self.fixup_symbols.append(self.__symbol_index(operand))
+                self.fixup_fields.append(mask | (shift << _FIELD_MASK_BITS))
+            else:
+                instruction_code |= (value & mask) << shift
+
+        self.code += instruction_code.to_bytes(2, "big")
+
+    def extend(self, items: Iterable[Bytecode]) -> None:
+        for item in items:
+            self.append(item)
+
+    def patch(self) -> None:
+        """
+        Fills in the forward references. Every symbol must be resolved by now
+        :return:
+        """
+        patch_fixups(
+            self.code, self.fixup_offsets, self.fixup_symbols, self.fixup_fields,
+            [symbol.operand_value() for symbol in self.symbols]
+        )
+
+        # Everything is filled in
+        del self.fixup_offsets[:], self.fixup_symbols[:], self.fixup_fields[:]
+
+    def view(self) -> memoryview:
+        """
+        Returns the bytecode without copying it. The program must not grow while the view is alive
+        :return: memoryview
+        """
+        return memoryview(self.code)
+
+    def write_into(self, buffer, offset: int = 0) -> int:
+        """
+        Copies the bytecode into a writable buffer (a bytearray, an mmap, ...) at the offset. Returns the number of
+        bytes written
+        :param buffer: a writable buffer, at least offset + size bytes long
+        :param offset: int
+        :return: int
+        """
+        size: int = len(self.code)
+        memoryview(buffer)[offset:offset + size] = self.code
+        return size
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.code)
+
+
+def write_output(file_path: str, bytecode, use_mmap: bool = False) -> None:
+    """
+    Writes the bytecode (a Program or any bytes-like object) to the file. With use_mmap set, the file is sized up front
+    and the bytecode is copied straight into a memory map of it
+    :param file_path: str
+    :param bytecode: Program | bytes-like
+    :param use_mmap: bool
+    :return:
+    """
+    with (bytecode.view() if isinstance(bytecode, Program) else memoryview(bytecode)) as data:
+        if not use_mmap or data.nbytes == 0:
+            with open(file_path, "wb") as f:
+                f.write(data)
+            return
+
+        with open(file_path, "w+b") as f:
+            os.ftruncate(f.fileno(), data.nbytes)
+            with mmap.mmap(f.fileno(), data.nbytes, access=mmap.ACCESS_WRITE) as mapped_file:
+                mapped_file[:] = data
+
+
+def write_atomically(file_path: str, data: bytes) -> None:
+    """
+    Writes the file through a temporary file in the same directory, renamed over it once complete, so a reader never
+    sees a partial file. The directory is created if needed. The file keeps the mode of the file it replaces, if any,
+    or gets the mode open gives a new file (the temporary file is only readable by its owner)
+    :param file_path: str
+    :param data: bytes
+    :return:
+    """
+    # Only needed by the builds writing their outputs atomically
+    import tempfile
+
+    directory: str = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            mode: int = os.stat(file_path).st_mode & 0o7777
+        except OSError:
+            mode = _FILE_MODE
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
@@ -0,0 +1,322 @@
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from typing import Iterable, Iterator
+
+# Instrumentation of the assembler pipeline.
+#
+# An AssemblyStats given to the assembly functions of Parser.py records the
+# time spent in every phase of the pipeline, a few counters about the source
+# and, optionally, the memory allocated in every phase. Without one, the
+# assembly runs its uninstrumented loop, so the instrumentation costs nothing
+# when disabled.
+#
+# The phases are interleaved (the source is streamed through all of them), so
+# they are timed with a stack: entering a phase pauses the current one, and
+# every phase is charged only its own (exclusive) time.
+
+# The phases of the pipeline, in order
+PHASES: tuple[str, ...] = (
+    "read", "strip_comments", "preprocess", "segments", "parse", "encode", "check", "optimize", "patch", "emit"
+)
+# The outcomes of parsing a line
+OUTCOMES: tuple[str, ...] = ("Instruction", "Label", "Variable", "Literal")
+COUNTERS: tuple[str, ...] = (
+    "lines",
+    "code_lines",
+    "instructions",
+    "labels",
+    "variables",
+    "data_bytes",
+    "forward_references"
+)
+
+
+class PhaseHook:
+    """
+    Attached to a phase (see AssemblyStats.attach), the hook is entered and exited around every stretch of time spent
+    in that phase. Nested phases run within the stretch
+    """
+
+    def enter(self) -> None:
+        pass
+
+    def exit(self) -> None:
+        pass
+
+    def finish(self) -> None:
+        """
+        Called once the assembly is done
+        """
+        pass
+
+
+class CProfileHook(PhaseHook):
+    """
+    Profiles a phase with cProfile. The profile can be read with pstats, e.g. pstats.Stats(hook.profile)
+    """
+
+    def __init__(self):
+        import cProfile
+
+        self.profile = cProfile.Profile()
+
+    def enter(self) -> None:
+        self.profile.enable()
+
+    def exit(self) -> None:
+        self.profile.disable()
+
+    def report(self, limit: int = 20) -> str:
+        import io
+        import pstats
+
+        stream = io.StringIO()
+        pstats.Stats(self.profile, stream=stream).sort_stats("tottime").print_stats(limit)
+        return stream.getvalue()
+
+
+class TracemallocHook(PhaseHook):
+    """
+    Traces the memory allocated in a phase with tracemalloc. allocated is the net memory allocated in the phase (what
+    it allocated minus what it freed), peak the highest traced memory seen during it. snapshot is taken at the end of
+    the assembly, it holds every allocation traced from the first stretch on
+    """
+
+    def __init__(self, frames: int = 1):
+        self.frames: int = frames
+        self.allocated: int = 0
+        self.peak: int = 0
+        self.snapshot = None
+        self.__started: bool = False
+        self.__entered_at: int = 0
+
+    def enter(self) -> None:
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.__started = True
+        tracemalloc.reset_peak()
+        self.__entered_at = tracemalloc.get_traced_memory()[0]
+
+    def exit(self) -> None:
+        import tracemalloc
+
+        current, peak = tracemalloc.get_traced_memory()
+        self.allocated += current - self.__entered_at
+        self.peak = max(self.peak, peak)
+
+    def finish(self) -> None:
+        import tracemalloc
+
+        if tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot()
+            if self.__started:
+                tracemalloc.stop()
+                self.__started = False
+
+    def report(self, limit: int = 10) -> str:
+        lines: list[str] = [f"allocated: {self.allocated} bytes, peak: {self.peak} bytes"]
+        if self.snapshot is not None:
+            lines.extend(str(statistic) for statistic in self.snapshot.statistics("lineno")[:limit])
+        return "\n".join(lines)
+
+
+class AssemblyStats:
+    """
+    Statistics of an assembly:
+        phases: the time spent in every phase, in seconds
+        outcomes: the time spent parsing the lines, by outcome (Instruction, Label, Variable or Literal)
+        counters: see COUNTERS
+        allocations: the memory allocated in every phase, in bytes, when track_allocations is set
+        elapsed: the duration of the whole assembly
+    """
+
+    def __init__(self, track_allocations: bool = False):
+        self.phases: dict[str, float] = dict.fromkeys(PHASES, 0.0)
+        self.outcomes: dict[str, float] = dict.fromkeys(OUTCOMES, 0.0)
+        self.counters: dict[str, int] = dict.fromkeys(COUNTERS, 0)
+        self.track_allocations: bool = track_allocations
+        self.allocations: dict[str, int] = dict.fromkeys(PHASES, 0) if track_allocations else {}
+        self.elapsed: float = 0.0
+        self.hooks: dict[str, list[PhaseHook]] = {}
+
+        self.__stack: list[str] = []
+        self.__resumed_at: float = 0.0
+        self.__memory_at: int = 0
+        self.__started_at: float = 0.0
+        self.__started_tracing: bool = False
+
+    def attach(self, phase: str, hook: PhaseHook) -> PhaseHook:
+        """
+        Attaches a hook (e.g. a CProfileHook or a TracemallocHook) around a phase. Returns the hook
+        :param phase: str, one of PHASES
+        :param hook: PhaseHook
+        :return: PhaseHook
+        """
+        if phase not in self.phases:
+            raise ValueError(f"Unknown phase '{phase}', expected one of {', '.join(PHASES)}")
+        self.hooks.setdefault(phase, []).append(hook)
+        return hook
+
+    def reset(self) -> None:
+        for counter in self.counters:
+            self.counters[counter] = 0
+        for phase in self.phases:
+            self.phases[phase] = 0.0
+        for outcome in self.outcomes:
+            self.outcomes[outcome] = 0.0
+        for phase in self.allocations:
+            self.allocations[phase] = 0
+        self.elapsed = 0.0
+        self.__stack.clear()
+
+    def start(self) -> None:
+        """
+        Called at the start of an assembly
+        """
+        self.reset()
+        if self.track_allocations:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.__started_tracing = True
+            self.__memory_at = tracemalloc.get_traced_memory()[0]
+        self.__started_at = timer()
+
+    def finish(self) -> None:
+        """
+        Called at the end of an assembly, even a failed one
+        """
+        self.elapsed = timer() - self.__started_at
+        while self.__stack:
+            self.exit()
+
+        for hooks in self.hooks.values():
+            for hook in hooks:
+                hook.finish()
+
+        if self.__started_tracing:
+            import tracemalloc
+
+            tracemalloc.stop()
+            self.__started_tracing = False
+
+    def __charge(self, now: float) -> None:
+        # Charges the time (and memory) since the last switch to the current phase
+        phase: str = self.__stack[-1]
+        self.phases[phase] += now - self.__resumed_at
+
+        if self.track_allocations:
+            import tracemalloc
+
+            memory: int = tracemalloc.get_traced_memory()[0]
+            self.allocations[phase] += memory - self.__memory_at
+            self.__memory_at = memory
+
+    def enter(self, phase: str) -> None:
+        """
+        Enters a phase, pausing the current one
+        :param phase: str
+        """
+        now: float = timer()
+        if self.__stack:
+            self.__charge(now)
+        elif self.track_allocations:
+            import tracemalloc
+
+            self.__memory_at = tracemalloc.get_traced_memory()[0]
+
+        self.__stack.append(phase)
+        for hook in self.hooks.get(phase, ()):
+            hook.enter()
+        self.__resumed_at = timer()
+
+    def exit(self) -> float:
+        """
+        Exits the current phase, resuming the one it paused. Returns the time spent in the phase since it was last
+        entered or resumed
+        :return: float
+        """
+        now: float = timer()
+        elapsed: float = now - self.__resumed_at
+        self.__charge(now)
+
+        for hook in self.hooks.get(self.__stack.pop(), ()):
+            hook.exit()
+        self.__resumed_at = timer()
+        return elapsed
+
+    @contextmanager
+    def phase(self, phase: str) -> Iterator[None]:
+        """
+        Charges the time spent in the block to the phase
+        :param phase: str
+        """
+        self.enter(phase)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def timed(self, iterable: Iterable, phase: str) -> Iterator:
+        """
+        Wraps an iterable, charging the time spent producing every item to the phase
+        :param iterable: Iterable
+        :param phase: str
+        :return: Iterator
+        """
+        iterator: Iterator = iter(iterable)
+
+        while True:
+            self.enter(phase)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.exit()
+                return
+            except BaseException:
+                self.exit()
+                raise
+            self.exit()
+            yield item
+
+    def to_dict(self) -> dict:
+        result: dict = {
+            "elapsed": self.elapsed,
+            "phases": dict(self.phases),
+            "outcomes": dict(self.outcomes),
+            "counters": dict(self.counters)
+        }
+        if self.track_allocations:
+            result["allocations"] = dict(self.allocations)
+        return result
+
+    def to_json(self) -> str:
+        import json
+
+        return json.dumps(self.to_dict(), indent=2)
+
+    def format(self) -> str:
+        """
+        Returns the statistics as a readable table
+        :return: str
+        """
+        lines: list[str] = [f"{'phase':<16}{'seconds':>12}{'share':>9}" +
+                            (f"{'allocated':>14}" if self.track_allocations else "")]
+
+        for phase, seconds in self.phases.items():
+            share: float = seconds / self.elapsed * 100 if self.elapsed else 0.0
+            line: str = f"{phase:<16}{seconds:>12.6f}{share:>8.1f}%"
+            if self.track_allocations:
+                line += f"{self.allocations[phase]:>14}"
+            lines.append(line)
+
+        lines.append(f"{'total':<16}{self.elapsed:>12.6f}")
+        lines.append("")
+        lines.append(f"{'parse outcome':<16}{'seconds':>12}")
+        lines.extend(f"{outcome:<16}{seconds:>12.6f}" for outcome, seconds in self.outcomes.items())
+        lines.append("")
+        lines.extend(f"{counter:<20}{value:>8}" for counter, value in self.counters.items())
+        return "\n".join(lines)
@@ -16,6 +16,10 @@ class Tokens(StrEnum):
     SEGMENT_BEGIN_TOKEN = "segment",
     SEGMENT_END_TOKEN = "segment_end"
 
+    INCLUDE_TOKEN = "include",
+    MACRO_TOKEN = "macro",
+    MACRO_END_TOKEN = "macro_end",
+
     LITERAL_TOKEN = "$",
     LITERAL_DECIMAL_TOKEN = "$d",
     LITERAL_BINARY_TOKEN = "$b",
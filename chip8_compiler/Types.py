@@ -1,7 +1,8 @@
 from typing import Union, TypeAlias, Callable, Any, Type
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from .Globals import (
+    AssemblyContext,
     variables_instance,
     labels_instance
 )
@@ -11,19 +12,21 @@ from .Tokens import (
 )
 
 from .Interfaces import (
+    AssemblyError,
+    DuplicateDefinitionError,
     Bytecode,
-    InstructionsLUTEntry
+    InstructionEncoding
 )
 
 from ._ChipInstructions import (
-    get_normal_entry,
-    get_special_entry,
-    get_edge_entry,
-    get_drw_entry
+    NORMAL_REGISTER_KIND,
+    LITERAL_KIND,
+    INSTRUCTION_NAMES,
+    get_encoding
 )
 
 
-@dataclass
+@dataclass(slots=True)
 class Literal(Bytecode):
     value: int
 
@@ -33,6 +36,13 @@ class Literal(Bytecode):
     def __str__(self):
         return f"Literal({self.value})"
 
+    def operand_value(self) -> int:
+        return self.value
+
+    @staticmethod
+    def operand_kind() -> str:
+        return LITERAL_KIND
+
     @staticmethod
     def byte_length() -> int:
         return 1
@@ -61,7 +71,18 @@ class Literal(Bytecode):
         return Literal(value=int(val[1:], 16))
 
 
-@dataclass
+@dataclass(slots=True)
+class AddressLiteral(Literal):
+    """
+    The address of an instruction, given by __ADDR__. Encoded as a literal, but moves with the program when it is
+    relocated (see Linker.py)
+    """
+
+    def __str__(self):
+        return f"AddressLiteral({self.value})"
+
+
+@dataclass(slots=True)
 class Label:
     """
     The Label class. Initially has the address unset, until the parser sets it.
@@ -72,18 +93,26 @@ class Label:
     def __str__(self):
         return f"Label({self.name}, at {hex(self.address)})"
 
+    def operand_value(self) -> int:
+        return self.address
+
     @staticmethod
-    def parse_value(val: str) -> Union["Label", None]:
+    def operand_kind() -> str:
+        return LITERAL_KIND
+
+    @staticmethod
+    def parse_value(val: str, context: AssemblyContext | None = None) -> Union["Label", None]:
         """
         Parses the Label value. Returns None if not a Label
         :param val
+        :param context
         :return:
         """
         if val[:2] != Tokens.LABEL_NAME_TOKEN:
             return None
 
         # Get the global state
-        global_state = labels_instance()
+        global_state = labels_instance(context)
 
         # See if the label already exists
         global_label: Label | None = global_state.get(val, None)
@@ -98,13 +127,14 @@ class Label:
         return label
 
     @staticmethod
-    def parse_definition(line: str, address: int) -> Union['Label', None]:
+    def parse_definition(line: str, address: int, context: AssemblyContext | None = None) -> Union['Label', None]:
         """
         Checks the code line for a label. Returns None in case of no label existing.
 
-        In case of conflicting Label names, raises an Exception.
+        In case of conflicting Label names, raises an AssemblyError.
         :param line
         :param address
+        :param context
         :return:  Label | None
         """
 
@@ -124,15 +154,27 @@ class Label:
 
         name = name[:-1] # Gets the label name
 
+        return Label.define(name, address, context)
+
+    @staticmethod
+    def define(name: str, address: int, context: AssemblyContext | None = None) -> 'Label':
+        """
+        Defines the label at the address. In case of conflicting Label names, raises a DuplicateDefinitionError.
+        :param name
+        :param address
+        :param context
+        :return: Label
+        """
+
         # The method adds a label into existence
-        global_state = labels_instance()
+        global_state = labels_instance(context)
         global_label: Label | None = global_state.get(name, None)
 
         # If it exists
         if global_label is not None:
             # Check if it was already defined
             if global_label.address is not None:
-                raise Exception(f"Label '{name}' was already defined")
+                raise DuplicateDefinitionError(f"Label '{name}' was already defined", symbol=name)
             else:
                 global_label.address = address
                 return global_label
@@ -146,7 +188,7 @@ class Label:
         return global_label
 
 
-@dataclass
+@dataclass(slots=True)
 class Variable:
     """
     The Variable class. Initially has the address and value unset, until the parser sets it.
@@ -158,16 +200,23 @@ class Variable:
     def __str__(self):
         return f"""Variable(name={self.name}, value={self.value.__str__()}, at {hex(self.address)})"""
 
+    def operand_value(self) -> int:
+        return self.value.value
+
+    @staticmethod
+    def operand_kind() -> str:
+        return LITERAL_KIND
+
     @staticmethod
-    def parse_value(val: str) -> 'Variable':
+    def parse_value(val: str, context: AssemblyContext | None = None) -> 'Variable':
         """
         Parses the Variable. Always returns an unset variable
         :param val: str
-        :param global_states
+        :param context
         :return:
         """
 
-        global_state = variables_instance()
+        global_state = variables_instance(context)
         global_var: Variable | None = global_state.get(val, None)
 
         if global_var is not None:
@@ -182,13 +231,14 @@ class Variable:
         return variable
 
     @staticmethod
-    def parse_definition(line: str, address: int) -> Union['Variable', None]:
+    def parse_definition(line: str, address: int, context: AssemblyContext | None = None) -> Union['Variable', None]:
         """
         Parses a code line to check for a variable. Returns None in case of no such thing.
 
-        In case of conflicting variable names, raises an Exception
+        In case of conflicting variable names, raises an AssemblyError
         :param line: str
         :param address
+        :param context
         :return: Variable | None
         """
 
@@ -204,24 +254,37 @@ class Variable:
         name: str = words[1]
         val: str = words[2]
 
-        global_state = variables_instance()
+        return Variable.define(name, Literal.parse_value(val), address, context)
+
+    @staticmethod
+    def define(name: str, value: Literal | None, address: int, context: AssemblyContext | None = None) -> 'Variable':
+        """
+        Defines the variable at the address. In case of conflicting variable names, raises a DuplicateDefinitionError
+        :param name: str
+        :param value: Literal | None
+        :param address
+        :param context
+        :return: Variable
+        """
+
+        global_state = variables_instance(context)
         global_var: Variable | None = global_state.get(name, None)
 
         # Check if it exists
         if global_var is not None:
             if global_var.address is not None:
-                raise Exception(f"Variable '{name}' was already defined")
+                raise DuplicateDefinitionError(f"Variable '{name}' was already defined", symbol=name)
             else:
                 # print("Setting data for variable ", name)
                 # print("Value: ", val),
                 # print("Addr: ", current_address_instance())
                 global_var.address = address
-                global_var.value = Literal.parse_value(val)
+                global_var.value = value
                 return global_var
 
         global_var = Variable(
             name=name,
-            value=Literal.parse_value(val),
+            value=value,
             address=address
         )
 
@@ -229,7 +292,7 @@ class Variable:
         return global_var
 
 
-@dataclass
+@dataclass(slots=True)
 class Register:
     """
     A Register class.
@@ -242,6 +305,13 @@ class Register:
     def __str__(self):
         return f"Register({self.name if self.is_special_reg else hex(self.name)})"
 
+    def operand_value(self) -> int:
+        return self.name
+
+    def operand_kind(self) -> str:
+        # Special registers are implied by the instruction, so they are told apart by name
+        return self.name if self.is_special_reg else NORMAL_REGISTER_KIND
+
     @staticmethod
     def parse_value(val: str) -> Union["Register", None]:
         """
@@ -259,7 +329,7 @@ class Register:
         parsed_val: int = int(val[1:], 16)
 
         if parsed_val > 0xF:
-            raise Exception(f"Invalid Register value for register '{val}'")
+            raise AssemblyError(f"Invalid Register value for register '{val}'")
 
         return Register(
             name=parsed_val,
@@ -267,13 +337,15 @@ class Register:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class Instruction(Bytecode):
     command: str
     address: int
     operand1: Register | Label | Literal | None = None
     operand2: Register | Literal | Variable | None = None
     optional_operand: Literal | Variable | None = None # Used by DRW
+    # Resolved while parsing, from the command and the kinds of the operands
+    encoding: InstructionEncoding | None = field(default=None, repr=False, compare=False)
 
     def __str__(self):
         return f"Instruction(\n"\
@@ -286,84 +358,24 @@ class Instruction(Bytecode):
             ")"
 
     def to_bytes(self) -> bytes:
+        # The encoding was resolved while parsing, only the operand values are left to fill in
+        return self.encoding.encode(
+            (self.operand1, self.operand2, self.optional_operand)
+        ).to_bytes(2, "big", signed=False)
 
-        # We can finally return, based on the set parameters
-        # Op code first
-
-        # print("CHECKING FOR COMMAND", self.command)
-        # print("WITH OPERAND 1", self.operand1)
-        # print("OPERAND 2", self.operand2)
-        # print("OPTIONAL OPERAND", self.optional_operand)
-        # print()
-
-        # We will convert each Label and Variable into a Literal
-        operand1 = self.operand1
-        operand2 = self.operand2
-        operand3 = self.optional_operand
-
-        # Print the types before
-        # print("BEFORE TYPES: ", type(operand1), type(operand2), type(operand3))
-        def get_operand_value(operand):
-            if isinstance(operand, Variable):
-                return operand.value
-            elif isinstance(operand, Label):
-                return Literal(operand.address)
-            return operand
-
-        operand1 = get_operand_value(operand1)
-        operand2 = get_operand_value(operand2)
-        operand3 = get_operand_value(operand3)
-
-        # print("AFTER TYPES: ", type(operand1), type(operand2), type(operand3))
-
-        # Drw Edge case
-        if operand3 is not None:
-            # DRW CASE
-            entry: InstructionsLUTEntry = get_drw_entry()
-            return entry.get_bytes(
-                operand1,
-                operand2,
-                operand3
-            )
-
-        # Check if the first operand is a special register
-        if type(operand1) == Register and operand1.is_special_reg:
-            entry: InstructionsLUTEntry = get_special_entry(
-                self.command,
-                operand1.name,
-                type(operand1),
-                type(operand2)
-            )
-            return entry.get_bytes(
-                operand1,
-                operand2,
-                operand3
-            )
-
-        # We have the special case cheked up.
-        # We need to check the LD_RI case
-        if type(operand1) == Register and type(operand2) == Register and operand2.is_special_reg == True:
-            entry: InstructionsLUTEntry = get_edge_entry(
-                command_name=self.command,
-                register2_name=operand2.name
-            )
-            return entry.get_bytes(
-                operand1,
-                operand2,
-                operand3
-            )
-
-        # Now we can check the generic cases
-        entry: InstructionsLUTEntry = get_normal_entry(
+    def resolve_encoding(self) -> InstructionEncoding | None:
+        """
+        Looks up the encoding of the instruction by its command and the kinds of its operands. Sets and returns it, or
+        returns None in case there is no such instruction
+        :return: InstructionEncoding | None
+        """
+        self.encoding = get_encoding(
             self.command,
-            type(operand1),
-            type(operand2)
-        )
-        return entry.get_bytes(
-            operand1,
-            operand2,
-            operand3
+            None if self.operand1 is None else self.operand1.operand_kind(),
+            None if self.operand2 is None else self.operand2.operand_kind(),
+            None if self.optional_operand is None else self.optional_operand.operand_kind()
         )
+        return self.encoding
 
     @staticmethod
     def byte_length() -> int:
@@ -372,12 +384,14 @@ class Instruction(Bytecode):
     @staticmethod
     def parse_definition(
             line: str,
-            address: int
+            address: int,
+            context: AssemblyContext | None = None
     ) -> Union['Instruction', None]:
         """
         Function to parse line of code into Instruction. Returns None in case of an invalid syntax  or Literal
         :param line: str
         :param address
+        :param context
         :return: Instruction | None
         """
 
@@ -385,37 +399,35 @@ class Instruction(Bytecode):
         line = line.replace(Tokens.SEPARATOR_TOKEN, Tokens.ZERO_WIDTH_TOKEN)
         words: list[str] = line.split(Tokens.WHITESPACE_TOKEN)
 
-        __INSTRUCTION_LIST: list[str] = [
-            "SYS","CLS","RET","JP","CALL","SE","SNE","LD","ADD","OR","AND","XOR","SUB","SHR","SUBN","SHL","RND","DRW","SKP","SKNP","NOOP"
-        ]
-
-        if words[0] not in __INSTRUCTION_LIST:
+        if words[0] not in INSTRUCTION_NAMES:
             return None
 
         # print("INSTRUCTION STR: ", matches)
 
         # Create the instruction
         if len(words) == 1:
-            return Instruction(command=words[0], address=address)
+            instruction: Instruction = Instruction(command=words[0], address=address)
+            return instruction if instruction.resolve_encoding() is not None else None
         elif len(words) == 2:
 
             # We will parse the second argument. It can be either a register, label or a literal
             if words[1] != Tokens.ADDRESS_SPECIAL_TOKEN:
                 parsed_operand1_val = Register.parse_value(words[1]) or \
-                                 Label.parse_value(words[1]) or \
+                                 Label.parse_value(words[1], context) or \
                                  Literal.parse_value(words[1])
             else:
-                parsed_operand1_val = Literal(value=address)
+                parsed_operand1_val = AddressLiteral(value=address)
 
             # If it's still None return
             if parsed_operand1_val is None:
                 return None
 
-            return Instruction(
+            instruction = Instruction(
                 command=words[0],
                 operand1=parsed_operand1_val,
                 address=address
             )
+            return instruction if instruction.resolve_encoding() is not None else None
 
         # Parse the last argument
         # Regster first
@@ -435,16 +447,16 @@ class Instruction(Bytecode):
         if words[2] != Tokens.ADDRESS_SPECIAL_TOKEN:
             parsed_operand2_val = Register.parse_value(words[2]) or \
                          Literal.parse_value(words[2]) or \
-                         Label.parse_value(words[2]) or \
-                         Variable.parse_value(words[2])
+                         Label.parse_value(words[2], context) or \
+                         Variable.parse_value(words[2], context)
         else:
-            parsed_operand2_val = Literal(value=address)
+            parsed_operand2_val = AddressLiteral(value=address)
 
         # If it's still none, return None
         if parsed_operand2_val is None:
             return None
 
-        instruction: Instruction = Instruction(
+        instruction = Instruction(
             command=words[0],
             operand1=Register.parse_value(words[1]),
             operand2=parsed_operand2_val,
@@ -454,9 +466,9 @@ class Instruction(Bytecode):
         # Parse the optional argument
         if len(words) == 4:
             if words[-1] != Tokens.ADDRESS_SPECIAL_TOKEN:
-                parsed_optional_val = Literal.parse_value(words[-1]) or Variable.parse_value(words[-1])
+                parsed_optional_val = Literal.parse_value(words[-1]) or Variable.parse_value(words[-1], context)
             else:
-                parsed_optional_val = Literal(value=address)
+                parsed_optional_val = AddressLiteral(value=address)
 
             # If it's still None
             if parsed_optional_val is None:
@@ -464,4 +476,5 @@ class Instruction(Bytecode):
 
             instruction.optional_operand = parsed_optional_val
 
-        return instruction
+        # Resolve the encoding once, so no lookups are needed when converting to bytes
+        return instruction if instruction.resolve_encoding() is not None else None
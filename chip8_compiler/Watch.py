@@ -0,0 +1,280 @@
+import os
+import threading
+from timeit import default_timer as timer
+from typing import Callable, Iterable
+
+from .Batch import BuildResult, SOURCE_EXTENSION, OUTPUT_EXTENSION
+from .Interfaces import AssemblyError
+from .Parser import assemble_file
+from .Preprocessor import Preprocessor
+from .Program import write_atomically
+
+# Watch mode: a long-lived process rebuilding the sources of a directory as
+# they change.
+#
+# The files are polled: every poll stats the watched sources and the files
+# they include, and lists again only the directories whose modification time
+# changed (a file being added or removed changes it). While nothing changes,
+# the polls back off up to max_interval, so a large idle tree costs little.
+#
+# A change starts a burst: the changed files are collected until no more
+# change is seen for the debounce delay, then only the changed sources and
+# the sources including a changed file (see DependencyGraph) are assembled
+# again. Sources that failed are retried on every rebuild, a missing include
+# may have appeared. The outputs are written atomically, so a reader never
+# sees a partial program.
+
+DEFAULT_INTERVAL: float = 0.25
+DEFAULT_MAX_INTERVAL: float = 2.0
+DEFAULT_DEBOUNCE: float = 0.2
+
+
+def _file_state(path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Watcher:
+    """
+    Rebuilds the sources of a directory (searched recursively) into the output directory, mirroring its layout, as
+    they or the files they include change. See run, or poll for driving it step by step
+    """
+
+    def __init__(
+            self,
+            source_dir: str,
+            output_dir: str,
+            include_dirs: Iterable[str] = (),
+            interval: float = DEFAULT_INTERVAL,
+            max_interval: float = DEFAULT_MAX_INTERVAL,
+            debounce: float = DEFAULT_DEBOUNCE,
+            on_build: Callable[[list[BuildResult]], None] | None = None
+    ):
+        """
+        :param source_dir: str
+        :param output_dir: str
+        :param include_dirs: Iterable[str], where the included files are searched (see Preprocessor)
+        :param interval: float, the time between two polls, in seconds
+        :param max_interval: float, the time between two polls once idle
+        :param debounce: float, how long the files must be left unchanged before rebuilding
+        :param on_build: called with the results of every rebuild
+        """
+        self.source_dir: str = os.path.abspath(source_dir)
+        self.output_dir: str = os.path.abspath(output_dir)
+        self.preprocessor: Preprocessor = Preprocessor(include_dirs)
+        self.interval: float = interval
+        self.max_interval: float = max_interval
+        self.debounce: float = debounce
+        self.on_build: Callable[[list[BuildResult]], None] | None = on_build
+
+        # The sources of every directory, by the modification time of the directory
+        self.__directories: dict[str, tuple[int, list[str], list[str]]] = {}
+        # The last seen state of every watched file
+        self.__files: dict[str, tuple[int, int] | None] = {}
+        self.__sources: set[str] = set()
+        # The files included by the sources, updated by every build
+        self.__dependencies: set[str] = set()
+        self.__failed: set[str] = set()
+
+        self.__pending: set[str] = set()
+        self.__last_change: float = 0.0
+
+    @property
+    def sources(self) -> list[str]:
+        return sorted(self.__sources)
+
+    def output_path(self, source: str) -> str:
+        relative_source: str = os.path.relpath(source, self.source_dir)
+        return os.path.join(self.output_dir, os.path.splitext(relative_source)[0] + OUTPUT_EXTENSION)
+
+    def __list_sources(self, directory: str, found: set[str]) -> None:
+        # Lists the sources under the directory, reusing the listings of the unchanged directories
+        try:
+            mtime_ns: int = os.stat(directory).st_mtime_ns
+        except OSError:
+            self.__directories.pop(directory, None)
+            return
+
+        listing: tuple[int, list[str], list[str]] | None = self.__directories.get(directory, None)
+        if listing is None or listing[0] != mtime_ns:
+            sources: list[str] = []
+            subdirectories: list[str] = []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.path)
+                        elif entry.name.endswith(SOURCE_EXTENSION):
+                            sources.append(entry.path)
+            except OSError:
+                return
+            listing = (mtime_ns, sources, subdirectories)
+            self.__directories[directory] = listing
+
+        found.update(listing[1])
+        for subdirectory in listing[2]:
+            self.__list_sources(subdirectory, found)
+
+    def scan(self) -> set[str]:
+        """
+        Polls the watched files once. Returns the files added, changed or removed since the last scan
+        :return: set[str]
+        """
+        found: set[str] = set()
+        self.__list_sources(self.source_dir, found)
+
+        watched: set[str] = found | self.__dependencies
+
+        changed: set[str] = set()
+        for path in watched:
+            state: tuple[int, int] | None = _file_state(path)
+            if path not in self.__files or self.__files[path] != state:
+                changed.add(path)
+            self.__files[path] = state
+
+        # Files no longer watched, e.g. removed sources
+        for path in list(self.__files):
+            if path not in watched:
+                del self.__files[path]
+                changed.add(path)
+
+        # The files included by the others are fragments, not sources: their includes are followed again once changed
+        graph = self.preprocessor.graph
+        for path in changed & found:
+            try:
+                self.preprocessor.dependencies(path)
+            except (AssemblyError, OSError, ValueError):
+                # Reported by the build of the source
+                pass
+        included: set[str] = set().union(*(graph.includes(path) for path in found))
+        sources: set[str] = found - included
+
+        # A fragment no longer included is built as a source from now on
+        changed |= sources - self.__sources
+        self.__sources = sources
+        return changed
+
+    def affected(self, changed: Iterable[str]) -> list[str]:
+        """
+        The sources to assemble again after the files changed: the changed sources and the ones including a changed
+        file, directly or not
+        :param changed: Iterable[str]
+        :return: list[str]
+        """
+        affected: set[str] = set()
+        for path in changed:
+            if path in self.__sources:
+                affected.add(path)
+            affected |= self.preprocessor.graph.dependents(path) & self.__sources
+        return sorted(affected)
+
+    def build(self, sources: Iterable[str]) -> list[BuildResult]:
+        """
+        Assembles the sources into their outputs. Never raises, the errors are stored in the results
+        :param sources: Iterable[str]
+        :return: list[BuildResult]
+        """
+        results: list[BuildResult] = []
+
+        for source in sources:
+            start = timer()
+            result: BuildResult = BuildResult(source=source, output=self.output_path(source))
+
+            try:
+                bytecode: bytes = assemble_file(source, preprocessor=self.preprocessor).to_bytes()
+                write_atomically(result.output, bytecode)
+                result.size = len(bytecode)
+                self.__failed.discard(source)
+            except (AssemblyError, OSError, ValueError) as e:
+                result.error = f"{type(e).__name__}: {e}"
+                self.__failed.add(source)
+
+            result.elapsed = timer() - start
+            results.append(result)
+
+        # The includes of the rebuilt sources are watched from now on
+        graph = self.preprocessor.graph
+        self.__dependencies = set().union(*(graph.includes(path) for path in graph.sources()))
+        for dependency in self.__dependencies:
+            if dependency not in self.__files:
+                self.__files[dependency] = _file_state(dependency)
+
+        if self.on_build is not None and results:
+            self.on_build(results)
+        return results
+
+    def __remove_outputs(self, removed: Iterable[str]) -> None:
+        for source in removed:
+            self.__failed.discard(source)
+            try:
+                os.remove(self.output_path(source))
+            except OSError:
+                pass
+
+    def start(self) -> list[BuildResult]:
+        """
+        Builds every source, and starts watching them
+        :return: list[BuildResult]
+        """
+        self.scan()
+        return self.build(self.sources)
+
+    def poll(self, now: float | None = None) -> list[BuildResult]:
+        """
+        A single step of the watch loop: scans the files, and rebuilds the affected sources once the changes settled.
+        Returns the results of the rebuild, if any
+        :param now: float | None, the current time (timer), for testing
+        :return: list[BuildResult]
+        """
+        changed: set[str] = self.scan()
+        now = timer() if now is None else now
+
+        if changed:
+            self.__pending |= changed
+            self.__last_change = now
+
+        if not self.__pending or now - self.__last_change < self.debounce:
+            return []
+
+        pending: set[str] = self.__pending
+        self.__pending = set()
+
+        self.__remove_outputs(
+            path for path in pending
+            if path.startswith(self.source_dir + os.sep) and path.endswith(SOURCE_EXTENSION) and
+            path not in self.__sources
+        )
+        return self.build(sorted(set(self.affected(pending)) | (self.__failed & self.__sources)))
+
+    @property
+    def settling(self) -> bool:
+        """
+        Whether changes are waiting for the debounce delay
+        """
+        return len(self.__pending) > 0
+
+    def run(self, stop: threading.Event | None = None) -> None:
+        """
+        Builds every source, then rebuilds them as they change, until the event is set (or forever)
+        :param stop: threading.Event | None
+        :return:
+        """
+        if stop is None:
+            stop = threading.Event()
+
+        self.start()
+        interval: float = self.interval
+
+        while not stop.wait(interval):
+            results: list[BuildResult] = self.poll()
+
+            if self.settling:
+                interval = min(self.interval, self.debounce)
+            elif results:
+                interval = self.interval
+            else:
+                # Idle, the polls back off
+                interval = min(interval * 2, self.max_interval)
@@ -5,7 +5,7 @@ if TYPE_CHECKING:
         Literal
     )
 
-from .Interfaces import InstructionsLUTEntry
+from .Interfaces import InstructionsLUTEntry, InstructionEncoding
 
 # This namespace is meant to hide the LUTs and chip instructions.
 # It is very ugly on purpose. Deal with it
@@ -83,254 +83,391 @@ __LD_FR_FUNCTION = __two_operand_i_nreg
 __LD_BR_OPCODE = 0xF033
 __LD_BR_FUNCTION = __two_operand_i_nreg
 
-__NORMAL_INSTRUCTIONS_LUT: dict = {
-    "NOOP": InstructionsLUTEntry(
-        command_code=0x0000,
-        func=__no_operand
-    ),
-    "CLS": InstructionsLUTEntry(
-        command_code=0x00E0,
-        func=__no_operand
-    ),
-    "RET": InstructionsLUTEntry(
-        command_code=0x00EE,
-        func=__no_operand
-    ),
-    "SYS": {
-        "Literal": InstructionsLUTEntry(
+def __build_luts() -> tuple[dict, dict, dict]:
+    # The normal, special and edge case LUTs
+    normal: dict = {
+        "NOOP": InstructionsLUTEntry(
             command_code=0x0000,
-            func=__one_operand_addr
-        )
-    },
-    "JP": {
-        "Literal": InstructionsLUTEntry(
-            command_code=0x1000,
-            func=__one_operand_addr
+            func=__no_operand
         ),
-        "Register": {
-            "Literal": InstructionsLUTEntry(
-                command_code=0xB000,
-                func=__two_operand_nreg_addr
-            )
-        }
-    },
-    "CALL": {
-        "Literal": InstructionsLUTEntry(
-            command_code=0x2000,
-            func=__one_operand_addr
-        )
-    },
-    "SE": {
-        "Register": {
-            "Literal": InstructionsLUTEntry(
-                command_code=0x3000,
-                func=__two_operand_nreg_byte
-            ),
-            "Register": InstructionsLUTEntry(
-                command_code=0x5000,
-                func=__two_operand_nreg_nreg
-            )
-        }
-    },
-    "SNE": {
-        "Register": {
+        "CLS": InstructionsLUTEntry(
+            command_code=0x00E0,
+            func=__no_operand
+        ),
+        "RET": InstructionsLUTEntry(
+            command_code=0x00EE,
+            func=__no_operand
+        ),
+        "SYS": {
             "Literal": InstructionsLUTEntry(
-                command_code=0x4000,
-                func=__two_operand_nreg_byte
-            ),
-            "Register": InstructionsLUTEntry(
-                command_code=0x9000,
-                func=__two_operand_nreg_nreg
+                command_code=0x0000,
+                func=__one_operand_addr
             )
-        }
-    },
-    "LD": {
-        "Register": {
+        },
+        "JP": {
             "Literal": InstructionsLUTEntry(
-                0x6000,
-                __two_operand_nreg_byte
+                command_code=0x1000,
+                func=__one_operand_addr
             ),
-            "Register": InstructionsLUTEntry(
-                0x8000,
-                __two_operand_nreg_nreg
-            )
-        }
-    },
-    "ADD": {
-        "Register": {
+            "Register": {
+                "Literal": InstructionsLUTEntry(
+                    command_code=0xB000,
+                    func=__two_operand_nreg_addr
+                )
+            }
+        },
+        "CALL": {
             "Literal": InstructionsLUTEntry(
-                0x7000,
-                __two_operand_nreg_byte
-            ),
-            "Register": InstructionsLUTEntry(
-                0x8004,
-                __two_operand_nreg_nreg
-            )
-        }
-    },
-    "OR": {
-        "Register": {
-            "Register": InstructionsLUTEntry(
-                0x8001,
-                __two_operand_nreg_nreg
+                command_code=0x2000,
+                func=__one_operand_addr
             )
-        }
-    },
-    "AND": {
-        "Register": {
-            "Register": InstructionsLUTEntry(
-                0x8002,
-                __two_operand_nreg_nreg
-            )
-        }
-    },
-    "XOR": {
-        "Register": {
-            "Register": InstructionsLUTEntry(
-                0x8003,
-                __two_operand_nreg_nreg
-            )
-        }
-    },
-    "SUB": {
-        "Register": {
-            "Register": InstructionsLUTEntry(
-                0x8005,
-                __two_operand_nreg_nreg
-            )
-        }
-    },
-    "SHR": {
-        "Register": {
-            "Register": InstructionsLUTEntry(
-                0x8006,
-                __two_operand_nreg_nreg
-            )
-        }
-    },
-    "SUBN": {
-        "Register": {
+        },
+        "SE": {
+            "Register": {
+                "Literal": InstructionsLUTEntry(
+                    command_code=0x3000,
+                    func=__two_operand_nreg_byte
+                ),
+                "Register": InstructionsLUTEntry(
+                    command_code=0x5000,
+                    func=__two_operand_nreg_nreg
+                )
+            }
+        },
+        "SNE": {
+            "Register": {
+                "Literal": InstructionsLUTEntry(
+                    command_code=0x4000,
+                    func=__two_operand_nreg_byte
+                ),
+                "Register": InstructionsLUTEntry(
+                    command_code=0x9000,
+                    func=__two_operand_nreg_nreg
+                )
+            }
+        },
+        "LD": {
+            "Register": {
+                "Literal": InstructionsLUTEntry(
+                    0x6000,
+                    __two_operand_nreg_byte
+                ),
+                "Register": InstructionsLUTEntry(
+                    0x8000,
+                    __two_operand_nreg_nreg
+                )
+            }
+        },
+        "ADD": {
+            "Register": {
+                "Literal": InstructionsLUTEntry(
+                    0x7000,
+                    __two_operand_nreg_byte
+                ),
+                "Register": InstructionsLUTEntry(
+                    0x8004,
+                    __two_operand_nreg_nreg
+                )
+            }
+        },
+        "OR": {
+            "Register": {
+                "Register": InstructionsLUTEntry(
+                    0x8001,
+                    __two_operand_nreg_nreg
+                )
+            }
+        },
+        "AND": {
+            "Register": {
+                "Register": InstructionsLUTEntry(
+                    0x8002,
+                    __two_operand_nreg_nreg
+                )
+            }
+        },
+        "XOR": {
+            "Register": {
+                "Register": InstructionsLUTEntry(
+                    0x8003,
+                    __two_operand_nreg_nreg
+                )
+            }
+        },
+        "SUB": {
+            "Register": {
+                "Register": InstructionsLUTEntry(
+                    0x8005,
+                    __two_operand_nreg_nreg
+                )
+            }
+        },
+        "SHR": {
+            "Register": {
+                "Register": InstructionsLUTEntry(
+                    0x8006,
+                    __two_operand_nreg_nreg
+                )
+            }
+        },
+        "SUBN": {
+            "Register": {
+                "Register": InstructionsLUTEntry(
+                    0x8007,
+                    __two_operand_nreg_nreg
+                )
+            }
+        },
+        "SHL": {
+            "Register": {
+                "Register": InstructionsLUTEntry(
+                    0x800E,
+                    __two_operand_nreg_nreg
+                )
+            }
+        },
+        "RND": {
+            "Register": {
+                "Literal": InstructionsLUTEntry(
+                    0xC000,
+                    __two_operand_nreg_byte
+                )
+            }
+        },
+        "SKP": {
             "Register": InstructionsLUTEntry(
-                0x8007,
-                __two_operand_nreg_nreg
+                0xE09E,
+                __one_operand_normal_reg
             )
-        }
-    },
-    "SHL": {
-        "Register": {
+        },
+        "SKNP": {
             "Register": InstructionsLUTEntry(
-                0x800E,
-                __two_operand_nreg_nreg
+                0xE0A1,
+                __one_operand_normal_reg
             )
-        }
-    },
-    "RND": {
-        "Register": {
-            "Literal": InstructionsLUTEntry(
-                0xC000,
-                __two_operand_nreg_byte
-            )
-        }
-    },
-    "SKP": {
-        "Register": InstructionsLUTEntry(
-            0xE09E,
-            __one_operand_normal_reg
-        )
-    },
-    "SKNP": {
-        "Register": InstructionsLUTEntry(
-            0xE0A1,
-            __one_operand_normal_reg
-        )
-    },
-}
+        },
+    }
 
-__SPECIAL_INSTRUCTIONS_LUT: dict = {
-            "LD": {
-                "I": {
-                    "Register": {
-                        "Literal": InstructionsLUTEntry(
-                            0xA000,
-                            __two_operand_i_addr
-                        ),
-                        "Register": InstructionsLUTEntry(
-                            0xF055,
-                            __two_operand_i_nreg
-                        )
-                    }
-                },
-                "DT": {
-                    "Register": {
-                        "Register": InstructionsLUTEntry(
-                            __LD_DTR_OPCODE,
-                            __LD_DTR_FUNCTION
-                        )
-                    }
-                },
-                "ST": {
-                    "Register": {
-                        "Register": InstructionsLUTEntry(
-                            __LD_STR_OPCODE,
-                            __LD_STR_FUNCTION
-                        )
-                    }
-                },
-                "F": {
-                    "Register": {
-                        "Register": InstructionsLUTEntry(
-                            __LD_FR_OPCODE,
-                            __LD_FR_FUNCTION
-                        )
-                    }
-                },
-                "B": {
-                    "Register": {
-                        "Register": InstructionsLUTEntry(
-                            __LD_BR_OPCODE,
-                            __LD_BR_FUNCTION
-                        )
-                    }
+    special: dict = {
+        "LD": {
+            "I": {
+                "Register": {
+                    "Literal": InstructionsLUTEntry(
+                        0xA000,
+                        __two_operand_i_addr
+                    ),
+                    "Register": InstructionsLUTEntry(
+                        0xF055,
+                        __two_operand_i_nreg
+                    )
+                }
+            },
+            "DT": {
+                "Register": {
+                    "Register": InstructionsLUTEntry(
+                        __LD_DTR_OPCODE,
+                        __LD_DTR_FUNCTION
+                    )
+                }
+            },
+            "ST": {
+                "Register": {
+                    "Register": InstructionsLUTEntry(
+                        __LD_STR_OPCODE,
+                        __LD_STR_FUNCTION
+                    )
+                }
+            },
+            "F": {
+                "Register": {
+                    "Register": InstructionsLUTEntry(
+                        __LD_FR_OPCODE,
+                        __LD_FR_FUNCTION
+                    )
                 }
-
             },
-            "ADD": {
-                "I": {
-                    "Register": {
-                        "Register": InstructionsLUTEntry(
-                            0xF01E,
-                            __two_operand_i_nreg
-                        )
-                    }
+            "B": {
+                "Register": {
+                    "Register": InstructionsLUTEntry(
+                        __LD_BR_OPCODE,
+                        __LD_BR_FUNCTION
+                    )
+                }
+            }
+
+        },
+        "ADD": {
+            "I": {
+                "Register": {
+                    "Register": InstructionsLUTEntry(
+                        0xF01E,
+                        __two_operand_i_nreg
+                    )
                 }
             }
         }
+    }
 
-__EDGE_NREG_SREG_CASE: dict = {
-    "LD": {
-        # Second register name
-        "I": InstructionsLUTEntry(
-            command_code=__LD_RI_OPCODE,
-            func=__LD_RI_FUNCTION
-        ),
-        "DT": InstructionsLUTEntry(
-            command_code=__LD_RDT_OPCODE,
-            func=__LD_RDT_FUNCTION
-        ),
-        "K": InstructionsLUTEntry(
-            command_code=__LD_RK_OPCODE,
-            func=__LD_RK_FUNCTION
-        )
+    edge: dict = {
+        "LD": {
+            # Second register name
+            "I": InstructionsLUTEntry(
+                command_code=__LD_RI_OPCODE,
+                func=__LD_RI_FUNCTION
+            ),
+            "DT": InstructionsLUTEntry(
+                command_code=__LD_RDT_OPCODE,
+                func=__LD_RDT_FUNCTION
+            ),
+            "K": InstructionsLUTEntry(
+                command_code=__LD_RK_OPCODE,
+                func=__LD_RK_FUNCTION
+            )
+        }
     }
+
+    return normal, special, edge
+
+
+# The LUTs, built on the first lookup (e.g. for the encoding table) rather than on import
+__LUTS: list[dict] = []
+
+
+def __luts() -> list[dict]:
+    if not __LUTS:
+        __LUTS.extend(__build_luts())
+    return __LUTS
+
+
+__DRW_ENTRY = InstructionsLUTEntry(
+    command_code=__DRW_OPCODE,
+    func=__DRW_FUNCTION
+)
+
+
+# Flat encoding table, built once from the LUTs above.
+# Keyed by (command, operand1 kind, operand2 kind, operand3 kind), where the kind of an operand is
+# NORMAL_REGISTER_KIND for V registers, the name for special registers, LITERAL_KIND for literals, labels and
+# variables and None for missing operands
+NORMAL_REGISTER_KIND: str = "V"
+LITERAL_KIND: str = "Literal"
+
+__LUT_TYPE_KINDS: dict[str, str] = {
+    "Register": NORMAL_REGISTER_KIND,
+    "Literal": LITERAL_KIND
 }
 
 
+class __FieldProbe:
+    """
+    Operand stand-in with every bit of its field set, used to find out where an entry places its operands
+    """
+    name: int = 0xF
+    value: int = 0xFFFF
+
+
+class __EmptyProbe:
+    name: int = 0
+    value: int = 0
+
+
+def __probe_fields(entry: InstructionsLUTEntry, shape: tuple) -> tuple[tuple[int, int, int], ...]:
+    fields: list[tuple[int, int, int]] = []
+
+    for index, kind in enumerate(shape):
+        if kind is None:
+            continue
+
+        operands = [__EmptyProbe, __EmptyProbe, __EmptyProbe]
+        operands[index] = __FieldProbe
+        bits: int = entry.func(0, *operands)
+
+        if bits == 0:
+            # The operand is implicit in the command code (e.g. special registers)
+            continue
+
+        shift: int = (bits & -bits).bit_length() - 1
+        fields.append((index, shift, bits >> shift))
+
+    return tuple(fields)
+
+
+def __build_encoding_table() -> dict[tuple, InstructionEncoding]:
+    entries: list[tuple[tuple, InstructionsLUTEntry]] = []
+    normal, special, edge = __luts()
+
+    for command, operand1_types in normal.items():
+        if isinstance(operand1_types, InstructionsLUTEntry):
+            entries.append(((command, None, None, None), operand1_types))
+            continue
+
+        for operand1_type, operand2_types in operand1_types.items():
+            operand1_kind: str = __LUT_TYPE_KINDS[operand1_type]
+            if isinstance(operand2_types, InstructionsLUTEntry):
+                entries.append(((command, operand1_kind, None, None), operand2_types))
+                continue
+
+            for operand2_type, entry in operand2_types.items():
+                entries.append(((command, operand1_kind, __LUT_TYPE_KINDS[operand2_type], None), entry))
+
+    for command, registers in special.items():
+        for register1_name, operand1_types in registers.items():
+            # The first operand is always the special register
+            for operand2_type, entry in operand1_types["Register"].items():
+                entries.append(((command, register1_name, __LUT_TYPE_KINDS[operand2_type], None), entry))
+
+    for command, registers in edge.items():
+        for register2_name, entry in registers.items():
+            entries.append(((command, NORMAL_REGISTER_KIND, register2_name, None), entry))
+
+    entries.append((("DRW", NORMAL_REGISTER_KIND, NORMAL_REGISTER_KIND, LITERAL_KIND), __DRW_ENTRY))
+
+    return {
+        key: InstructionEncoding(
+            command=key[0],
+            shape=key[1:],
+            command_code=entry.command_code,
+            fields=__probe_fields(entry, key[1:])
+        )
+        for key, entry in entries
+    }
+
+
+# Built on first use (probing the fields of every entry), not on import
+__ENCODING_TABLE: dict[tuple, InstructionEncoding] = {}
+# The names of every instruction, for classifying the first word of a line. Spelled out rather than read from the
+# LUTs, which are only built on first use
+INSTRUCTION_NAMES: frozenset[str] = frozenset([
+    "NOOP", "CLS", "RET", "SYS", "JP", "CALL", "SE", "SNE", "LD", "ADD", "OR", "AND", "XOR", "SUB", "SHR", "SUBN",
+    "SHL", "RND", "SKP", "SKNP", "DRW"
+])
+
+
 # Public functions
+def get_encoding(
+        command_name: str,
+        operand1_kind: str | None,
+        operand2_kind: str | None,
+        operand3_kind: str | None
+) -> InstructionEncoding | None:
+    """
+    Returns the encoding of the command for the given operand kinds, None if there is no such instruction
+    """
+    return encoding_table().get((command_name, operand1_kind, operand2_kind, operand3_kind), None)
+
+
+def encoding_table() -> dict[tuple, InstructionEncoding]:
+    """
+    Returns the encoding of every instruction, by (command, operand kinds). The table is built on the first call, and
+    filled in place: the same dict is returned every time
+    """
+    if not __ENCODING_TABLE:
+        __ENCODING_TABLE.update(__build_encoding_table())
+    return __ENCODING_TABLE
+
+
 def get_drw_entry() -> InstructionsLUTEntry:
-    return InstructionsLUTEntry(
-        command_code=__DRW_OPCODE,
-        func=__DRW_FUNCTION
-    )
+    return __DRW_ENTRY
 
 
 def get_special_entry(
@@ -342,14 +479,14 @@ def get_special_entry(
     # Convert the types to strings
     op1_type_str: str = operand1_type.__name__
     op2_type_str: str = operand2_type.__name__
-    return __SPECIAL_INSTRUCTIONS_LUT[command_name][register1_name][op1_type_str][op2_type_str]
+    return __luts()[1][command_name][register1_name][op1_type_str][op2_type_str]
 
 
 def get_edge_entry(
         command_name: str,
         register2_name: str
 ) -> InstructionsLUTEntry:
-    return __EDGE_NREG_SREG_CASE[command_name][register2_name]
+    return __luts()[2][command_name][register2_name]
 
 
 def get_normal_entry(
@@ -364,12 +501,13 @@ def get_normal_entry(
     op1_type_str: str = operand1_type.__name__
     op2_type_str: str = operand2_type.__name__
 
+    normal: dict = __luts()[0]
     if op1_type_str == NoneType:
-        return __NORMAL_INSTRUCTIONS_LUT[command_name]
+        return normal[command_name]
 
     # Test for the second operand
     if op2_type_str == NoneType:
-        return __NORMAL_INSTRUCTIONS_LUT[command_name][op1_type_str]
+        return normal[command_name][op1_type_str]
 
-    return __NORMAL_INSTRUCTIONS_LUT[command_name][op1_type_str][op2_type_str]
+    return normal[command_name][op1_type_str][op2_type_str]
 
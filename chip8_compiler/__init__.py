@@ -1 +1,101 @@
-from .Parser import parse_file
\ No newline at end of file
+from typing import TYPE_CHECKING
+
+__version__ = "0.1"
+
+# The public API. The modules are only imported on the first access to one of
+# their names, so importing the package (e.g. to start the CLI) does not pay
+# for the parts of it that are not used, like the process pool of Batch.py.
+# The classes named like their module (Program, Preprocessor, Optimizer) are
+# imported from it: importing the module binds its name in the package.
+__LAZY_NAMES__: dict[str, str] = {
+    "AssemblyContext": "Globals",
+    "AssemblyError": "Interfaces",
+    "InvalidCodeError": "Interfaces",
+    "PreprocessorError": "Interfaces",
+    "LinkError": "Interfaces",
+    "MachineError": "Interfaces",
+    "OptimizationError": "Interfaces",
+    "DuplicateDefinitionError": "Interfaces",
+    "assemble": "Parser",
+    "assemble_file": "Parser",
+    "assemble_program": "Parser",
+    "parse_file": "Parser",
+    "parse_stream": "Parser",
+    "write_output": "Program",
+    "write_atomically": "Program",
+    "build_many": "Batch",
+    "BatchSummary": "Batch",
+    "BuildResult": "Batch",
+    "assemble_cached": "Cache",
+    "BuildCache": "Cache",
+    "AssemblyStats": "Stats",
+    "CProfileHook": "Stats",
+    "TracemallocHook": "Stats",
+    "SourceCache": "Preprocessor",
+    "DependencyGraph": "Preprocessor",
+    "ObjectModule": "Linker",
+    "assemble_object": "Linker",
+    "link": "Linker",
+    "link_files": "Linker",
+    "LinkResult": "Linker",
+    "IncrementalAssembler": "Incremental",
+    "IncrementalResult": "Incremental",
+    "Watcher": "Watch",
+    "Machine": "vm",
+    "StopReason": "vm",
+    "run_rom": "vm",
+    "disassemble": "Disassembler",
+    "disassemble_file": "Disassembler",
+    "Disassembly": "Disassembler",
+    "OptimizationReport": "Optimizer",
+    "ControlFlowGraph": "ControlFlow",
+    "AsyncAssembler": "Async",
+    "assemble_file_async": "Async",
+    "build_stream": "Async",
+    "Diagnostic": "Diagnostics",
+    "DiagnosticKind": "Diagnostics",
+    "diagnose": "Diagnostics",
+    "diagnose_file": "Diagnostics"
+}
+
+__all__ = ["__version__", *__LAZY_NAMES__]
+
+if TYPE_CHECKING:
+    from .Globals import AssemblyContext
+    from .Interfaces import (
+        AssemblyError, InvalidCodeError, PreprocessorError, LinkError, MachineError, OptimizationError,
+        DuplicateDefinitionError
+    )
+    from .Parser import assemble, assemble_file, assemble_program, parse_file, parse_stream
+    from .Program import write_output, write_atomically
+    from .Batch import build_many, BatchSummary, BuildResult
+    from .Cache import assemble_cached, BuildCache
+    from .Stats import AssemblyStats, CProfileHook, TracemallocHook
+    from .Preprocessor import SourceCache, DependencyGraph
+    from .Linker import ObjectModule, assemble_object, link, link_files, LinkResult
+    from .Incremental import IncrementalAssembler, IncrementalResult
+    from .Watch import Watcher
+    from .vm import Machine, StopReason, run_rom
+    from .Disassembler import disassemble, disassemble_file, Disassembly
+    from .Optimizer import OptimizationReport
+    from .ControlFlow import ControlFlowGraph
+    from .Async import AsyncAssembler, assemble_file_async, build_stream
+    from .Diagnostics import Diagnostic, DiagnosticKind, diagnose, diagnose_file
+
+
+def __getattr__(name: str):
+    module_name: str | None = __LAZY_NAMES__.get(name, None)
+    if module_name is None:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+    import importlib
+
+    value = getattr(importlib.import_module(f".{module_name}", __name__), name)
+    # Cached, the next accesses do not go through __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(__all__))
+
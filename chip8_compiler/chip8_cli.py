@@ -1,19 +1,62 @@
-import argparse
+import sys
+from typing import TYPE_CHECKING
 
 import chip8_compiler as cc
 
+# argparse is only imported once a command line is parsed, not with the module
+if TYPE_CHECKING:
+    import argparse
+
 
 FILE_EXTENSION: str = ".mini8"
 
 
 def is_chip8_file(file_path: str) -> str:
+    import argparse
+
     if not file_path.endswith(FILE_EXTENSION):
-        raise argparse.ArgumentTypeError("Input file must have a '.chip8' extension")
+        raise argparse.ArgumentTypeError(f"Input file must have a '{FILE_EXTENSION}' extension")
     return file_path
 
 
-def main() -> None:
-    parser = argparse.ArgumentParser(description="Allows assembly of '.mini8' files.")
+def positive_int(value: str) -> int:
+    import argparse
+
+    parsed_value: int = int(value)
+    if parsed_value < 1:
+        raise argparse.ArgumentTypeError("Value must be a positive integer")
+    return parsed_value
+
+
+def add_cache_argument(parser: 'argparse.ArgumentParser') -> None:
+    parser.add_argument(
+        "--cache-dir",
+        help="Reuse the results of previous assemblies of unchanged sources, stored in this directory.",
+        default=None
+    )
+
+
+def add_include_argument(parser: 'argparse.ArgumentParser') -> None:
+    parser.add_argument(
+        "-I", "--include-dir",
+        help="Search the included files in this directory too, after the directory of the including file.",
+        action="append",
+        default=[],
+        dest="include_dirs"
+    )
+
+
+def assemble_main(argv: list[str]) -> int:
+    import argparse
+
+    from .Preprocessor import Preprocessor
+
+    parser = argparse.ArgumentParser(
+        prog="chip8_compiler",
+        description="Allows assembly of '.mini8' files.",
+        epilog="Use 'chip8_compiler build -h' for assembling many files at once, 'chip8_compiler link -h' for linking "
+               "object files."
+    )
     parser.add_argument(
         "-i", "--input",
         help="The path to the input file.",
@@ -23,13 +66,552 @@ def main() -> None:
     parser.add_argument(
         "-o", "--output",
         help="The path to the output file.",
-        default="./tmp.ch8",
-        nargs=1
+        default="./tmp.ch8"
+    )
+    add_cache_argument(parser)
+    add_include_argument(parser)
+    parser.add_argument(
+        "--mmap",
+        help="Memory-map the input and the output files instead of reading and writing them whole.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "-c", "--object",
+        help="Assemble into a relocatable object file, to be linked with 'chip8_compiler link'.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--daemon",
+        help="Assemble through the assembler server ('chip8_compiler serve') listening on this socket, when it is "
+             "running. Uses the default socket if none is given.",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="SOCKET"
     )
+    parser.add_argument(
+        "--stats",
+        help="Print the time spent in every phase of the assembly and a few counters, as a table or as JSON. The "
+             "file is always assembled locally, without the cache or the server.",
+        nargs="?",
+        const="text",
+        default=None,
+        choices=["text", "json"]
+    )
+    parser.add_argument(
+        "--track-allocations",
+        help="With --stats, also trace the memory allocated in every phase (slower).",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--profile-phase",
+        help="Profile a single phase of the assembly, printing the report on stderr.",
+        default=None,
+        metavar="PHASE"
+    )
+    parser.add_argument(
+        "--profiler",
+        help="The profiler used by --profile-phase.",
+        choices=["cprofile", "tracemalloc"],
+        default="cprofile"
+    )
+
+    parser.add_argument(
+        "-O", "--optimize",
+        help="Apply the optimizations (dead code, tail calls, jump threading, NOOPs, jumps to the next instruction, "
+             "redundant loads of I, data packing) and print the bytes they saved. The file is always assembled "
+             "locally: cannot be combined with -c, --daemon or --cache-dir.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--verify",
+        help="With -O, check that the optimized program has the control flow of the original one.",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--diagnostics",
+        help="Check the whole file first and report every error found (syntax errors, duplicate definitions, "
+             "undefined symbols, ...) with its line and column, as text on stderr or as JSON. Nothing is written if "
+             "there is any.",
+        nargs="?",
+        const="text",
+        default=None,
+        choices=["text", "json"]
+    )
+    parser.add_argument(
+        "--fail-fast",
+        help="With --diagnostics, stop at the first error.",
+        action="store_true"
+    )
+
+    args = parser.parse_args(argv)
+
+    # The flags the modes of assembly would ignore
+    if args.optimize and (args.object or args.daemon is not None or args.cache_dir is not None):
+        parser.error("-O cannot be combined with -c, --daemon or --cache-dir")
+    if args.verify and not args.optimize:
+        parser.error("--verify requires -O")
+    if args.object and (args.stats is not None or args.profile_phase is not None):
+        parser.error("-c cannot be combined with --stats or --profile-phase")
+
+    if args.diagnostics is not None:
+        status: int = diagnostics_main(args)
+        if status != 0:
+            return status
 
-    args = parser.parse_args()
-    compiled_bytecode: bytes = cc.parse_file(file_path=args.input)
+    if args.stats is not None or args.profile_phase is not None:
+        return stats_main(args)
+
+    if args.optimize:
+        return optimize_main(args)
+
+    if args.object:
+        return object_main(args)
+
+    # The server searches the includes next to the sources only
+    if args.daemon is not None and not args.include_dirs:
+        from .Daemon import DaemonClient, DaemonError
+
+        try:
+            DaemonClient(args.daemon or None).assemble(args.input, args.output)
+            return 0
+        except ConnectionError:
+            # Not running, assemble locally
+            pass
+        except DaemonError as e:
+            if e.error_type != "InvalidCodeError":
+                print(e, file=sys.stderr)
+                return 1
+
+            print(e.message)
+            print("Invalid code!")
+            cc.write_output(args.output, b'')
+            return 0
+
+    preprocessor = Preprocessor(args.include_dirs)
+
+    try:
+        if args.cache_dir is not None:
+            compiled_bytecode = cc.assemble_cached(
+                args.input, cc.BuildCache(args.cache_dir), preprocessor=preprocessor
+            ).bytecode
+        else:
+            compiled_bytecode = cc.assemble_file(args.input, use_mmap=args.mmap, preprocessor=preprocessor)
+    except cc.InvalidCodeError as e:
+        print(e)
+        print("Invalid code!")
+        compiled_bytecode = b''
 
     # Write to the file
-    with open(args.output, "wb") as f:
-        f.write(compiled_bytecode)
+    cc.write_output(args.output, compiled_bytecode, use_mmap=args.mmap)
+
+    return 0
+
+
+def diagnostics_main(args: 'argparse.Namespace') -> int:
+    """
+    Checks the file and reports every error found, see assemble_main. Returns 1 if there is any
+    """
+    import json
+    from .Diagnostics import diagnose_file
+    from .Preprocessor import Preprocessor
+
+    diagnostics = diagnose_file(args.input, Preprocessor(args.include_dirs), fail_fast=args.fail_fast)
+
+    if args.diagnostics == "json":
+        print(json.dumps([diagnostic.to_dict() for diagnostic in diagnostics]))
+    else:
+        for diagnostic in diagnostics:
+            print(diagnostic, file=sys.stderr)
+
+    return 1 if diagnostics else 0
+
+
+def stats_main(args: 'argparse.Namespace') -> int:
+    """
+    Assembles the file with the instrumentation on, and the optimizations with -O, see assemble_main
+    """
+    from .Optimizer import Optimizer
+    from .Parser import open_source
+    from .Preprocessor import Preprocessor
+
+    stats = cc.AssemblyStats(track_allocations=args.track_allocations)
+    optimizer = Optimizer(verify=args.verify) if args.optimize else None
+
+    hook = None
+    if args.profile_phase is not None:
+        hook = cc.CProfileHook() if args.profiler == "cprofile" else cc.TracemallocHook()
+        try:
+            stats.attach(args.profile_phase, hook)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+
+    try:
+        with open_source(args.input, args.mmap) as lines:
+            compiled_bytecode = cc.assemble(
+                lines, stats=stats, preprocessor=Preprocessor(args.include_dirs), source_path=args.input,
+                optimizer=optimizer
+            )
+    except cc.OptimizationError as e:
+        print(e, file=sys.stderr)
+        return 1
+    except cc.InvalidCodeError as e:
+        print(e)
+        print("Invalid code!")
+        compiled_bytecode = b''
+
+    cc.write_output(args.output, compiled_bytecode, use_mmap=args.mmap)
+
+    if optimizer is not None and optimizer.report is not None:
+        # Kept off stdout with the JSON stats, which stay parseable
+        print(optimizer.report.format(), file=sys.stderr if args.stats == "json" else sys.stdout)
+    if args.stats == "json":
+        print(stats.to_json())
+    elif args.stats == "text":
+        print(stats.format())
+
+    if hook is not None:
+        print(hook.report(), file=sys.stderr)
+
+    return 0
+
+
+def optimize_main(args: 'argparse.Namespace') -> int:
+    """
+    Assembles the file with the peephole optimizations, see assemble_main
+    """
+    from .Optimizer import Optimizer
+    from .Preprocessor import Preprocessor
+
+    optimizer = Optimizer(verify=args.verify)
+    try:
+        compiled_bytecode = cc.assemble_file(
+            args.input, use_mmap=args.mmap, preprocessor=Preprocessor(args.include_dirs), optimizer=optimizer
+        )
+    except cc.OptimizationError as e:
+        print(e, file=sys.stderr)
+        return 1
+    except cc.InvalidCodeError as e:
+        print(e)
+        print("Invalid code!")
+        cc.write_output(args.output, b'')
+        return 0
+
+    cc.write_output(args.output, compiled_bytecode, use_mmap=args.mmap)
+    print(optimizer.report.format())
+    return 0
+
+
+def object_main(args: 'argparse.Namespace') -> int:
+    """
+    Assembles the file into a relocatable object file, see assemble_main
+    """
+    from .Linker import assemble_object
+    from .Preprocessor import Preprocessor
+
+    try:
+        module = assemble_object(args.input, Preprocessor(args.include_dirs), use_mmap=args.mmap)
+    except cc.InvalidCodeError as e:
+        print(e)
+        print("Invalid code!")
+        return 1
+
+    module.write(args.output)
+    return 0
+
+
+def build_main(argv: list[str]) -> int:
+    import argparse
+    import json
+
+    from .Batch import build_many
+
+    parser = argparse.ArgumentParser(
+        prog="chip8_compiler build",
+        description="Assembles many '.mini8' files in parallel."
+    )
+    parser.add_argument(
+        "sources",
+        help="Sources, directories (searched recursively) or manifests (one source per line).",
+        nargs="+"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="The output directory.",
+        required=True
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        help="The number of worker processes. Defaults to the number of CPUs.",
+        type=positive_int,
+        default=None
+    )
+    parser.add_argument(
+        "--json",
+        help="Print the summary as JSON.",
+        action="store_true"
+    )
+    add_cache_argument(parser)
+    add_include_argument(parser)
+
+    args = parser.parse_args(argv)
+    summary = build_many(
+        args.sources, args.output, jobs=args.jobs, cache_dir=args.cache_dir, include_dirs=args.include_dirs
+    )
+
+    if args.json:
+        json.dump(summary.to_dict(), sys.stdout, indent=2)
+        print()
+    else:
+        for result in summary.failed:
+            print(f"{result.source}: {result.error}", file=sys.stderr)
+        print(
+            f"Built {len(summary.succeeded)}/{len(summary.results)} files "
+            f"({len(summary.cached)} cached) in {summary.elapsed:.3f} seconds"
+        )
+
+    return 0 if len(summary.failed) == 0 else 1
+
+
+def link_main(argv: list[str]) -> int:
+    import argparse
+
+    from .Linker import link_files, OBJECT_EXTENSION
+    from .Preprocessor import Preprocessor
+
+    parser = argparse.ArgumentParser(
+        prog="chip8_compiler link",
+        description="Links object files and '.mini8' sources into a single program, laid out in the given order. "
+                    "The sources are assembled into object files, which are reused until the sources change."
+    )
+    parser.add_argument(
+        "inputs",
+        help=f"Object files ('{OBJECT_EXTENSION}') and sources ('{FILE_EXTENSION}'). The first one holds the entry "
+             f"point.",
+        nargs="+"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="The path to the output file.",
+        default="./tmp.ch8"
+    )
+    parser.add_argument(
+        "--object-dir",
+        help="Where the object files of the sources go. Defaults to next to the sources.",
+        default=None
+    )
+    add_include_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    for path in args.inputs:
+        if not path.endswith((OBJECT_EXTENSION, FILE_EXTENSION)):
+            parser.error(f"Inputs must have a '{OBJECT_EXTENSION}' or a '{FILE_EXTENSION}' extension: '{path}'")
+
+    try:
+        result = link_files(args.inputs, args.object_dir, Preprocessor(args.include_dirs))
+    except cc.AssemblyError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    cc.write_output(args.output, result.bytecode)
+    return 0
+
+
+def watch_main(argv: list[str]) -> int:
+    import argparse
+
+    from .Watch import Watcher, DEFAULT_INTERVAL, DEFAULT_MAX_INTERVAL, DEFAULT_DEBOUNCE
+
+    parser = argparse.ArgumentParser(
+        prog="chip8_compiler watch",
+        description="Builds the '.mini8' files of a directory, then rebuilds the ones that change (or include a file "
+                    "that changes) until interrupted."
+    )
+    parser.add_argument(
+        "source_dir",
+        help="The directory to watch, searched recursively."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="The output directory, mirroring the layout of the watched one.",
+        required=True
+    )
+    parser.add_argument(
+        "--interval",
+        help=f"The time between two polls, in seconds. Defaults to {DEFAULT_INTERVAL}.",
+        type=float,
+        default=DEFAULT_INTERVAL
+    )
+    parser.add_argument(
+        "--max-interval",
+        help=f"The time between two polls once idle, in seconds. Defaults to {DEFAULT_MAX_INTERVAL}.",
+        type=float,
+        default=DEFAULT_MAX_INTERVAL
+    )
+    parser.add_argument(
+        "--debounce",
+        help=f"How long the files must be left unchanged before rebuilding, in seconds. Defaults to "
+             f"{DEFAULT_DEBOUNCE}.",
+        type=float,
+        default=DEFAULT_DEBOUNCE
+    )
+    add_include_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    def report(results) -> None:
+        for result in results:
+            if result.ok:
+                print(f"{result.source} -> {result.output} ({result.size} bytes)")
+            else:
+                print(f"{result.source}: {result.error}", file=sys.stderr)
+        succeeded: int = sum(result.ok for result in results)
+        print(f"Built {succeeded}/{len(results)} files in {sum(result.elapsed for result in results):.3f} seconds")
+        sys.stdout.flush()
+
+    watcher = Watcher(
+        args.source_dir, args.output, args.include_dirs,
+        interval=args.interval, max_interval=max(args.interval, args.max_interval), debounce=args.debounce,
+        on_build=report
+    )
+
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def disassemble_main(argv: list[str]) -> int:
+    import argparse
+    import os
+    from .Disassembler import disassemble_file
+
+    parser = argparse.ArgumentParser(
+        prog="chip8_compiler disassemble",
+        description="Disassembles programs into '.mini8' sources, which assemble back into the same programs."
+    )
+    parser.add_argument(
+        "inputs",
+        help="The programs.",
+        nargs="+"
+    )
+    parser.add_argument(
+        "-o", "--output-dir",
+        help="Where the sources go. Defaults to next to the programs.",
+        default=None
+    )
+    parser.add_argument(
+        "--listing",
+        help="Print the addresses, opcodes and instructions instead of writing the sources.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--histogram",
+        help="Print how many times every instruction occurs in the programs instead of writing the sources.",
+        action="store_true"
+    )
+
+    args = parser.parse_args(argv)
+    histogram: dict[str, int] = {}
+
+    for path in args.inputs:
+        try:
+            disassembly = disassemble_file(path)
+        except OSError as e:
+            print(e, file=sys.stderr)
+            return 1
+
+        if args.histogram:
+            for command, count in disassembly.histogram().items():
+                histogram[command] = histogram.get(command, 0) + count
+        elif args.listing:
+            print(f"{path}:")
+            print(disassembly.listing())
+        else:
+            output_dir: str = args.output_dir if args.output_dir is not None else os.path.dirname(path)
+            output_path: str = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + FILE_EXTENSION)
+            os.makedirs(output_dir or ".", exist_ok=True)
+            with open(output_path, "w") as f:
+                f.write(disassembly.to_source())
+
+    for command, count in sorted(histogram.items(), key=lambda item: -item[1]):
+        print(f"{command:<6} {count}")
+    return 0
+
+
+def serve_main(argv: list[str]) -> int:
+    import argparse
+
+    from .Daemon import AssemblerService, serve_socket, serve_stdio
+
+    parser = argparse.ArgumentParser(
+        prog="chip8_compiler serve",
+        description="Runs an assembler server, answering JSON requests (one per line) with warm caches."
+    )
+    transport = parser.add_mutually_exclusive_group()
+    transport.add_argument(
+        "--socket",
+        help="The Unix socket to listen on. Defaults to $CHIP8_COMPILER_SOCKET or a per-user socket.",
+        default=None
+    )
+    transport.add_argument(
+        "--stdio",
+        help="Answer the requests read from stdin on stdout instead.",
+        action="store_true"
+    )
+
+    args = parser.parse_args(argv)
+    service = AssemblerService()
+
+    if args.stdio:
+        serve_stdio(service)
+    else:
+        serve_socket(service, args.socket)
+
+    return 0
+
+
+def lsp_main(argv: list[str]) -> int:
+    import argparse
+
+    from .LanguageServer import serve_lsp
+
+    parser = argparse.ArgumentParser(
+        prog="chip8_compiler lsp",
+        description="Runs the language server of the editors (LSP), over stdin and stdout."
+    )
+    add_include_argument(parser)
+    # Passed by some clients, always stdio here
+    parser.add_argument("--stdio", help=argparse.SUPPRESS, action="store_true")
+
+    args = parser.parse_args(argv)
+    return serve_lsp(args.include_dirs)
+
+
+# Subcommands, selected by the first argument. Anything else assembles a single file
+COMMANDS: dict = {
+    "build": build_main,
+    "disassemble": disassemble_main,
+    "link": link_main,
+    "lsp": lsp_main,
+    "serve": serve_main,
+    "watch": watch_main
+}
+
+
+def main(argv: list[str] | None = None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if len(argv) > 0 and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
+    return assemble_main(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
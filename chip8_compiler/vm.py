@@ -0,0 +1,499 @@
+import random
+from array import array
+from enum import StrEnum
+from typing import Iterable
+
+from .Globals import PROGRAM_START
+from .Interfaces import MachineError, InstructionEncoding
+from ._ChipInstructions import encoding_table
+
+# Headless CHIP-8 interpreter, for running assembled programs in tests.
+#
+# Decoding: a 64K-entry dispatch table maps every opcode to the instruction it
+# encodes. It is derived from the encoding table of the assembler: every
+# encoding matches the opcodes agreeing with its command code outside of its
+# operand fields, and where encodings overlap (NOOP, CLS and RET within SYS)
+# the one with the most fixed bits wins.
+#
+# Execution: the program runs by basic blocks, the straight-line runs of
+# instructions ending at a jump, a call, a return or a skip. Each block is
+# translated once into a Python function (its instructions with their
+# operands inlined) and cached by address, so a hot loop is never decoded
+# again. Writes into memory holding translated code (LD [I], Vx and LD B, Vx)
+# drop the blocks covering it.
+#
+# The framebuffer is packed into one 64-bit int per row, the leftmost pixel
+# being the most significant bit. Sprites wrap around the edges.
+#
+# Behaviour follows the common (CHIP-48) interpreters: SHR and SHL shift Vx,
+# LD [I], Vx and LD Vx, [I] leave I unchanged, JP V0, addr jumps to addr + V0.
+# The timers tick once every instructions_per_frame instructions, and RND
+# draws from a random.Random seeded by the machine, so runs are reproducible.
+# A jump to itself halts the machine.
+
+MEMORY_SIZE: int = 0x1000
+SCREEN_WIDTH: int = 64
+SCREEN_HEIGHT: int = 32
+STACK_SIZE: int = 16
+FONT_START: int = 0x50
+FONT: bytes = bytes.fromhex(
+    "F0909090F0" "2060202070" "F010F080F0" "F010F010F0" "9090F01010" "F080F010F0" "F080F090F0" "F010204040"
+    "F090F090F0" "F090F010F0" "F090F09090" "E090E090E0" "F0808080F0" "E0909090E0" "F080F080F0" "F080F08080"
+)
+
+DEFAULT_INSTRUCTIONS_PER_FRAME: int = 10
+# The longest block, so a long straight run does not get translated in one go
+MAX_BLOCK_LENGTH: int = 64
+
+_ROW_MASK: int = (1 << SCREEN_WIDTH) - 1
+_INVALID: int = 0xFF
+
+# The body of every instruction, by encoding. {x}, {y}, {n}, {kk} and {nnn} are its operand fields, {next} the address
+# of the next instruction and {skip} the one after it. The terminators end a block with the address to go on from
+_STATEMENTS: dict[tuple, str] = {
+    ("NOOP", None, None, None): "",
+    ("SYS", "Literal", None, None): "",
+    ("CLS", None, None, None): "s._clear()",
+    ("LD", "V", "Literal", None): "v[{x}] = {kk}",
+    ("ADD", "V", "Literal", None): "v[{x}] = (v[{x}] + {kk}) & 0xFF",
+    ("LD", "V", "V", None): "v[{x}] = v[{y}]",
+    ("OR", "V", "V", None): "v[{x}] |= v[{y}]",
+    ("AND", "V", "V", None): "v[{x}] &= v[{y}]",
+    ("XOR", "V", "V", None): "v[{x}] ^= v[{y}]",
+    ("ADD", "V", "V", None): "t = v[{x}] + v[{y}]; v[{x}] = t & 0xFF; v[15] = t >> 8",
+    ("SUB", "V", "V", None): "t = v[{x}] - v[{y}]; v[{x}] = t & 0xFF; v[15] = int(t >= 0)",
+    ("SHR", "V", "V", None): "t = v[{x}]; v[{x}] = t >> 1; v[15] = t & 1",
+    ("SUBN", "V", "V", None): "t = v[{y}] - v[{x}]; v[{x}] = t & 0xFF; v[15] = int(t >= 0)",
+    ("SHL", "V", "V", None): "t = v[{x}]; v[{x}] = (t << 1) & 0xFF; v[15] = t >> 7",
+    ("LD", "I", "Literal", None): "s.i = {nnn}",
+    ("RND", "V", "Literal", None): "v[{x}] = s._random_byte() & {kk}",
+    ("DRW", "V", "V", "Literal"): "s._draw(v[{x}], v[{y}], {n})",
+    ("LD", "V", "DT", None): "v[{x}] = s.dt",
+    ("LD", "DT", "V", None): "s.dt = v[{x}]",
+    ("LD", "ST", "V", None): "s.st = v[{x}]",
+    ("ADD", "I", "V", None): "s.i = (s.i + v[{x}]) & 0xFFFF",
+    ("LD", "F", "V", None): f"s.i = {FONT_START} + (v[{{x}}] & 0xF) * 5",
+    ("LD", "B", "V", None): "s._store_bcd(v[{x}])",
+    ("LD", "I", "V", None): "s._store_registers({x})",
+    ("LD", "V", "I", None): "s._load_registers({x})",
+}
+_TERMINATORS: dict[tuple, str] = {
+    ("JP", "Literal", None, None): "return {nnn}",
+    ("JP", "V", "Literal", None): "return ({nnn} + v[0]) & 0xFFF",
+    ("CALL", "Literal", None, None): "s._call({next}); return {nnn}",
+    ("RET", None, None, None): "return s._return()",
+    ("SE", "V", "Literal", None): "return {skip} if v[{x}] == {kk} else {next}",
+    ("SNE", "V", "Literal", None): "return {skip} if v[{x}] != {kk} else {next}",
+    ("SE", "V", "V", None): "return {skip} if v[{x}] == v[{y}] else {next}",
+    ("SNE", "V", "V", None): "return {skip} if v[{x}] != v[{y}] else {next}",
+    ("SKP", "V", None, None): "return {skip} if s.keys >> (v[{x}] & 0xF) & 1 else {next}",
+    ("SKNP", "V", None, None): "return {next} if s.keys >> (v[{x}] & 0xF) & 1 else {skip}",
+    ("LD", "V", "K", None): "return s._wait_key({x}, {address})",
+}
+_WAIT_KEY: tuple = ("LD", "V", "K", None)
+
+# Built on first use, see dispatch_table
+_DISPATCH: dict[str, object] = {}
+
+
+class StopReason(StrEnum):
+    HALTED = "halted",
+    LIMIT = "limit",
+    KEY_WAIT = "key wait"
+
+
+def __fixed_mask(encoding: InstructionEncoding) -> int:
+    # The bits of the opcode that are not operand fields
+    operand_bits: int = 0
+    for _, shift, mask in encoding.fields:
+        operand_bits |= mask << shift
+    return 0xFFFF & ~operand_bits
+
+
+def __build_dispatch_table() -> tuple[array, tuple[InstructionEncoding, ...]]:
+    encodings: tuple[InstructionEncoding, ...] = tuple(
+        sorted(encoding_table().values(), key=lambda encoding: bin(__fixed_mask(encoding)).count("1"))
+    )
+    table: array = array("B", bytes([_INVALID]) * 0x10000)
+
+    # The most specific encodings come last, and overwrite the ones they overlap
+    for index, encoding in enumerate(encodings):
+        operand_bits: int = 0xFFFF & ~__fixed_mask(encoding)
+        bits: int = operand_bits
+        while True:
+            table[encoding.command_code | bits] = index
+            if bits == 0:
+                break
+            bits = (bits - 1) & operand_bits
+
+    return table, encodings
+
+
+def dispatch_table() -> tuple[array, tuple[InstructionEncoding, ...]]:
+    """
+    Returns the dispatch table: the index (in the returned encodings) of the instruction of every opcode, 0xFF for the
+    invalid ones. Built on the first call
+    :return: tuple[array, tuple[InstructionEncoding, ...]]
+    """
+    if not _DISPATCH:
+        _DISPATCH["table"], _DISPATCH["encodings"] = __build_dispatch_table()
+    return _DISPATCH["table"], _DISPATCH["encodings"]
+
+
+def decode(opcode: int) -> InstructionEncoding | None:
+    """
+    Returns the encoding of the instruction of the opcode, None if it is invalid
+    :param opcode: int
+    :return: InstructionEncoding | None
+    """
+    table, encodings = dispatch_table()
+    index: int = table[opcode & 0xFFFF]
+    return None if index == _INVALID else encodings[index]
+
+
+class _Block:
+    __slots__ = ("function", "start", "end", "length", "count", "halts")
+
+    def __init__(self, function, start: int, end: int, length: int, halts: bool):
+        self.function = function
+        self.start: int = start
+        self.end: int = end
+        self.length: int = length
+        self.count: int = 0
+        self.halts: bool = halts
+
+
+class Machine:
+    """
+    A CHIP-8 machine running a program from 0x200:
+        v: the 16 registers, i: the address register, pc: the program counter
+        dt, st: the delay and sound timers
+        keys: the pressed keys, as a bit mask (see press and release)
+        framebuffer: one int per row, the leftmost pixel being the most significant of its 64 bits
+        cycles: the number of instructions executed
+        labels: the address of every label of the program, for label_counts
+    """
+
+    def __init__(
+            self,
+            rom: bytes = b"",
+            seed: int = 0,
+            instructions_per_frame: int = DEFAULT_INSTRUCTIONS_PER_FRAME,
+            labels: dict[str, int] | None = None
+    ):
+        """
+        :param rom: bytes, the program, loaded at 0x200
+        :param seed: int, the seed of RND
+        :param instructions_per_frame: int, the instructions executed between two ticks of the timers
+        :param labels: dict[str, int] | None
+        """
+        if len(rom) > MEMORY_SIZE - PROGRAM_START:
+            raise MachineError(f"The program does not fit in memory ({len(rom)} bytes)")
+
+        self.memory: bytearray = bytearray(MEMORY_SIZE)
+        self.memory[FONT_START:FONT_START + len(FONT)] = FONT
+        self.memory[PROGRAM_START:PROGRAM_START + len(rom)] = rom
+
+        self.v: list[int] = [0] * 16
+        self.i: int = 0
+        self.pc: int = PROGRAM_START
+        self.stack: list[int] = []
+        self.dt: int = 0
+        self.st: int = 0
+        self.keys: int = 0
+        self.framebuffer: list[int] = [0] * SCREEN_HEIGHT
+        self.cycles: int = 0
+        self.instructions_per_frame: int = instructions_per_frame
+        self.labels: dict[str, int] = dict(labels) if labels is not None else {}
+
+        self.__random: random.Random = random.Random(seed)
+        self.__next_frame: int = instructions_per_frame
+        self.__waiting: bool = False
+
+        self.__blocks: dict[int, _Block] = {}
+        # How many translated blocks cover every byte of memory
+        self.__covered: bytearray = bytearray(MEMORY_SIZE)
+        # The executions of the blocks dropped so far, by address
+        self.__retired_counts: list[int] = [0] * MEMORY_SIZE
+
+    # Keys
+
+    def press(self, key: int) -> None:
+        self.keys |= 1 << (key & 0xF)
+
+    def release(self, key: int) -> None:
+        self.keys &= ~(1 << (key & 0xF))
+
+    # Execution
+
+    def run(self, max_instructions: int = 1_000_000) -> StopReason:
+        """
+        Runs the program until it halts (jumps to itself), waits for a key that is not pressed (LD Vx, K), or has run
+        max_instructions instructions (give or take a block). Raises a MachineError on an invalid opcode or a broken
+        stack. Can be called again to resume
+        :param max_instructions: int
+        :return: StopReason
+        """
+        blocks: dict[int, _Block] = self.__blocks
+        v: list[int] = self.v
+        memory: bytearray = self.memory
+        limit: int = self.cycles + max_instructions
+        pc: int = self.pc
+
+        try:
+            while self.cycles < limit:
+                block: _Block | None = blocks.get(pc, None)
+                if block is None:
+                    block = self.__translate(pc)
+                if block.halts:
+                    return StopReason.HALTED
+
+                self.__waiting = False
+                # Counted first, the block may drop itself by writing into its own code
+                block.count += 1
+                next_pc: int = block.function(self, v, memory)
+                self.cycles += block.length
+
+                if self.cycles >= self.__next_frame:
+                    self.__tick()
+                if self.__waiting:
+                    return StopReason.KEY_WAIT
+                pc = next_pc
+
+            return StopReason.LIMIT
+        finally:
+            self.pc = pc
+
+    def __tick(self) -> None:
+        frames: int = (self.cycles - self.__next_frame) // self.instructions_per_frame + 1
+        self.__next_frame += frames * self.instructions_per_frame
+        self.dt = max(0, self.dt - frames)
+        self.st = max(0, self.st - frames)
+
+    def __translate(self, start: int) -> _Block:
+        table, encodings = dispatch_table()
+        memory: bytearray = self.memory
+
+        lines: list[str] = ["def block(s, v, m):"]
+        address: int = start
+        length: int = 0
+        halts: bool = False
+
+        while True:
+            if address > MEMORY_SIZE - 2:
+                lines.append(f"    return s._invalid({address})")
+                break
+
+            opcode: int = memory[address] << 8 | memory[address + 1]
+            index: int = table[opcode]
+            operands: dict[str, int] = {
+                "x": (opcode >> 8) & 0xF, "y": (opcode >> 4) & 0xF, "n": opcode & 0xF, "kk": opcode & 0xFF,
+                "nnn": opcode & 0xFFF, "address": address, "next": address + 2, "skip": address + 4
+            }
+
+            if index == _INVALID:
+                lines.append(f"    return s._invalid({address})")
+                length += 1
+                break
+
+            key: tuple = (encodings[index].command, *encodings[index].shape)
+            if key == _WAIT_KEY and length > 0:
+                # Waiting for a key starts a block of its own, so the block can run again once a key is pressed
+                lines.append(f"    return {address}")
+                break
+
+            terminator: str | None = _TERMINATORS.get(key, None)
+            length += 1
+            if terminator is not None:
+                lines.append("    " + terminator.format(**operands))
+                halts = length == 1 and key == ("JP", "Literal", None, None) and opcode & 0xFFF == start
+                break
+
+            statement: str = _STATEMENTS[key].format(**operands)
+            if statement:
+                lines.append("    " + statement)
+
+            address += 2
+            if length == MAX_BLOCK_LENGTH:
+                lines.append(f"    return {address}")
+                break
+
+        namespace: dict = {}
+        exec("\n".join(lines), namespace)
+
+        end: int = min(start + 2 * length, MEMORY_SIZE)
+        block: _Block = _Block(namespace["block"], start, end, length, halts)
+        self.__blocks[start] = block
+        for covered_address in range(start, end):
+            self.__covered[covered_address] += 1
+        return block
+
+    def __invalidate(self, start: int, end: int) -> None:
+        # Drops the blocks covering the memory written to
+        for block in [block for block in self.__blocks.values() if block.start < end and start < block.end]:
+            del self.__blocks[block.start]
+            for address in range(block.start, block.end):
+                self.__covered[address] -= 1
+            for address in range(block.start, block.end, 2):
+                self.__retired_counts[address] += block.count
+
+    # Called by the translated blocks
+
+    def _written(self, start: int, end: int) -> None:
+        if any(self.__covered[start:end]):
+            self.__invalidate(start, end)
+
+    def _clear(self) -> None:
+        self.framebuffer[:] = [0] * SCREEN_HEIGHT
+
+    def _random_byte(self) -> int:
+        return self.__random.getrandbits(8)
+
+    def _draw(self, x: int, y: int, height: int) -> None:
+        framebuffer: list[int] = self.framebuffer
+        memory: bytearray = self.memory
+        x %= SCREEN_WIDTH
+        collision: int = 0
+
+        for row in range(height):
+            sprite: int = memory[(self.i + row) & 0xFFF]
+            # The byte rotated into place, wrapping around the right edge
+            bits: int = ((sprite << 56) >> x) | ((sprite << (120 - x)) & _ROW_MASK)
+            row_index: int = (y + row) % SCREEN_HEIGHT
+            if framebuffer[row_index] & bits:
+                collision = 1
+            framebuffer[row_index] ^= bits
+
+        self.v[15] = collision
+
+    def __check_range(self, count: int) -> None:
+        if self.i + count > MEMORY_SIZE:
+            raise MachineError(f"Memory access out of range at I = 0x{self.i:X}")
+
+    def _store_bcd(self, value: int) -> None:
+        self.__check_range(3)
+        self.memory[self.i:self.i + 3] = bytes([value // 100, value // 10 % 10, value % 10])
+        self._written(self.i, self.i + 3)
+
+    def _store_registers(self, x: int) -> None:
+        self.__check_range(x + 1)
+        self.memory[self.i:self.i + x + 1] = bytes(self.v[:x + 1])
+        self._written(self.i, self.i + x + 1)
+
+    def _load_registers(self, x: int) -> None:
+        self.__check_range(x + 1)
+        self.v[:x + 1] = self.memory[self.i:self.i + x + 1]
+
+    def _call(self, return_address: int) -> None:
+        if len(self.stack) == STACK_SIZE:
+            raise MachineError(f"Stack overflow at 0x{return_address - 2:X}")
+        self.stack.append(return_address)
+
+    def _return(self) -> int:
+        if not self.stack:
+            raise MachineError("Return with an empty stack")
+        return self.stack.pop()
+
+    def _wait_key(self, x: int, address: int) -> int:
+        if self.keys == 0:
+            self.__waiting = True
+            return address
+        self.v[x] = (self.keys & -self.keys).bit_length() - 1
+        return address + 2
+
+    def _invalid(self, address: int) -> int:
+        if address > MEMORY_SIZE - 2:
+            raise MachineError(f"Program counter out of memory: 0x{address:X}")
+        opcode: int = self.memory[address] << 8 | self.memory[address + 1]
+        raise MachineError(f"Invalid opcode 0x{opcode:04X} at 0x{address:X}")
+
+    # Output
+
+    def framebuffer_bytes(self) -> bytes:
+        """
+        The framebuffer, 8 bytes per row, the leftmost pixel being the most significant bit
+        :return: bytes
+        """
+        return b"".join(row.to_bytes(SCREEN_WIDTH // 8, "big") for row in self.framebuffer)
+
+    def framebuffer_hash(self) -> str:
+        """
+        A digest of the framebuffer, to compare against a known good run
+        :return: str
+        """
+        import hashlib
+
+        return hashlib.sha256(self.framebuffer_bytes()).hexdigest()
+
+    def render(self, on: str = "#", off: str = ".") -> str:
+        return "\n".join(
+            "".join(on if row >> (SCREEN_WIDTH - 1 - column) & 1 else off for column in range(SCREEN_WIDTH))
+            for row in self.framebuffer
+        )
+
+    def execution_counts(self) -> list[int]:
+        """
+        How many times the instruction at every address was executed
+        :return: list[int]
+        """
+        counts: list[int] = list(self.__retired_counts)
+        for block in self.__blocks.values():
+            for address in range(block.start, block.end, 2):
+                counts[address] += block.count
+        return counts
+
+    def label_counts(self, labels: dict[str, int] | None = None) -> dict[str, int]:
+        """
+        How many instructions were executed after every label, up to the next one
+        :param labels: dict[str, int] | None, the address of every label, the labels of the machine by default
+        :return: dict[str, int]
+        """
+        labels = self.labels if labels is None else labels
+        counts: list[int] = self.execution_counts()
+        ordered: list[tuple[int, str]] = sorted((address, name) for name, address in labels.items())
+
+        result: dict[str, int] = {}
+        for index, (address, name) in enumerate(ordered):
+            end: int = ordered[index + 1][0] if index + 1 < len(ordered) else MEMORY_SIZE
+            result[name] = sum(counts[address:end])
+        return result
+
+
+def run_rom(
+        rom: bytes,
+        max_instructions: int = 1_000_000,
+        seed: int = 0,
+        keys: Iterable[int] = (),
+        labels: dict[str, int] | None = None
+) -> Machine:
+    """
+    Runs a program on a fresh machine, see Machine.run. Returns the machine
+    :param rom: bytes
+    :param max_instructions: int
+    :param seed: int, the seed of RND
+    :param keys: Iterable[int], the keys held down
+    :param labels: dict[str, int] | None
+    :return: Machine
+    """
+    machine: Machine = Machine(rom, seed, labels=labels)
+    for key in keys:
+        machine.press(key)
+    machine.run(max_instructions)
+    return machine
+
+
+def run_file(file_path: str, max_instructions: int = 1_000_000, seed: int = 0, keys: Iterable[int] = ()) -> Machine:
+    """
+    Assembles the .mini8 file and runs it, see run_rom. The labels of the machine are the ones of the file
+    :param file_path: str
+    :param max_instructions: int
+    :param seed: int
+    :param keys: Iterable[int]
+    :return: Machine
+    """
+    from .Globals import AssemblyContext
+    from .Parser import assemble_file
+
+    context: AssemblyContext = AssemblyContext()
+    program = assemble_file(file_path, context)
+    return run_rom(program.to_bytes(), max_instructions, seed, keys, context.symbol_table()["labels"])
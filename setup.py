@@ -6,7 +6,11 @@ setup(
     description="A probably over-engineered compiler/assembler for the chip8 language.",
     author="waytoounoriginal",
     author_email="mihai.tira@yahoo.ro",
-    py_modules=["chip8_compiler"],
+    packages=["chip8_compiler"],
+    extras_require={
+        # Decodes whole programs in bulk in the disassembler
+        'numpy': ['numpy']
+    },
     entry_points={
         'console_scripts': ['chip8_compiler=chip8_compiler.chip8_cli:main']
     }
@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import tracemalloc
+from timeit import default_timer as timer
+
+import chip8_compiler as cc
+from chip8_compiler.Parser import strip_comments, segment_lines, parse_line
+from chip8_compiler.Program import Program
+
+from program_generator import ProgramShape, write_program
+
+# Benchmark suite for the assembler pipeline.
+#
+# Assembles generated programs of several sizes, timing every phase of the
+# pipeline on its own (best of a few runs) plus the whole assembly, and
+# recording the memory high-water marks. The results are written as JSON and
+# can be compared against a stored baseline, flagging the regressions.
+#
+# Usage: python benchmark.py [--sizes 1000 10000] [--baseline baseline.json] [--update-baseline]
+
+BASELINE_PATH: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_SIZES: list[int] = [1_000, 10_000, 100_000]
+# Differences below this many seconds are noise, whatever the ratio
+TIME_NOISE_FLOOR: float = 0.002
+
+
+def __best_of(repeat: int, function) -> tuple[float, object]:
+    best: float = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = timer()
+        result = function()
+        best = min(best, timer() - start)
+    return best, result
+
+
+def __peak_memory(function) -> int:
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_file(file_path: str, repeat: int = 3) -> dict:
+    """
+    Benchmarks the assembly of a single file
+    :param file_path: str
+    :param repeat: int, the number of runs of every phase, the best one is kept
+    :return: dict
+    """
+    phases: dict[str, float] = {}
+
+    def read() -> list[str]:
+        with open(file_path, "r") as f:
+            return list(f)
+
+    phases["read"], lines = __best_of(repeat, read)
+    phases["strip_comments"], stripped_lines = __best_of(repeat, lambda: list(strip_comments(lines)))
+    phases["segments"], segment_code = __best_of(repeat, lambda: list(segment_lines(stripped_lines)))
+
+    def parse() -> cc.AssemblyContext:
+        context = cc.AssemblyContext()
+        for _, line in segment_code:
+            parse_line(line, context)
+        return context
+
+    phases["parse"], context = __best_of(repeat, parse)
+
+    def encode() -> Program:
+        program = Program()
+        program.extend(context.raw_opcodes)
+        return program
+
+    phases["encode"], program = __best_of(repeat, encode)
+    phases["emit"], bytecode = __best_of(repeat, program.to_bytes)
+
+    total, _ = __best_of(repeat, lambda: cc.parse_file(file_path))
+    total_objects, _ = __best_of(repeat, lambda: cc.parse_file(file_path, compact=False))
+
+    return {
+        "lines": len(lines),
+        "bytes": len(bytecode),
+        "phases": phases,
+        "total": total,
+        "total_objects": total_objects,
+        "peak_memory": __peak_memory(lambda: cc.parse_file(file_path)),
+        "peak_memory_objects": __peak_memory(lambda: cc.parse_file(file_path, compact=False))
+    }
+
+
+def run(sizes: list[int], repeat: int = 3) -> dict:
+    results: dict = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "benchmarks": {}
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            file_path: str = os.path.join(temp_dir, f"generated_{size}.mini8")
+            write_program(file_path, ProgramShape(instructions=size))
+            results["benchmarks"][str(size)] = benchmark_file(file_path, repeat)
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compares the results against the baseline. Returns the regressions, as readable messages
+    :param results: dict
+    :param baseline: dict
+    :param tolerance: float, the allowed relative slowdown (0.25 is 25%)
+    :return: list[str]
+    """
+    regressions: list[str] = []
+
+    def check(size: str, metric: str, value: float, baseline_value: float, is_time: bool) -> None:
+        limit: float = baseline_value * (1 + tolerance)
+        if is_time:
+            limit = max(limit, baseline_value + TIME_NOISE_FLOOR)
+
+        if value > limit:
+            regressions.append(
+                f"[{size}] {metric}: {value:.6g} vs baseline {baseline_value:.6g} "
+                f"(+{(value / baseline_value - 1) * 100 if baseline_value else float('inf'):.1f}%)"
+            )
+
+    for size, result in results["benchmarks"].items():
+        baseline_result: dict | None = baseline.get("benchmarks", {}).get(size, None)
+        if baseline_result is None:
+            continue
+
+        for phase, value in result["phases"].items():
+            if phase in baseline_result["phases"]:
+                check(size, phase, value, baseline_result["phases"][phase], True)
+
+        for metric in ["total", "total_objects"]:
+            check(size, metric, result[metric], baseline_result[metric], True)
+
+        for metric in ["peak_memory", "peak_memory_objects"]:
+            check(size, metric, result[metric], baseline_result[metric], False)
+
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks the assembler on generated programs.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Program sizes, in instructions.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per phase, the best one is kept.")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="The baseline to compare against.")
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression.")
+
+    args = parser.parse_args()
+    results: dict = run(args.sizes, args.repeat)
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at '{args.baseline}', nothing to compare against", file=sys.stderr)
+        return 0
+
+    with open(args.baseline, "r") as f:
+        regressions: list[str] = compare(results, json.load(f), args.tolerance)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
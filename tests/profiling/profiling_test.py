@@ -1,6 +1,8 @@
 import cProfile
+import os
 
 import chip8_compiler as cc
 
 if __name__ == "__main__":
-    cProfile.run("cc.parse_file(file_path='../time_10k_test.chip8')")
\ No newline at end of file
+    source_path: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "time_10k_test.mini8")
+    cProfile.run(f"cc.parse_file(file_path={source_path!r})", sort="tottime")
@@ -0,0 +1,155 @@
+import argparse
+import random
+from dataclasses import dataclass
+from typing import Iterator
+
+# Generator of valid, synthetic .mini8 programs of any size, used by the
+# benchmarks. The programs mix every kind of line the assembler handles:
+# instructions, labels with backward and forward references, variables,
+# data literals in every base, __ADDR__ uses, comments and blank lines.
+
+
+@dataclass
+class ProgramShape:
+    instructions: int = 10_000
+    # One label every label_spacing instructions
+    label_spacing: int = 16
+    variables: int = 64
+    sprites: int = 128
+    sprite_height: int = 5
+    # Share of the instructions using __ADDR__
+    addr_ratio: float = 0.02
+    # Share of the lines followed by a comment
+    comment_ratio: float = 0.1
+    seed: int = 0
+
+    @property
+    def labels(self) -> int:
+        return max(1, self.instructions // self.label_spacing)
+
+    @property
+    def byte_size(self) -> int:
+        return 2 * self.instructions + self.sprites * self.sprite_height
+
+
+def __register(rng: random.Random) -> str:
+    return f"V0x{rng.randrange(16):X}"
+
+
+def __literal(rng: random.Random, value: int, bits: int = 8) -> str:
+    kind: int = rng.randrange(3)
+    if kind == 0:
+        return f"$0x{value:0{bits // 4}X}"
+    elif kind == 1:
+        return f"$d{value}"
+    return f"$b{value:0{bits}b}"
+
+
+def __instruction(rng: random.Random, shape: ProgramShape) -> str:
+    if rng.random() < shape.addr_ratio:
+        return "JP __ADDR__"
+
+    # Jumps go to labels anywhere in the program, so about half of them are forward references
+    label: str = f"__L{rng.randrange(shape.labels)}"
+
+    kind: int = rng.randrange(12)
+    if kind == 0:
+        return f"JP {label}"
+    elif kind == 1:
+        return f"CALL {label}"
+    elif kind == 2:
+        return f"LD I, __SPRITE{rng.randrange(shape.sprites)}"
+    elif kind == 3:
+        return f"LD {__register(rng)}, var{rng.randrange(shape.variables)}"
+    elif kind == 4:
+        return f"SE {__register(rng)}, {__literal(rng, rng.randrange(256))}"
+    elif kind == 5:
+        return f"SNE {__register(rng)}, {__register(rng)}"
+    elif kind == 6:
+        return f"LD {__register(rng)}, {__literal(rng, rng.randrange(256))}"
+    elif kind == 7:
+        return f"{rng.choice(['ADD', 'OR', 'AND', 'XOR', 'SUB', 'SHR', 'SUBN', 'SHL'])} {__register(rng)}, {__register(rng)}"
+    elif kind == 8:
+        return f"DRW {__register(rng)}, {__register(rng)}, {__literal(rng, shape.sprite_height, 4)}"
+    elif kind == 9:
+        return f"LD {rng.choice(['DT', 'ST', 'F', 'B', 'I'])}, {__register(rng)}"
+    elif kind == 10:
+        return f"{rng.choice(['SKP', 'SKNP'])} {__register(rng)}"
+    return rng.choice(["CLS", "RET", "NOOP"])
+
+
+def __with_comment(rng: random.Random, shape: ProgramShape, line: str) -> str:
+    if rng.random() < shape.comment_ratio:
+        return f"{line} ; generated"
+    return line
+
+
+def generate_program(shape: ProgramShape) -> Iterator[str]:
+    """
+    Lazily yields the lines of a program of the given shape
+    :param shape: ProgramShape
+    :return: Iterator[str]
+    """
+    rng: random.Random = random.Random(shape.seed)
+
+    yield f"; Generated program, {shape.instructions} instructions"
+    yield "segment code:"
+
+    label_index: int = 0
+    for index in range(shape.instructions):
+        if index % shape.label_spacing == 0 and label_index < shape.labels:
+            yield ""
+            yield f"    label __L{label_index}:"
+            label_index += 1
+
+        yield "    " + __with_comment(rng, shape, __instruction(rng, shape))
+
+    # Labels past the last instruction still need a definition
+    while label_index < shape.labels:
+        yield f"    label __L{label_index}:"
+        label_index += 1
+
+    yield "segment_end"
+    yield ""
+    yield "segment data:"
+
+    for index in range(shape.variables):
+        yield "    " + __with_comment(rng, shape, f"variable var{index} {__literal(rng, rng.randrange(256))}")
+
+    for index in range(shape.sprites):
+        yield ""
+        yield f"    ; Sprite {index}"
+        yield f"    label __SPRITE{index}:"
+        for _ in range(shape.sprite_height):
+            yield "    " + __literal(rng, rng.randrange(256))
+
+    yield "segment_end"
+
+
+def write_program(file_path: str, shape: ProgramShape) -> None:
+    with open(file_path, "w") as f:
+        for line in generate_program(shape):
+            f.write(line + "\n")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generates a synthetic '.mini8' program.")
+    parser.add_argument("output", help="The path to the output file.")
+    parser.add_argument("-n", "--instructions", type=int, default=ProgramShape.instructions)
+    parser.add_argument("--label-spacing", type=int, default=ProgramShape.label_spacing)
+    parser.add_argument("--variables", type=int, default=ProgramShape.variables)
+    parser.add_argument("--sprites", type=int, default=ProgramShape.sprites)
+    parser.add_argument("--seed", type=int, default=ProgramShape.seed)
+
+    args = parser.parse_args()
+    write_program(args.output, ProgramShape(
+        instructions=args.instructions,
+        label_spacing=args.label_spacing,
+        variables=args.variables,
+        sprites=args.sprites,
+        seed=args.seed
+    ))
+
+
+if __name__ == "__main__":
+    main()
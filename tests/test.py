@@ -1,7 +1,26 @@
+import asyncio
+import base64
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
+from unittest import mock
 
 import chip8_compiler as cc
+from chip8_compiler import vm
+from chip8_compiler.DataLayout import pack
+from chip8_compiler.Linker import OBJECT_MAGIC
+from chip8_compiler.Optimizer import Optimizer, equivalent
+from chip8_compiler.Preprocessor import Preprocessor
 
 # bytecodes = cc.parse_file(file_path="./hello_world_test.chip8")
 #
@@ -28,6 +47,129 @@ class TestInstructions(unittest.TestCase):
 
         self.assertEqual(compiled_bytecodes, expected_bytecodes, "Byte codes not equal")
 
+    def test_stream(self):
+        with open("./instruction_test_input.mini8", "r") as f:
+            compiled_bytecodes = cc.parse_stream(f)
+
+        with open("./instruction_test_expected.ch8", "rb") as f:
+            expected_bytecodes = f.read()
+
+        self.assertEqual(compiled_bytecodes, expected_bytecodes, "Byte codes not equal")
+
+    def test_stream_data_before_code(self):
+        lines = [
+            "segment data:",
+            "    label __sprite:",
+            "    $0xF0",
+            "segment_end",
+            "segment code:",
+            "    LD I, __sprite ; Forward to the data",
+            "segment_end",
+        ]
+        self.assertEqual(cc.parse_stream(iter(lines)), b"\xA2\x02\xF0", "Byte codes not equal")
+
+    def test_compact(self):
+        for source in ["./instruction_test_input.mini8", "./hello_world_test.mini8", "./special_token_test.mini8"]:
+            context = cc.AssemblyContext()
+            compiled_bytecodes = cc.parse_file(file_path=source, context=context)
+
+            self.assertEqual(
+                compiled_bytecodes,
+                cc.parse_file(file_path=source, compact=False),
+                f"Byte codes not equal for {source}"
+            )
+            self.assertEqual(context.raw_opcodes, [], "Compact assembly kept the parsed objects")
+
+    def test_write_into(self):
+        with open("./hello_world_test.mini8", "r") as f:
+            program = cc.assemble_program(f)
+
+        with open("./hello_world_program.ch8", "rb") as f:
+            expected_bytecodes = f.read()
+
+        buffer = bytearray(program.size + 2)
+        self.assertEqual(program.write_into(buffer, offset=2), len(expected_bytecodes))
+        self.assertEqual(bytes(buffer[2:]), expected_bytecodes, "Byte codes not equal")
+        self.assertEqual(program.view(), expected_bytecodes, "Byte codes not equal")
+
+    def test_mmap(self):
+        for source, expected in [
+            ("./instruction_test_input.mini8", "./instruction_test_expected.ch8"),
+            ("./hello_world_test.mini8", "./hello_world_program.ch8")
+        ]:
+            program = cc.assemble_file(source, use_mmap=True)
+
+            with tempfile.TemporaryDirectory() as temp_dir:
+                output = os.path.join(temp_dir, "output.ch8")
+                cc.write_output(output, program, use_mmap=True)
+
+                with open(output, "rb") as f:
+                    compiled_bytecodes = f.read()
+
+            with open(expected, "rb") as f:
+                expected_bytecodes = f.read()
+
+            self.assertEqual(compiled_bytecodes, expected_bytecodes, f"Byte codes not equal for {source}")
+
+    def test_context(self):
+        context = cc.AssemblyContext()
+        cc.parse_file(file_path="./instruction_test_input.mini8", context=context)
+
+        self.assertEqual(context.variables["test_dec"].value.value, 10)
+        self.assertEqual(context.labels["__lab"].address, 0x200 + 35 * 2)
+
+    def test_concurrent_assembly(self):
+        files = ["./instruction_test_input.mini8", "./hello_world_test.mini8", "./special_token_test.mini8"] * 8
+        expected = {file: cc.parse_file(file_path=file) for file in files}
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda file: cc.parse_file(file_path=file), files))
+
+        for file, result in zip(files, results):
+            self.assertEqual(result, expected[file], f"Byte codes not equal for {file}")
+
+    def test_generated_program(self):
+        from profiling.program_generator import ProgramShape, generate_program
+
+        shape = ProgramShape(instructions=2_000, seed=1)
+        context = cc.AssemblyContext()
+        compiled_bytecodes = cc.assemble(generate_program(shape), context)
+
+        self.assertEqual(len(compiled_bytecodes), shape.byte_size)
+        self.assertEqual(len(context.labels), shape.labels + shape.sprites)
+        self.assertEqual(compiled_bytecodes, cc.assemble(generate_program(shape), compact=False))
+
+    def test_stats(self):
+        stats = cc.AssemblyStats(track_allocations=True)
+        hook = stats.attach("parse", cc.CProfileHook())
+        compiled_bytecodes = cc.parse_file(file_path="./instruction_test_input.mini8", stats=stats)
+
+        self.assertEqual(compiled_bytecodes, cc.parse_file(file_path="./instruction_test_input.mini8"))
+        self.assertEqual(stats.counters["instructions"], 35)
+        self.assertEqual(stats.counters["data_bytes"] + 2 * stats.counters["instructions"], len(compiled_bytecodes))
+        self.assertGreater(stats.phases["parse"], 0)
+        self.assertLessEqual(sum(stats.phases.values()), stats.elapsed)
+        self.assertIn("parse_item", hook.report())
+        self.assertEqual(json.loads(stats.to_json())["counters"], stats.counters)
+
+    def test_tokenize(self):
+        from chip8_compiler.Lexer import tokenize, TokenKind
+
+        tokens = tokenize("DRW V0, __sprite, $d5", 7)
+        self.assertEqual(
+            [(token.kind, token.text, token.column) for token in tokens],
+            [
+                (TokenKind.INSTRUCTION, "DRW", 1),
+                (TokenKind.REGISTER, "V0", 5),
+                (TokenKind.LABEL, "__sprite", 9),
+                (TokenKind.LITERAL, "$d5", 19)
+            ]
+        )
+        self.assertTrue(all(token.line == 7 for token in tokens))
+
+        with self.assertRaisesRegex(cc.AssemblyError, "line 3, column 4"):
+            cc.assemble(["segment code:", "CLS", "JP foo", "segment_end", "segment data:", "segment_end"])
+
     def test_time_1k(self):
         # We want to have a time under 0.01 seconds
         start = timer()
@@ -46,6 +188,803 @@ class TestInstructions(unittest.TestCase):
 
         self.assertLess(end - start, 0.12, "Time is greater than 0.01 seconds")
 
+    def test_startup(self):
+        # What the console script imports before assembling a file
+        code = ("import sys, chip8_compiler.chip8_cli, chip8_compiler as cc; cc.parse_file('./time_1k_test.mini8'); "
+                "print(' '.join(sys.modules))")
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True, text=True, check=True,
+            env={**os.environ, "PYTHONPATH": os.pathsep.join([os.path.abspath(".."), os.environ.get("PYTHONPATH", "")])}
+        )
+        modules = set(result.stdout.split())
+
+        self.assertEqual(
+            {module for module in modules if module.startswith("chip8_compiler")},
+            {"chip8_compiler", *(f"chip8_compiler.{module}" for module in [
+                "chip8_cli", "Parser", "Lexer", "Types", "Tokens", "Interfaces", "Globals", "Program", "Preprocessor",
+                "_ChipInstructions"
+            ])}
+        )
+        # Nor anything only needed by the other commands, or by the command line
+        for module in ["argparse", "multiprocessing", "concurrent.futures", "hashlib"]:
+            self.assertNotIn(module, modules)
+
+        # And importing them stays cheap: the cumulative time of the imports not nested in another one, in us
+        import_time = sum(
+            int(cumulative) for _, cumulative, name in (line.split("|") for line in result.stderr.splitlines()[1:])
+            if name.startswith(" chip8_compiler")
+        )
+        self.assertLess(import_time, 500_000)
+
+        # The instruction names are spelled out, not read from the LUTs
+        from chip8_compiler._ChipInstructions import INSTRUCTION_NAMES, encoding_table
+        self.assertEqual(INSTRUCTION_NAMES, {command for command, *_ in encoding_table()})
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.temp_dir, "src")
+        os.makedirs(os.path.join(self.source_dir, "nested"))
+
+        shutil.copy("./instruction_test_input.mini8", os.path.join(self.source_dir, "instructions.mini8"))
+        shutil.copy("./special_token_test.mini8", os.path.join(self.source_dir, "nested", "special.mini8"))
+        with open(os.path.join(self.source_dir, "broken.mini8"), "w") as f:
+            f.write("segment code:\n    JP __nowhere\nsegment_end\nsegment data:\nsegment_end\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_build_many(self):
+        output_dir = os.path.join(self.temp_dir, "out")
+        summary = cc.build_many([self.source_dir], output_dir, jobs=2)
+
+        self.assertEqual(len(summary.results), 3)
+        self.assertEqual([os.path.basename(result.source) for result in summary.failed], ["broken.mini8"])
+        self.assertIn("__nowhere", summary.failed[0].error)
+
+        with open(os.path.join(output_dir, "nested", "special.ch8"), "rb") as f:
+            compiled_bytecodes = f.read()
+        with open("./special_token_test_expected.ch8", "rb") as f:
+            expected_bytecodes = f.read()
+
+        self.assertEqual(compiled_bytecodes, expected_bytecodes, "Byte codes not equal")
+
+    def test_build_stream(self):
+        output_dir = os.path.join(self.temp_dir, "out")
+
+        async def build():
+            self.assertEqual(
+                await cc.assemble_file_async("./special_token_test.mini8"), cc.parse_file("./special_token_test.mini8")
+            )
+            results = [result async for result in cc.build_stream([self.source_dir], output_dir, queue_size=1)]
+
+            # Left after the first result: nothing more is written
+            source = os.path.join(self.source_dir, "instructions.mini8")
+            pairs = [(source, os.path.join(output_dir, "many", f"{index}.ch8")) for index in range(50)]
+            async with contextlib.aclosing(cc.AsyncAssembler().build(pairs, queue_size=1)) as stream:
+                async for _ in stream:
+                    break
+            return results
+
+        results = asyncio.run(build())
+        # In order, with a single worker
+        self.assertEqual(
+            [os.path.basename(result.source) for result in results],
+            ["broken.mini8", "instructions.mini8", "special.mini8"]
+        )
+        self.assertIn("__nowhere", results[0].error)
+        with open(os.path.join(output_dir, "nested", "special.ch8"), "rb") as f:
+            self.assertEqual(f.read(), cc.parse_file("./special_token_test.mini8"))
+        self.assertLess(len(os.listdir(os.path.join(output_dir, "many"))), 10)
+
+    def test_build_includes(self):
+        # The fragments included by the other sources of a directory are not built on their own
+        project_dir = os.path.join(self.temp_dir, "project")
+        os.makedirs(os.path.join(project_dir, "lib"))
+        for name, code in [
+            ("main.mini8", 'include "lib/macros.mini8"\nsegment code:\nclear\nsegment_end\nsegment data:\n'
+                           'include "sprites.mini8"\nsegment_end\n'),
+            ("lib/macros.mini8", "macro clear:\nCLS\nmacro_end\n"),
+            ("sprites.mini8", "$0xF0\n")
+        ]:
+            with open(os.path.join(project_dir, name), "w") as f:
+                f.write(code)
+
+        output_dir = os.path.join(self.temp_dir, "out")
+        self.assertEqual(cc.build_many([project_dir], output_dir, jobs=1).failed, [])
+        self.assertEqual(os.listdir(output_dir), ["main.ch8"])
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_cache_hit(self):
+        cache = cc.BuildCache(self.temp_dir)
+        cold_build = cc.assemble_cached("./instruction_test_input.mini8", cache)
+        warm_build = cc.assemble_cached("./instruction_test_input.mini8", cache)
+
+        with open("./instruction_test_expected.ch8", "rb") as f:
+            expected_bytecodes = f.read()
+
+        self.assertFalse(cold_build.hit)
+        self.assertTrue(warm_build.hit)
+        self.assertEqual(warm_build.bytecode, expected_bytecodes, "Byte codes not equal")
+        self.assertEqual(warm_build.symbols, cold_build.symbols)
+        self.assertEqual(warm_build.symbols["variables"]["test_bin"]["value"], 0b01110)
+
+    def test_corrupt_entry(self):
+        cache = cc.BuildCache(self.temp_dir)
+        cold_build = cc.assemble_cached("./instruction_test_input.mini8", cache)
+        (entry,) = [entry.path for entry in os.scandir(self.temp_dir) if entry.name.endswith(".c8c")]
+
+        # Not an entry at all, then a symbol table longer than the entry: a miss, and the entry is written again
+        for garbage in [b"garbage", b"\xff\xff\xff\xff{}"]:
+            with open(entry, "wb") as f:
+                f.write(garbage)
+            rebuilt = cc.assemble_cached("./instruction_test_input.mini8", cache)
+            self.assertFalse(rebuilt.hit)
+            self.assertEqual(rebuilt.bytecode, cold_build.bytecode)
+            self.assertTrue(cc.assemble_cached("./instruction_test_input.mini8", cache).hit)
+
+    def test_file_mode(self):
+        # The files written atomically get the mode of the files open creates, not the one of the temporary files
+        reference_path = os.path.join(self.temp_dir, "reference")
+        open(reference_path, "wb").close()
+        path = os.path.join(self.temp_dir, "out", "program.ch8")
+        cc.write_atomically(path, b"\x00\xe0")
+        self.assertEqual(os.stat(path).st_mode, os.stat(reference_path).st_mode)
+
+        # Replacing a file keeps its mode
+        os.chmod(path, 0o640)
+        cc.write_atomically(path, b"\x00\xee")
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+
+    def test_cache_eviction(self):
+        cache = cc.BuildCache(self.temp_dir, max_bytes=1024)
+        for index in range(64):
+            cache.put(cache.key(str(index).encode()), bytes(100), {})
+
+        self.assertLessEqual(cache.size(), 1024)
+        self.assertIsNotNone(cache.get(cache.key(b"63")), "The most recent entry was evicted")
+
+        # An entry is never kept over a more recently used one, even when it is small enough to fit
+        cache.clear()
+        for name, size, last_use in [(b"old", 10, 1), (b"large", 400, 2), (b"recent", 200, 3)]:
+            cache.put(cache.key(name), bytes(size), {})
+            os.utime(os.path.join(self.temp_dir, cache.key(name) + ".c8c"), (last_use, last_use))
+        cache.evict()
+        self.assertEqual(
+            [cache.get(cache.key(name)) is not None for name in [b"old", b"large", b"recent"]], [False, False, True]
+        )
+
+
+class TestPreprocessor(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.temp_dir, "lib"))
+
+        self.write("lib/sprite.mini8", "; Shared sprite\nlabel __smile:\n    $b00100100\n    $b01000010\n")
+        self.write("lib/macros.mini8", "macro draw x, y:\n    LD V0, x\n    LD V1, y\n    DRW V0, V1, $2\nmacro_end\n"
+                                       "macro draw_twice x:\n    draw x, x\n    draw x, $d8\nmacro_end\n")
+        self.write("main.mini8", 'include "lib/macros.mini8"\nsegment code:\n    LD I, __smile\n    draw_twice $d4\n'
+                                 'segment_end\nsegment data:\n    include "lib/sprite.mini8"\nsegment_end\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, code):
+        with open(os.path.join(self.temp_dir, name), "w") as f:
+            f.write(code)
+        return os.path.join(self.temp_dir, name)
+
+    def test_expansion(self):
+        expected_bytecodes = cc.assemble([
+            "segment code:", "LD I, __smile",
+            "LD V0, $d4", "LD V1, $d4", "DRW V0, V1, $2", "LD V0, $d4", "LD V1, $d8", "DRW V0, V1, $2",
+            "segment_end", "segment data:", "label __smile:", "$b00100100", "$b01000010", "segment_end"
+        ])
+
+        preprocessor = Preprocessor()
+        for name in ["main.mini8", "main.mini8"]:
+            compiled_bytecodes = cc.parse_file(os.path.join(self.temp_dir, name), preprocessor=preprocessor)
+            self.assertEqual(compiled_bytecodes, expected_bytecodes, "Byte codes not equal")
+
+        # Each included file is only loaded once
+        self.assertEqual(preprocessor.cache.misses, 2)
+        self.assertEqual(
+            preprocessor.graph.dependents(os.path.join(self.temp_dir, "lib", "sprite.mini8")),
+            {os.path.join(self.temp_dir, "main.mini8")}
+        )
+
+    def test_errors(self):
+        self.write("a.mini8", 'include "b.mini8"\n')
+        self.write("b.mini8", 'include "a.mini8"\n')
+        recursive_path = self.write("recursive.mini8", "macro loop x:\n    loop x\nmacro_end\nsegment code:\n"
+                                                       "    loop $1\nsegment_end\nsegment data:\nsegment_end\n")
+
+        with self.assertRaisesRegex(cc.PreprocessorError, "Include cycle"):
+            cc.parse_file(os.path.join(self.temp_dir, "a.mini8"))
+        with self.assertRaisesRegex(cc.PreprocessorError, "invokes itself"):
+            cc.parse_file(recursive_path)
+
+    def test_cache_key(self):
+        cache = cc.BuildCache(os.path.join(self.temp_dir, "cache"))
+        main_path = os.path.join(self.temp_dir, "main.mini8")
+        cold_build = cc.assemble_cached(main_path, cache)
+
+        # Changing an included file changes the key
+        self.write("lib/sprite.mini8", "label __smile:\n    $b11111111\n    $b01000010\n")
+        changed_build = cc.assemble_cached(main_path, cache)
+
+        self.assertFalse(changed_build.hit)
+        self.assertNotEqual(changed_build.bytecode, cold_build.bytecode)
+
+
+class TestLinker(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        self.main_path = self.write("main.mini8", "segment code:\n    CALL __draw\n    LD I, __sprite\n"
+                                                  "    LD V0, width\n    label __loop:\n    JP __loop\nsegment_end\n"
+                                                  "segment data:\nsegment_end\n")
+        self.lib_path = self.write("lib.mini8", "segment code:\n    variable width $8\n    label __draw:\n"
+                                                "    LD V1, width\n    JP __ADDR__\n    RET\nsegment_end\n"
+                                                "segment data:\n    label __sprite:\n    $FF\n    $81\nsegment_end\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, code):
+        with open(os.path.join(self.temp_dir, name), "w") as f:
+            f.write(code)
+        return os.path.join(self.temp_dir, name)
+
+    def test_single_module(self):
+        for file_path in ["./instruction_test_input.mini8", "./special_token_test.mini8", "./time_1k_test.mini8"]:
+            module = cc.ObjectModule.from_bytes(cc.assemble_object(file_path).to_bytes())
+            self.assertEqual(cc.link([module]), cc.parse_file(file_path), "Byte codes not equal")
+
+    def test_invalid_object(self):
+        data = cc.assemble_object("./instruction_test_input.mini8").to_bytes()
+        header_start = len(OBJECT_MAGIC) + 4
+        header_end = header_start + int.from_bytes(data[len(OBJECT_MAGIC):header_start], "big")
+        header = json.loads(data[header_start:header_end])
+
+        # A missing key, a count of the wrong type and a malformed export table all read as invalid
+        for changed in [{"size": None}, {"relocations": "1"}, {"exports": []}]:
+            encoded = json.dumps({key: value for key, value in {**header, **changed}.items() if value is not None})
+            with self.assertRaises(cc.LinkError):
+                cc.ObjectModule.from_bytes(OBJECT_MAGIC + len(encoded).to_bytes(4, "big") + encoded.encode())
+
+        with self.assertRaises(cc.LinkError):
+            cc.ObjectModule.from_bytes(data[:header_end + 1])
+        with self.assertRaises(cc.LinkError):
+            cc.ObjectModule.from_bytes(data[:header_end - 1])
+
+    def test_link(self):
+        expected_bytecodes = bytes.fromhex("2208a20e600812066108120a00eeff81")
+        self.assertEqual(cc.link_files([self.main_path, self.lib_path]).bytecode, expected_bytecodes)
+
+        with self.assertRaisesRegex(cc.LinkError, "Undefined symbols: __draw, __sprite, width"):
+            cc.link([cc.assemble_object(self.main_path)])
+        with self.assertRaisesRegex(cc.LinkError, "more than one module: __draw, __sprite, width"):
+            cc.link([cc.assemble_object(self.lib_path), cc.assemble_object(self.lib_path)])
+
+    def test_relink(self):
+        object_dir = os.path.join(self.temp_dir, "objects")
+        cold_link = cc.link_files([self.main_path, self.lib_path], object_dir)
+        warm_link = cc.link_files([self.main_path, self.lib_path], object_dir)
+
+        self.assertEqual(cold_link.assembled, [self.main_path, self.lib_path])
+        self.assertEqual(warm_link.assembled, [])
+        self.assertEqual(warm_link.bytecode, cold_link.bytecode)
+
+        # Only the changed source is assembled again
+        self.write("lib.mini8", "segment code:\n    variable width $4\n    label __draw:\n    RET\nsegment_end\n"
+                                "segment data:\n    label __sprite:\n    $FF\nsegment_end\n")
+        os.utime(self.lib_path, ns=(0, os.stat(self.lib_path).st_mtime_ns + 1_000_000_000))
+        changed_link = cc.link_files([self.main_path, self.lib_path], object_dir)
+
+        self.assertEqual(changed_link.assembled, [self.lib_path])
+        self.assertEqual(changed_link.bytecode, bytes.fromhex("2208a20a6004120600eeff"))
+
+
+class TestIncremental(unittest.TestCase):
+
+    def test_edits(self):
+        with open("./time_1k_test.mini8", "r") as f:
+            lines = f.read().splitlines()
+
+        assembler = cc.IncrementalAssembler()
+        self.assertTrue(assembler.update(lines).full_build)
+
+        code_start = lines.index("segment code:") + 1
+        edits = [
+            lambda source: source.insert(code_start, "    CLS"),
+            lambda source: source.insert(code_start + 1, "    label __incremental:"),
+            lambda source: source.insert(len(source) - 1, "    JP __incremental"),
+            lambda source: source.__setitem__(code_start, "    JP __ADDR__"),
+            lambda source: source.__delitem__(len(source) - 2)
+        ]
+        for edit in edits:
+            edit(lines)
+            result = assembler.update(lines)
+            self.assertFalse(result.full_build)
+            self.assertLessEqual(result.reparsed_lines, 1)
+            self.assertEqual(result.bytecode, cc.assemble(lines), "Byte codes not equal")
+
+    def test_invalid_edit(self):
+        lines = ["segment code:", "label __start:", "JP __start", "segment_end", "segment data:", "segment_end"]
+        assembler = cc.IncrementalAssembler()
+        bytecode = assembler.update(lines).bytecode
+
+        with self.assertRaisesRegex(cc.InvalidCodeError, "Label '__start' is never defined"):
+            assembler.edit(1, 2, [])
+        with self.assertRaisesRegex(cc.AssemblyError, "Label '__start' was already defined"):
+            assembler.edit(2, 2, ["label __start:"])
+
+        # The last valid version is kept
+        self.assertEqual(assembler.lines, lines)
+        self.assertEqual(assembler.edit(2, 2, ["CLS"]).bytecode, bytes.fromhex("00e01200"))
+        self.assertNotEqual(assembler.bytecode, bytecode)
+
+
+class TestWatch(unittest.TestCase):
+
+    def test_rebuild(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source_dir = os.path.join(temp_dir, "src")
+            os.makedirs(os.path.join(source_dir, "sub"))
+
+            def write(path, code):
+                with open(path, "w") as f:
+                    f.write(code)
+                # A distinct mtime, whatever the resolution of the file system
+                os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1_000_000_000))
+
+            main_path = os.path.join(source_dir, "main.mini8")
+            other_path = os.path.join(source_dir, "sub", "other.mini8")
+            lib_path = os.path.join(source_dir, "lib.mini8")
+            write(lib_path, "CLS\n")
+            write(main_path, "segment code:\ninclude \"lib.mini8\"\nsegment_end\nsegment data:\nsegment_end\n")
+            write(other_path, "segment code:\nRET\nsegment_end\nsegment data:\nsegment_end\n")
+
+            watcher = cc.Watcher(source_dir, os.path.join(temp_dir, "out"), debounce=1.0)
+            self.assertTrue(all(result.ok for result in watcher.start()))
+            # The included file is not a source of its own
+            self.assertEqual(watcher.sources, [main_path, other_path])
+            self.assertEqual(watcher.poll(now=0.0), [])
+
+            # Rebuilt once the changes settled, only the sources including the changed file
+            write(lib_path, "CLS\nRET\n")
+            self.assertEqual(watcher.poll(now=10.0), [])
+            results = watcher.poll(now=11.0)
+            self.assertEqual([result.source for result in results], [main_path])
+            with open(watcher.output_path(main_path), "rb") as f:
+                self.assertEqual(f.read(), bytes.fromhex("00e000ee"))
+
+            os.remove(other_path)
+            watcher.poll(now=20.0)
+            self.assertEqual(watcher.poll(now=21.0), [])
+            self.assertFalse(os.path.exists(watcher.output_path(other_path)))
+
+
+class TestOptimizer(unittest.TestCase):
+
+    def test_rules(self):
+        code = [
+            "segment code:",
+            "NOOP", "LD I, __a", "LD I, __b", "CALL __sub", "JP __next",
+            "label __next:", "SE V0x0, $0x1", "NOOP", "JP __hop",
+            "label __hop:", "JP __end",
+            "label __sub:", "LD V0x1, $0x3", "CALL __sub2", "RET",
+            "label __sub2:", "DRW V0x0, V0x1, $0x1", "RET",
+            "label __end:", "JP __ADDR__",
+            "segment_end",
+            "segment data:", "label __a:", "$0xF0", "label __b:", "$0x90", "segment_end"
+        ]
+        optimizer = Optimizer(verify=True)
+        bytecode = cc.assemble(code, optimizer=optimizer)
+
+        # The NOOP after the skip stays, the JP at __hop is left unreachable once the jump to it is threaded
+        self.assertEqual(bytecode.hex(), "a213220a3001000012106103d01100ee1210f090")
+        self.assertEqual(optimizer.report.bytes_saved, {
+            "dead_code": 2, "tail_call": 2, "jump_threading": 0, "noop": 2, "jump_to_next": 4, "redundant_load_i": 2,
+            "data_packing": 0
+        })
+        self.assertTrue(optimizer.report.verified)
+
+        # The program jumps by value, so only the jumps are threaded
+        code[1] = "JP V0x0, $0x202"
+        optimizer = Optimizer(verify=True)
+        self.assertEqual(len(cc.assemble(code, optimizer=optimizer)), len(cc.assemble(code)))
+        self.assertEqual(optimizer.report.rewrites["jump_threading"], 1)
+        self.assertIsNotNone(optimizer.report.restricted)
+
+    def test_dead_code(self):
+        code = [
+            "segment code:",
+            "LD V0x0, $0x2", "JP V0x0, __table",
+            "label __unused:", "CLS", "RET",
+            "label __table:", "JP __first", "JP __second",
+            "label __first:", "CALL __used", "label __second:", "JP __ADDR__",
+            "label __used:", "LD V0x1, speed", "RET",
+            "segment_end",
+            "segment data:", "variable speed $0x3", "variable unused $0x4", "segment_end"
+        ]
+        context = cc.AssemblyContext()
+        optimizer = Optimizer(verify=True)
+        bytecode = cc.assemble(code, context, optimizer=optimizer)
+
+        # Only __unused goes, the table keeps its layout
+        self.assertEqual(bytecode.hex(), "6002b2041208120a220c120a610300ee")
+        self.assertEqual(optimizer.report.bytes_saved["dead_code"], 4)
+        self.assertEqual(optimizer.report.removed_variables, ["unused"])
+        self.assertEqual(context.labels["__unused"].address, 0x204)
+
+        cc.assemble(code, context, compact=False)
+        graph = cc.ControlFlowGraph(context.raw_opcodes)
+        self.assertEqual(graph.unreachable_instructions(), [2, 3])
+        self.assertEqual(graph.blocks[0].successors, [2, 3, 4, 5, 6, 7])
+
+    def test_cli(self):
+        from chip8_compiler.chip8_cli import main
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, "out.ch8")
+            optimized = cc.assemble_file("./hello_world_test.mini8", optimizer=Optimizer()).to_bytes()
+
+            # The stats are taken of the optimized assembly, the optimizer being timed as a phase of its own
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                self.assertEqual(main(["-i", "./hello_world_test.mini8", "-o", output, "-O", "--stats", "json"]), 0)
+            with open(output, "rb") as f:
+                self.assertEqual(f.read(), optimized)
+
+            # The flags that would be ignored are rejected
+            for flags in [["-O", "-c"], ["-O", "--daemon"], ["-O", "--cache-dir", temp_dir], ["--verify"]]:
+                with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                    main(["-i", "./hello_world_test.mini8", "-o", output, *flags])
+
+        stats = cc.AssemblyStats()
+        cc.assemble_file("./hello_world_test.mini8", stats=stats, optimizer=Optimizer())
+        self.assertGreater(stats.phases["optimize"], 0)
+
+    def test_data_packing(self):
+        code = [
+            "segment code:",
+            "LD I, __a", "DRW V0x0, V0x1, $0x3", "LD I, __b", "DRW V0x0, V0x1, $0x3",
+            "LD I, __c", "DRW V0x0, V0x1, $0x4", "LD I, __d", "DRW V0x0, V0x1, $0x2",
+            "label __end:", "JP __end",
+            "segment_end",
+            "segment data:",
+            "label __a:", "$0x1", "$0x2", "$0x3", "label __b:", "$0x1", "$0x2", "$0x3",
+            "label __c:", "$0x3", "$0x4", "$0x5", "$0x6", "label __d:", "$0x5", "$0x6",
+            "segment_end"
+        ]
+        context = cc.AssemblyContext()
+        optimizer = Optimizer(verify=True)
+        bytecode = cc.assemble(code, context, optimizer=optimizer)
+
+        # __b is __a, __c starts with the end of __a, __d is the end of __c
+        self.assertEqual(bytecode.hex(), "a212d013a212d013a214d014a216d0121210010203040506")
+        self.assertEqual(optimizer.report.bytes_saved["data_packing"], 6)
+        self.assertEqual(
+            [context.labels[name].address for name in ("__a", "__b", "__c", "__d")], [0x212, 0x212, 0x214, 0x216]
+        )
+
+        # Drawing past the end of __d would draw __a, the data stays as is
+        code[8] = "DRW V0x0, V0x1, $0x5"
+        optimizer = Optimizer(verify=True)
+        cc.assemble(code, optimizer=optimizer)
+        self.assertEqual(optimizer.report.bytes_saved["data_packing"], 0)
+        self.assertIsNotNone(optimizer.report.data_kept)
+
+        # I is followed past the label of the DRW: it draws __TOP and __BOTTOM, which must stay together
+        code = [
+            "segment code:", "LD I, __TOP", "label __draw:", "DRW V0x0, V0x0, $d4", "JP __draw", "segment_end",
+            "segment data:",
+            "label __TOP:", "$0xFF", "$0x81", "label __BOTTOM:", "$0x81", "$0xFF", "label __OTHER:", "$0xFF", "$0x81",
+            "segment_end"
+        ]
+        optimizer = Optimizer(verify=True)
+        self.assertEqual(cc.assemble(code, optimizer=optimizer), cc.assemble(code))
+        self.assertEqual(optimizer.report.data_kept, "the instruction at 0x202 reads 4 bytes from 0x206")
+        # The bytes drawn are compared, not the run loaded
+        self.assertIsNotNone(equivalent(bytes.fromhex("a206d0041202ff8181ffff81"), bytes.fromhex("a206d0041202ff81ff")))
+
+        # Thousands of sprites, each found in the block
+        sprites = [bytes((index * 7 + row * 13) % 41 for row in range(index % 15 + 1)) for index in range(5000)]
+        block, offsets = pack(sprites)
+        self.assertLess(len(block), sum(map(len, sprites)))
+        for sprite, offset in zip(sprites, offsets):
+            self.assertEqual(block[offset:offset + len(sprite)], sprite)
+
+
+class TestDiagnostics(unittest.TestCase):
+
+    def test_diagnose(self):
+        code = [
+            "; every kind of error",
+            "segment code:",
+            "    LD V0x0, $0xZZ",
+            "    JP __nowhere",
+            "",
+            "        LD I, sprite",
+            "    label __start:",
+            "    label __start:",
+            "    CALL __nowhere",
+            "segment_end",
+            "segment data:",
+            "    $0x100"
+        ]
+        diagnostics = cc.diagnose(code, "game.mini8")
+        self.assertEqual(
+            [(diagnostic.kind, diagnostic.line, diagnostic.column, diagnostic.symbol) for diagnostic in diagnostics],
+            [
+                (cc.DiagnosticKind.SYNTAX, 3, 14, None),
+                (cc.DiagnosticKind.UNRESOLVED, 4, 8, "__nowhere"),
+                (cc.DiagnosticKind.UNRESOLVED, 6, 15, "sprite"),
+                (cc.DiagnosticKind.DUPLICATE, 8, 11, "__start"),
+                (cc.DiagnosticKind.UNRESOLVED, 9, 10, "__nowhere"),
+                (cc.DiagnosticKind.SEGMENT, 11, None, None),
+                (cc.DiagnosticKind.SYNTAX, 12, 5, None)
+            ]
+        )
+        self.assertEqual(str(diagnostics[1]), "game.mini8:4:8: error: Label '__nowhere' is never defined [unresolved]")
+        self.assertEqual(len(cc.diagnose(code, fail_fast=True)), 1)
+        self.assertEqual(cc.diagnose(["segment code:", "CLS", "segment_end", "segment data:", "segment_end"]), [])
+
+        # Assembling stops at the first error, which has the same position within the code of the line
+        with self.assertRaises(cc.AssemblyError) as error:
+            cc.assemble(code)
+        self.assertEqual((error.exception.line, error.exception.column), (3, 10))
+
+    def test_operands(self):
+        # Literals too wide for their field, and a register past VF
+        code = [
+            "segment code:",
+            "    LD V0x1, $d300",
+            "    DRW V0x1, V0x2, $d20",
+            "  JP $0x1234",
+            "    LD V0x10, $d3",
+            "    JP $0xFFF",
+            "segment_end",
+            "segment data:",
+            "segment_end"
+        ]
+        self.assertEqual(
+            [(diagnostic.kind, diagnostic.line, diagnostic.column) for diagnostic in cc.diagnose(code)],
+            [(cc.DiagnosticKind.SYNTAX, 2, 14), (cc.DiagnosticKind.SYNTAX, 3, 21), (cc.DiagnosticKind.SYNTAX, 4, 6),
+             (cc.DiagnosticKind.SYNTAX, 5, 8)]
+        )
+
+
+class TestMachine(unittest.TestCase):
+
+    def test_hello_world(self):
+        machine = vm.run_file("hello_world_test.mini8")
+        self.assertEqual(machine.run(), cc.StopReason.HALTED)
+        self.assertEqual(
+            machine.framebuffer_hash(), "ac14d5eeb4dd6a45d19574eb1d149b35a0fb2b84dae143deee52dfe4177a1f86"
+        )
+        self.assertEqual(machine.label_counts()["__advance_height"], 3)
+
+    def test_run(self):
+        # A loop storing V0 over the operand of its ADD, so V0 doubles (4, 8, ... 128, 0), then a wait for a key
+        rom = bytes.fromhex("6003" "7001" "a203" "f055" "3000" "1202" "f10a" "120e")
+        machine = cc.Machine(rom, instructions_per_frame=1)
+        self.assertEqual(machine.run(), cc.StopReason.KEY_WAIT)
+        self.assertEqual(machine.pc, 0x20C)
+
+        machine.press(7)
+        self.assertEqual(machine.run(), cc.StopReason.HALTED)
+        self.assertEqual(machine.v[1], 7)
+        self.assertEqual(machine.execution_counts()[0x202], 7)
+
+        with self.assertRaises(cc.MachineError):
+            cc.run_rom(bytes.fromhex("2200"))
+        self.assertEqual(vm.decode(0x00EE).command, "RET")
+        self.assertIsNone(vm.decode(0xE000))
+
+
+class TestDisassembler(unittest.TestCase):
+
+    def test_round_trip(self):
+        with open("hello_world_program.ch8", "rb") as f:
+            rom = f.read()
+
+        disassembly = cc.disassemble(rom)
+        source = disassembly.to_source()
+        self.assertIn("CALL __sub_254", source)
+        self.assertEqual(cc.assemble(source.splitlines()), rom)
+        self.assertEqual(sum(disassembly.histogram().values()), len(rom) // 2)
+
+        # Every opcode, a label in the middle of a word and a trailing byte
+        rom = b"".join(opcode.to_bytes(2, "big") for opcode in range(0x10000)) + b"\x12"
+        self.assertEqual(cc.assemble(cc.disassemble(rom).to_source().splitlines()), rom)
+        self.assertEqual(str(cc.disassemble(bytes.fromhex("d12f"))[0]), "DRW V0x1, V0x2, $0xF")
+
+    @unittest.skipIf(importlib.util.find_spec("numpy") is None, "numpy is not installed")
+    def test_numpy_decoding(self):
+        # The gather of numpy and the fallback over an array decode every opcode alike
+        rom = b"".join(opcode.to_bytes(2, "big") for opcode in range(0x10000)) + b"\x12"
+        with mock.patch("chip8_compiler.Disassembler._numpy", return_value=None):
+            fallback = cc.disassemble(rom)
+        disassembly = cc.disassemble(rom)
+
+        self.assertNotIsInstance(disassembly.opcodes, type(fallback.opcodes))
+        self.assertEqual(list(map(int, disassembly.opcodes)), list(fallback.opcodes))
+        self.assertEqual(list(map(int, disassembly.indexes)), list(fallback.indexes))
+        self.assertEqual(disassembly.to_source(), fallback.to_source())
+
+
+class TestLanguageServer(unittest.TestCase):
+
+    @staticmethod
+    def frame(message):
+        body = json.dumps({"jsonrpc": "2.0", **message}).encode()
+        return f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+
+    def test_session(self):
+        from chip8_compiler.LanguageServer import LanguageServer
+
+        uri = "file:///main.mini8"
+        text = "segment code:\n    CALL __draw\n    JP __missing\n    label __draw:\n    RET\nsegment_end\n" \
+               "segment data:\nsegment_end\n"
+        messages = [
+            {"id": 1, "method": "initialize", "params": {}},
+            {"method": "textDocument/didOpen", "params": {"textDocument": {"uri": uri, "version": 1, "text": text}}},
+            {"id": 2, "method": "textDocument/hover",
+             "params": {"textDocument": {"uri": uri}, "position": {"line": 1, "character": 11}}},
+            {"method": "textDocument/didChange", "params": {
+                "textDocument": {"uri": uri, "version": 2},
+                "contentChanges": [{"range": {"start": {"line": 2, "character": 0}, "end": {"line": 3, "character": 0}},
+                                    "text": "    CLS\n    CLS\n"}]
+            }},
+            {"id": 3, "method": "textDocument/definition",
+             "params": {"textDocument": {"uri": uri}, "position": {"line": 1, "character": 11}}},
+            {"id": 4, "method": "shutdown"},
+            {"method": "exit"}
+        ]
+
+        output_stream = io.BytesIO()
+        server = LanguageServer(io.BytesIO(b"".join(map(self.frame, messages))), output_stream)
+        self.assertEqual(server.run(), 0)
+
+        output_stream.seek(0)
+        reader = LanguageServer(output_stream, io.BytesIO())
+        responses = []
+        while (response := reader.read_message()) is not None:
+            responses.append(response)
+
+        diagnostics = [response["params"]["diagnostics"] for response in responses
+                       if response.get("method") == "textDocument/publishDiagnostics"]
+        results = {response["id"]: response["result"] for response in responses if "id" in response}
+
+        self.assertTrue(results[1]["capabilities"]["hoverProvider"])
+        self.assertEqual(
+            [diagnostic["message"] for diagnostic in diagnostics[0]], ["Label '__missing' is never defined"]
+        )
+        self.assertEqual(results[2]["contents"]["value"], "label __draw at 0x204")
+        self.assertEqual(diagnostics[1], [])
+        # The label moved down by a line
+        self.assertEqual(results[3]["range"]["start"], {"line": 4, "character": 10})
+
+    def test_incremental(self):
+        from chip8_compiler.LanguageServer import Document
+
+        with open("./time_10k_test.mini8", "r") as f:
+            document = Document("file:///time_10k_test.mini8", f.read())
+        layouts, analyzed = document.layouts, document.analyzed
+
+        # Typing within a line, then adding a line
+        line = len(document.lines) // 2
+        end = len(document.lines[line].text)
+        for change in [
+            {"range": {"start": {"line": line, "character": end}, "end": {"line": line, "character": end}},
+             "text": " "},
+            {"range": {"start": {"line": line, "character": 0}, "end": {"line": line, "character": 0}},
+             "text": "    CLS\n"}
+        ]:
+            document.apply_change(change)
+            document.diagnostics()
+
+        # Only the edited lines were analyzed again
+        self.assertEqual(document.layouts, layouts, "The document was laid out again")
+        self.assertEqual(document.analyzed - analyzed, 3)
+
+        expected = [(info.line, info.segment, info.offset) for info in
+                    Document("file:///time_10k_test.mini8", "\n".join(info.text for info in document.lines)).lines]
+        self.assertEqual([(info.line, info.segment, info.offset) for info in document.lines], expected)
+
+    def test_layout(self):
+        from chip8_compiler.LanguageServer import Document, UTF32
+
+        text = "macro BLINK x:\n    LD V0x0, x\n    JP __gone\nmacro_end\nsegment code:\n    BLINK $d3\n    NOPE\n" \
+               "    JP __missing ; \U0001F600\nsegment_end\nsegment data:\nsegment_end\n"
+        document = Document("file:///main.mini8", text)
+        # The errors of a macro are reported within its body, the unknown macros at their invocation
+        self.assertEqual(
+            [(diagnostic["range"]["start"]["line"], diagnostic["message"]) for diagnostic in document.diagnostics()],
+            [(6, "Unknown instruction or macro 'NOPE'"), (2, "Label '__gone' is never defined"),
+             (7, "Label '__missing' is never defined")]
+        )
+        self.assertEqual((document.lines[5].segment, document.lines[7].offset), ("code", 4))
+
+        # The characters past the basic plane take two UTF-16 code units, a single UTF-32 one
+        self.assertEqual((document.to_client(7, 20), document.from_client(7, 21)), (21, 20))
+        document = Document("file:///main.mini8", text, position_encoding=UTF32)
+        self.assertEqual((document.to_client(7, 20), document.from_client(7, 21)), (20, 21))
+
+
+class TestDaemon(unittest.TestCase):
+
+    def test_stdio(self):
+        from chip8_compiler.Daemon import AssemblerService, serve_stdio
+
+        requests = [
+            {"id": 1, "method": "assemble", "params": {"input": "./special_token_test.mini8"}},
+            {"id": 2, "method": "assemble", "params": {"input": "./special_token_test.mini8"}},
+            {"id": 3, "method": "unknown"},
+            {"id": 4, "method": "shutdown"},
+            {"id": 5, "method": "ping"}
+        ]
+        output_stream = io.StringIO()
+        serve_stdio(
+            AssemblerService(),
+            io.StringIO("\n".join(json.dumps(request) for request in requests)),
+            output_stream
+        )
+        responses = [json.loads(line) for line in output_stream.getvalue().splitlines()]
+
+        with open("./special_token_test_expected.ch8", "rb") as f:
+            expected_bytecodes = f.read()
+
+        self.assertEqual(len(responses), 4, "The server kept going after the shutdown")
+        self.assertEqual(base64.b64decode(responses[0]["result"]["bytecode"]), expected_bytecodes)
+        self.assertFalse(responses[0]["result"]["cached"])
+        self.assertTrue(responses[1]["result"]["cached"])
+        self.assertEqual(responses[2]["error"]["type"], "MethodNotFound")
+
+    def test_socket(self):
+        from chip8_compiler.Daemon import AssemblerService, AssemblerServer, DaemonClient, DaemonError
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            socket_path = os.path.join(temp_dir, "chip8.sock")
+            server = AssemblerServer(socket_path, AssemblerService())
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+
+            try:
+                client = DaemonClient(socket_path)
+                self.assertTrue(client.is_running())
+
+                output = os.path.join(temp_dir, "output.ch8")
+                self.assertEqual(client.assemble("./instruction_test_input.mini8", output)["size"], 70)
+                with open(output, "rb") as f, open("./instruction_test_expected.ch8", "rb") as expected:
+                    self.assertEqual(f.read(), expected.read(), "Byte codes not equal")
+
+                with self.assertRaises(DaemonError):
+                    client.assemble("./missing.mini8")
+
+                client.request("shutdown")
+                thread.join(timeout=5)
+                self.assertFalse(thread.is_alive(), "The server did not shut down")
+            finally:
+                server.server_close()
+
+            self.assertFalse(DaemonClient(socket_path).is_running())
+
 
 if __name__ == "__main__":
     unittest.main()